@@ -0,0 +1,192 @@
+"""
+microbenchmarks for sh's own overhead.  these don't measure how fast programs
+run, only how much time sh spends in python around them.  run all of them:
+
+    $> python bench.py
+
+or just some of them:
+
+    $> python bench.py attr call
+"""
+from __future__ import print_function
+import sys
+import os
+import timeit
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, THIS_DIR)
+
+import sh
+
+
+BENCHMARKS = []
+
+def benchmark(fn):
+    BENCHMARKS.append(fn)
+    return fn
+
+
+def report(name, number, seconds):
+    per_call = seconds / number * 1e6
+    print("%-40s %10.2f usec/op  (%d ops)" % (name, per_call, number))
+
+
+def run_timeit(name, fn, number):
+    best = min(timeit.Timer(fn).repeat(repeat=3, number=number))
+    report(name, number, best)
+
+
+class _NoSpawn(object):
+    """ stands in for RunningCommand so that we can time everything
+    Command.__call__ does up to, but not including, the fork """
+    def __init__(self, cmd, call_args, stdin, stdout, stderr):
+        self.cmd = cmd
+
+
+def _sh_globals():
+    return sh.Command.__init__.__globals__
+
+
+@benchmark
+def attr():
+    """ subcommand and internal attribute access """
+    git = sh.Command(sh.which("ls"))
+    run_timeit("git.log (subcommand access)", lambda: git.log, 200000)
+    run_timeit("git._path (internal attribute)", lambda: git._path, 200000)
+    run_timeit("git.bake('log')", lambda: git.bake("log"), 50000)
+    run_timeit("sh.ls (resolve from PATH)", lambda: sh.ls, 50000)
+
+
+@benchmark
+def call():
+    """ Command.__call__ overhead, excluding the fork """
+    g = _sh_globals()
+    orig = g["RunningCommand"]
+    g["RunningCommand"] = _NoSpawn
+    try:
+        ls = sh.Command(sh.which("ls"))
+        baked = ls.bake("-l", _tty_out=False)
+        run_timeit("ls('/tmp')", lambda: ls("/tmp"), 50000)
+        run_timeit("baked('/tmp')", lambda: baked("/tmp"), 50000)
+        run_timeit("ls('/tmp', _tty_out=False)",
+                lambda: ls("/tmp", _tty_out=False), 50000)
+        compiled = ls._compile("-l", sh.ARG, _tty_out=False)
+        run_timeit("compiled('/tmp')", lambda: compiled("/tmp"), 50000)
+    finally:
+        g["RunningCommand"] = orig
+
+
+@benchmark
+def import_hook():
+    """ what sh adds to imports that have nothing to do with it """
+    g = _sh_globals()
+    importer_class = g["ModuleImporterFromVariables"]
+    registered = any(isinstance(i, importer_class) for i in sys.meta_path)
+    print("importer registered after `import sh`: %s" % registered)
+
+    importer = importer_class(restrict_to=["SelfWrapper"])
+    find = lambda: importer.find_spec("not_a_context", None)
+    run_timeit("find_spec, no contexts", find, 200000)
+    run_timeit("find_spec, submodule",
+            lambda: importer.find_spec("json.decoder", ["/x"]), 200000)
+
+    context = sh(_tty_out=False)
+    run_timeit("find_spec, one context alive", find, 200000)
+
+
+def _context_from_call():
+    ctx = sh(_timeout=3)
+    return ctx
+
+@benchmark
+def context():
+    """ creating execution contexts """
+    run_timeit("sh(_timeout=3)", _context_from_call, 2000)
+    run_timeit("sh._context(_timeout=3)", lambda: sh._context(_timeout=3), 50000)
+    run_timeit("sh._context('ctx', _timeout=3)",
+            lambda: sh._context("ctx", _timeout=3), 50000)
+    ctx = sh._context(_timeout=3)
+    run_timeit("ctx.ls (resolve from PATH)", lambda: ctx.ls, 50000)
+
+
+@benchmark
+def memory():
+    """ memory held by finished commands that are kept around """
+    try:
+        import tracemalloc
+    except ImportError:
+        print("needs tracemalloc, from python 3.4")
+        return
+
+    import gc
+    true = sh.Command(sh.which("true"))
+    true()
+
+    def measure(name, fn, number=200):
+        gc.collect()
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            kept = [fn() for i in range(number)]
+            gc.collect()
+            held = tracemalloc.get_traced_memory()[0] - before
+        finally:
+            tracemalloc.stop()
+        print("%-40s %10d bytes/command" % (name, held // number))
+
+    measure("true()", lambda: true())
+    measure("true(_tty_out=False)", lambda: true(_tty_out=False))
+    measure("true(_timeout=10)", lambda: true(_timeout=10))
+
+    seq = sh.Command(sh.which("seq"))
+    measure("seq(1000)", lambda: seq(1000), 50)
+    measure("seq(1000, _freeze_output=True)",
+            lambda: seq(1000, _freeze_output=True), 50)
+    measure("seq(1000, _out_keep=512 head+tail)",
+            lambda: seq(1000, _out_keep=("head", 512, "tail", 512)), 50)
+    measure("seq(1000, _out_filter=\"^9\")",
+            lambda: seq(1000, _out_filter=b"^9"), 50)
+    measure("seq(1000, _out=sh._sinks.Hash())",
+            lambda: seq(1000, _out=sh._sinks.Hash()), 50)
+    measure("seq(1000, _out_compress=True)",
+            lambda: seq(1000, _out_compress=True), 50)
+
+
+# what `import sh` should take with cached bytecode, on the machine that sets
+# it.  it was ~57ms before the rarely needed modules were imported lazily.
+# test_import_is_lean keeps those modules out of `import sh`
+IMPORT_TIME_TARGET_MSEC = 30
+
+@benchmark
+def importtime():
+    """ how long `import sh` takes in a fresh interpreter """
+    # the first run makes sure that sh's bytecode is cached, so that we don't
+    # time compiling it
+    env = dict(os.environ)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    python = sh.Command(sys.executable).bake(_cwd=THIS_DIR, _env=env)
+    python("-c", "import sh")
+
+    best = None
+    for i in range(5):
+        err = python("-X", "importtime", "-c", "import sh").stderr
+        line = err.decode("utf8").strip().splitlines()[-1]
+        total = int(line.split("|")[1])
+        best = total if best is None else min(best, total)
+    msec = best / 1000.0
+    print("%-40s %10.2f msec  (target %d msec: %s)" % ("import sh", msec,
+        IMPORT_TIME_TARGET_MSEC,
+        "ok" if msec <= IMPORT_TIME_TARGET_MSEC else "MISSED"))
+
+    loaded = python("-c", "import sys, sh; print(len(sys.modules))").strip()
+    print("%-40s %10s" % ("modules loaded", loaded))
+
+
+if __name__ == "__main__":
+    wanted = set(sys.argv[1:])
+    for fn in BENCHMARKS:
+        if wanted and fn.__name__ not in wanted:
+            continue
+        print("%s: %s" % (fn.__name__, fn.__doc__.strip()))
+        fn()
+        print("")
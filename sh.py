@@ -28,35 +28,32 @@ __version__ = "1.12.14"
 __project_url__ = "https://github.com/amoffat/sh"
 
 
-import platform
+import sys
 
-if "windows" in platform.system().lower(): # pragma: no cover
+if sys.platform.startswith("win"): # pragma: no cover
     raise ImportError("sh %s is currently only supported on linux and osx. \
 please install pbs 0.110 (http://pypi.python.org/pypi/pbs) for windows \
 support." % __version__)
 
 
-import sys
 IS_PY3 = sys.version_info[0] == 3
 MINOR_VER = sys.version_info[1]
 IS_PY26 = sys.version_info[0] == 2 and MINOR_VER == 6
 
-import traceback
+# most of what sh can do is rarely used, so the modules that only those parts
+# need are imported where they're used, and not here.  this keeps `import sh`
+# cheap for short-lived scripts
 import os
 import re
 import time
-import getpass
-from types import ModuleType, GeneratorType
+from types import ModuleType, GeneratorType, MethodType, FunctionType
 from functools import partial
-import inspect
-import tempfile
 import stat
 import glob as glob_module
-import ast
 from contextlib import contextmanager
 import pwd
 import errno
-from io import UnsupportedOperation, open as fdopen
+from io import UnsupportedOperation, FileIO, BufferedWriter, BufferedRandom
 
 from locale import getpreferredencoding
 DEFAULT_ENCODING = getpreferredencoding() or "UTF-8"
@@ -87,24 +84,26 @@ else:
     from io import BytesIO as iocStringIO
     from Queue import Queue, Empty
 
-IS_OSX = platform.system() == "Darwin"
+# binary files, which write bytes to their fd as they are, once they've been
+# flushed.  py2's file doesn't translate newlines on posix either
+if IS_PY3:
+    raw_file_types = (FileIO, BufferedWriter, BufferedRandom)
+else:
+    raw_file_types = (file, FileIO, BufferedWriter, BufferedRandom)
+
+IS_OSX = sys.platform == "darwin"
 THIS_DIR = os.path.dirname(os.path.realpath(__file__))
 SH_LOGGER_NAME = __name__
 
 
 import errno
-import pty
-import termios
 import signal
 import gc
 import select
 import threading
-import tty
 import fcntl
 import struct
-import resource
 from collections import deque
-import logging
 import weakref
 
 
@@ -114,12 +113,11 @@ import weakref
 PUSHD_LOCK = threading.RLock()
 
 
-if hasattr(inspect, "getfullargspec"):
-    def get_num_args(fn):
+def get_num_args(fn):
+    import inspect
+    if hasattr(inspect, "getfullargspec"):
         return len(inspect.getfullargspec(fn).args)
-else:
-    def get_num_args(fn):
-        return len(inspect.getargspec(fn).args)
+    return len(inspect.getargspec(fn).args)
 
 if IS_PY3:
     raw_input = input
@@ -519,17 +517,55 @@ glob_module.glob = glob
 
 
 
+# this is our equivalent of the shell's `hash` table.  resolving a program
+# name means testing every directory in the search path with a few syscalls
+# each, and it happens on every `sh.<name>` lookup, so we remember the results.
+# the cache is keyed by the search path itself, so changing PATH naturally
+# starts a fresh index.  a name that resolved successfully is returned without
+# touching the filesystem again, just like bash.  a name that did NOT resolve
+# is only trusted for as long as none of the search directories have been
+# modified, so installing a new program is noticed without a _rehash().
+# resolve_command_path() also remembers where a name finally resolved to, by
+# the PATH it was resolved with, so a name found by its dashed version doesn't
+# have its underscored version looked for again every time
+_which_cache = {}
+_which_exe_cache = set()
+_resolved_cache = {}
+_which_cache_lock = threading.Lock()
+
+
+def _dir_mtimes(paths):
+    mtimes = []
+    for path in paths:
+        try:
+            mtimes.append(os.stat(path).st_mtime)
+        except OSError:
+            mtimes.append(None)
+    return mtimes
+
+
+def _rehash():
+    """ forgets every program location that which() has remembered, like the
+    shell's `hash -r`.  use this after removing or moving programs that have
+    already been resolved """
+    with _which_cache_lock:
+        _which_cache.clear()
+        _which_exe_cache.clear()
+        _resolved_cache.clear()
+
+
+def _is_exe(fpath):
+    return (os.path.exists(fpath) and
+            os.access(fpath, os.X_OK) and
+            os.path.isfile(os.path.realpath(fpath)))
+
+
 def which(program, paths=None):
     """ takes a program name or full path, plus an optional collection of search
     paths, and returns the full path of the requested executable.  if paths is
     specified, it is the entire list of search paths, and the PATH env is not
     used at all.  otherwise, PATH env is used to look for the program """
 
-    def is_exe(fpath):
-        return (os.path.exists(fpath) and
-                os.access(fpath, os.X_OK) and
-                os.path.isfile(os.path.realpath(fpath)))
-
     found_path = None
     fpath, fname = os.path.split(program)
 
@@ -537,30 +573,66 @@ def which(program, paths=None):
     # and we should just test if that program is executable.  if it is, return
     if fpath:
         program = os.path.abspath(os.path.expanduser(program))
-        if is_exe(program):
+        if program in _which_exe_cache:
+            found_path = program
+        elif _is_exe(program):
+            _which_exe_cache.add(program)
             found_path = program
 
     # otherwise, we've just passed in the program name, and we need to search
     # the paths to find where it actually lives
     else:
-        paths_to_search = []
-
         if isinstance(paths, (tuple, list)):
-            paths_to_search.extend(paths)
+            paths_to_search = tuple(paths)
         else:
-            env_paths = os.environ.get("PATH", "").split(os.pathsep)
-            paths_to_search.extend(env_paths)
-
-        for path in paths_to_search:
+            paths_to_search = os.environ.get("PATH", "")
+
+        entry = _which_cache.get(paths_to_search)
+        if entry is not None:
+            search_dirs, mtimes, found = entry
+            found_path = found.get(program)
+            if found_path is not None:
+                return found_path
+        else:
+            search_dirs = paths_to_search
+            if not isinstance(search_dirs, tuple):
+                search_dirs = tuple(search_dirs.split(os.pathsep))
+
+        # either we've never seen this program, or we know it's missing.  both
+        # are only trustworthy if none of the directories have changed since
+        # we built our index, otherwise we start the index over
+        cur_mtimes = _dir_mtimes(search_dirs)
+        with _which_cache_lock:
+            entry = _which_cache.get(paths_to_search)
+            if entry is None or entry[1] != cur_mtimes:
+                entry = (search_dirs, cur_mtimes, {})
+                _which_cache[paths_to_search] = entry
+            found = entry[2]
+
+        if program in found:
+            return found[program]
+
+        for path in search_dirs:
             exe_file = os.path.join(path, program)
-            if is_exe(exe_file):
+            if _is_exe(exe_file):
                 found_path = exe_file
                 break
 
+        found[program] = found_path
+
     return found_path
 
 
 def resolve_command_path(program):
+    # a relative path depends on our cwd, not on PATH, so only a bare name can
+    # be remembered
+    key = None
+    if not os.path.dirname(program):
+        key = (os.environ.get("PATH", ""), program)
+        path = _resolved_cache.get(key)
+        if path is not None:
+            return path
+
     path = which(program)
     if not path:
         # our actual command might have a dash in it, but we can't call
@@ -571,6 +643,10 @@ def resolve_command_path(program):
             path = which(program.replace("_", "-"))
         if not path:
             return None
+
+    if key is not None:
+        with _which_cache_lock:
+            _resolved_cache[key] = path
     return path
 
 
@@ -586,6 +662,11 @@ def resolve_command(name, baked_args=None):
 
 
 
+# the logging loggers behind our Loggers, by name.  there are only a handful of
+# names, so we look each one up once instead of on every message
+_loggers = {}
+
+
 class Logger(object):
     """ provides a memory-inexpensive logger.  a gotcha about python's builtin
     logger is that logger objects are never garbage collected.  if you create a
@@ -603,11 +684,31 @@ class Logger(object):
     "context", which will be the very unique name.  this allows us to get a
     logger with a very general name, eg: "command", and have a unique name
     appended to it via the context, eg: "ls -l /tmp" """
+
+    __slots__ = ("name", "context")
+
     def __init__(self, name, context=None):
         self.name = name
-        self.log = logging.getLogger("%s.%s" % (SH_LOGGER_NAME, name))
         self.set_context(context)
 
+    @property
+    def log(self):
+        try:
+            return _loggers[self.name]
+        except KeyError:
+            import logging
+            log = logging.getLogger("%s.%s" % (SH_LOGGER_NAME, self.name))
+            _loggers[self.name] = log
+            return log
+
+    def _enabled(self, level):
+        # if nothing has imported logging, nothing can have configured a
+        # handler for our messages, so we don't import it just to drop them
+        logging = sys.modules.get("logging")
+        if logging is None:
+            return False
+        return self.log.isEnabledFor(getattr(logging, level))
+
     def _format_msg(self, msg, *args):
         if self.context:
             msg = "%s: %s" % (self.context, msg)
@@ -625,10 +726,12 @@ class Logger(object):
         return l
 
     def info(self, msg, *args):
-        self.log.info(self._format_msg(msg, *args))
+        if self._enabled("INFO"):
+            self.log.info(self._format_msg(msg, *args))
 
     def debug(self, msg, *args):
-        self.log.debug(self._format_msg(msg, *args))
+        if self._enabled("DEBUG"):
+            self.log.debug(self._format_msg(msg, *args))
 
     def error(self, msg, *args):
         self.log.error(self._format_msg(msg, *args))
@@ -646,6 +749,146 @@ def default_logger_str(cmd, call_args, pid=None):
 
 
 
+class ConcurrencyLimiter(object):
+    """ limits how many child processes may be running at the same time.
+    processes that would go over the limit wait their turn, first come first
+    served.  a slot is taken just before a process is launched and given back
+    when it has exited.  this keeps bursts of commands, perhaps from many
+    threads at once, from exhausting pids, ptys and file descriptors.
+
+    keep in mind that a pipeline needs a slot for each of its processes, so a
+    limit smaller than your longest pipeline will wait forever """
+
+    def __init__(self, max_concurrent):
+        if max_concurrent < 1:
+            raise ValueError("max_concurrent must be at least 1")
+
+        self._lock = threading.Lock()
+        self._max_concurrent = max_concurrent
+        self._running = 0
+
+        # each waiter is a (time it started waiting, function to call when it
+        # gets its slot)
+        self._waiters = deque()
+
+        self._num_started = 0
+        self._num_waited = 0
+        self._total_wait_time = 0.0
+        self._max_wait_time = 0.0
+
+    def __repr__(self):
+        return "<ConcurrencyLimiter %d/%d, %d waiting>" % (self._running,
+                self._max_concurrent, len(self._waiters))
+
+    def set_max_concurrent(self, max_concurrent):
+        if max_concurrent < 1:
+            raise ValueError("max_concurrent must be at least 1")
+
+        with self._lock:
+            self._max_concurrent = max_concurrent
+            ready = self._grant_waiters()
+        for fn in ready:
+            fn()
+
+    def acquire(self):
+        """ blocks until a slot is free and takes it """
+        event = threading.Event()
+        if self._take_or_wait(event.set):
+            return
+        event.wait()
+
+    def acquire_async(self, fn):
+        """ calls fn as soon as a slot is free, either right now, or later, on
+        a thread of its own.  a slot is given up from deep inside whichever
+        command exited, so fn mustn't run there, where it would hold up, or
+        raise into, a command that has nothing to do with it """
+        def start():
+            thread = threading.Thread(target=fn, name="pending spawn")
+            thread.daemon = True
+            thread.start()
+
+        if self._take_or_wait(start):
+            fn()
+
+    def release(self):
+        with self._lock:
+            self._running -= 1
+            ready = self._grant_waiters()
+        for fn in ready:
+            fn()
+
+    def _take_or_wait(self, fn):
+        with self._lock:
+            if self._running < self._max_concurrent and not self._waiters:
+                self._running += 1
+                self._num_started += 1
+                return True
+
+            self._waiters.append((time.time(), fn))
+            return False
+
+    def _grant_waiters(self):
+        """ must be called with the lock held.  the functions it returns must
+        be called after the lock is released """
+        ready = []
+        now = time.time()
+        while self._waiters and self._running < self._max_concurrent:
+            queued_at, fn = self._waiters.popleft()
+            waited = now - queued_at
+
+            self._running += 1
+            self._num_started += 1
+            self._num_waited += 1
+            self._total_wait_time += waited
+            self._max_wait_time = max(self._max_wait_time, waited)
+            ready.append(fn)
+        return ready
+
+    def stats(self):
+        """ a snapshot of how the limit is being used, and how long processes
+        have had to wait for it """
+        with self._lock:
+            return {
+                "max_concurrent": self._max_concurrent,
+                "running": self._running,
+                "waiting": len(self._waiters),
+                "started": self._num_started,
+                "waited": self._num_waited,
+                "total_wait_time": self._total_wait_time,
+                "max_wait_time": self._max_wait_time,
+            }
+
+
+# the process-wide ConcurrencyLimiter, if set_max_concurrency() has set one
+_global_limiter = None
+
+
+def set_max_concurrency(max_concurrent):
+    """ limits how many processes sh will have running at once, across every
+    thread, to max_concurrent.  once the limit is reached, foreground commands
+    block until a process slot is free, and background commands return right
+    away and start when a slot frees up.  None removes the limit.  returns the
+    ConcurrencyLimiter being used, for its stats() """
+    global _global_limiter
+
+    if max_concurrent is None:
+        _global_limiter = None
+    elif _global_limiter is None:
+        _global_limiter = ConcurrencyLimiter(max_concurrent)
+    else:
+        _global_limiter.set_max_concurrent(max_concurrent)
+    return _global_limiter
+
+
+def get_concurrency_limiter(call_args):
+    limiter = call_args["max_concurrent"]
+    if limiter is None:
+        return _global_limiter
+    if not isinstance(limiter, ConcurrencyLimiter):
+        limiter = ConcurrencyLimiter(limiter)
+    return limiter
+
+
 class RunningCommand(object):
     """ this represents an executing Command object.  it is returned as the
     result of __call__() being executed on a Command instance.  this creates a
@@ -677,6 +920,13 @@ class RunningCommand(object):
         "bg_thread_exc",
     ))
 
+    # we can be kept around in large numbers, for example in a list of results,
+    # so we don't carry a __dict__
+    __slots__ = ("ran", "call_args", "cmd", "process", "log",
+            "_process_completed", "_stopped_iteration", "_limiter", "_spawned",
+            "_spawn_exc", "_cache_key", "_result_cache", "_result_cache_key",
+            "_flight", "_spawned_and_waited", "__weakref__")
+
     def __init__(self, cmd, call_args, stdin, stdout, stderr):
         """
             cmd is an array, where each element is encoded as bytes (PY3) or str
@@ -745,6 +995,25 @@ class RunningCommand(object):
         elif call_args["iter_noblock"] == "err":
             pipe = OProc.STDERR
 
+        # if we're limiting how many processes can run at once, this is what
+        # we got our slot from.  a background command that has to wait for a
+        # slot returns right away, and _spawned is set when it has started
+        self._limiter = None
+        self._spawned = None
+        self._spawn_exc = None
+
+        # if this command's results are being recorded in a _cache_dir, this
+        # is the key they'll be recorded under once we finish successfully
+        self._cache_key = None
+
+        # same for an in-memory ResultCache, from _cache_ttl
+        self._result_cache = None
+        self._result_cache_key = None
+
+        # if we're the first of several identical _single_flight commands,
+        # this is what the others are waiting on
+        self._flight = None
+
         # there's currently only one case where we wouldn't spawn a child
         # process, and that's if we're using a with-context with our command
         self._spawned_and_waited = False
@@ -753,55 +1022,185 @@ class RunningCommand(object):
             logger_str = log_str_factory(self.ran, call_args)
             self.log = Logger("command", logger_str)
 
-            self.log.info("starting process")
-
             if should_wait:
                 self._spawned_and_waited = True
 
-            # this lock is needed because of a race condition where a background
-            # thread, created in the OProc constructor, may try to access
-            # self.process, but it has not been assigned yet
-            process_assign_lock = threading.Lock()
+            replay = None
+            if call_args["cache_ttl"] is not None:
+                key = get_result_cache_key(cmd, call_args, stdin)
+                if key is not None:
+                    self._result_cache = get_result_cache(call_args)
+                    self._result_cache_key = key
+                    replay = self._result_cache.get(self, key)
+
+            if not replay and call_args["cache_dir"] is not None:
+                self._cache_key = get_incremental_key(cmd, call_args, stdin)
+                if self._cache_key:
+                    replay = load_incremental_record(self, self._cache_key)
+
+            if replay:
+                self.log.info("replaying recorded results")
+                self._cache_key = None
+                self._result_cache = None
+                self.process = replay
+                replay.finish()
+
+                if should_wait:
+                    self.wait()
+                return
+
+            session = call_args["session"]
+            if session is not None and session.can_run(call_args, stdin):
+                self.log.info("running in %r", session)
+                self.process = session.run(self, cmd, stdin)
+                self.process.finish()
+
+                if should_wait:
+                    self.wait()
+                return
+
+            if call_args["single_flight"]:
+                # there's no key for a _piped run, so it never leads or joins
+                # a flight.  a SharedProcess has nothing to pipe from
+                key = get_result_cache_key(cmd, call_args, stdin)
+                if key is not None:
+                    flight, leading = join_flight(self, key)
+                    if leading:
+                        self._flight = flight
+                    else:
+                        self.log.info("attaching to an identical command")
+                        self._cache_key = None
+                        self._result_cache = None
+                        self.process = SharedProcess(self, flight)
+
+                        if should_wait:
+                            self.wait()
+                        return
+
+            spawn_args = (cmd, stdin, stdout, stderr, pipe)
+            self._limiter = get_concurrency_limiter(call_args)
+            if self._limiter and call_args["bg"]:
+                self._spawned = threading.Event()
+                self.log.info("waiting for a process slot")
+                self._limiter.acquire_async(partial(self._spawn_pending,
+                    *spawn_args))
+
+            else:
+                if self._limiter:
+                    self._limiter.acquire()
+                self._spawn(*spawn_args)
+
+                if should_wait:
+                    self.wait()
+
+
+    def _spawn(self, cmd, stdin, stdout, stderr, pipe):
+        self.log.info("starting process")
+
+        # this lock is needed because of a race condition where a background
+        # thread, created in the OProc constructor, may try to access
+        # self.process, but it has not been assigned yet
+        process_assign_lock = threading.Lock()
+        try:
             with process_assign_lock:
                 self.process = OProc(self, self.log, cmd, stdin, stdout, stderr,
                         self.call_args, pipe, process_assign_lock)
+        except Exception as e:
+            if self._limiter:
+                self._limiter.release()
+            if self._flight:
+                self._flight.failed(e)
+            raise
 
-            logger_str = log_str_factory(self.ran, call_args, self.process.pid)
-            self.log.set_context(logger_str)
-            self.log.info("process started")
+        if self._flight:
+            self._flight.started.set()
+
+        log_str_factory = self.call_args["log_msg"] or default_logger_str
+        logger_str = log_str_factory(self.ran, self.call_args, self.process.pid)
+        self.log.set_context(logger_str)
+        self.log.info("process started")
 
-            if should_wait:
-                self.wait()
+
+    def _spawn_pending(self, *spawn_args):
+        """ launches a background command that had to wait for a process slot.
+        this runs in whichever thread gave up the slot, so any exception is
+        saved for .wait() to raise """
+        try:
+            self._spawn(*spawn_args)
+        except Exception as e:
+            self._spawn_exc = e
+        finally:
+            self._spawned.set()
+
+
+    def _wait_for_spawn(self):
+        """ a background command that's waiting for a process slot has no
+        process yet.  this blocks until it has one, and raises whatever kept it
+        from starting """
+        if self._spawned is not None:
+            self._spawned.wait()
+            if self._spawn_exc:
+                raise self._spawn_exc
 
 
     def wait(self):
         """ waits for the running command to finish.  this is called on all
         running commands, eventually, except for ones that run in the background
         """
+        self._wait_for_spawn()
+
         if not self._process_completed:
             self._process_completed = True
 
             exit_code = self.process.wait()
-            if self.process.timed_out:
-                # if we timed out, our exit code represents a signal, which is
-                # negative, so let's make it positive to store in our
-                # TimeoutException
-                raise TimeoutException(-exit_code)
+            try:
+                if self.process.timed_out:
+                    # if we timed out, our exit code represents a signal, which
+                    # is negative, so let's make it positive to store in our
+                    # TimeoutException
+                    raise TimeoutException(-exit_code)
 
-            else:
-                self.handle_command_exit_code(exit_code)
-        
-                # if an iterable command is using an instance of OProc for its stdin,
-                # wait on it.  the process is probably set to "piped", which means it
-                # won't be waited on, which means exceptions won't propagate up to the
-                # main thread.  this allows them to bubble up
-                if self.process._stdin_process:
-                    self.process._stdin_process.command.wait()
+                else:
+                    self.handle_command_exit_code(exit_code)
+
+                    if self._cache_key:
+                        save_incremental_record(self, self._cache_key)
+                    if self._result_cache is not None:
+                        self._result_cache.put(self._result_cache_key,
+                                self.process)
+
+                    # if an iterable command is using an instance of OProc for
+                    # its stdin, wait on it.  the process is probably set to
+                    # "piped", which means it won't be waited on, which means
+                    # exceptions won't propagate up to the main thread.  this
+                    # allows them to bubble up
+                    if self.process._stdin_process:
+                        self.process._stdin_process.command.wait()
+            finally:
+                self._compact()
 
         self.log.info("process completed")
         return self
 
 
+    def _compact(self):
+        """ lets go of everything we only needed while our process was running.
+        results are often kept around for a long time, and this way they cost
+        little more than their output """
+        self._spawned = None
+        self._limiter = None
+        self._flight = None
+        self._cache_key = None
+        self._result_cache = None
+        self._result_cache_key = None
+
+        # a piped process's output goes straight to the process it's piped to,
+        # through its OProc, so that one stays
+        if isinstance(self.process, OProc) and not self.call_args["piped"]:
+            self.process = FinishedProcess(self.process,
+                    self.call_args["freeze_output"])
+
+
     def handle_command_exit_code(self, code):
         """ here we determine if we had an exception, or an error code that we
         weren't expecting to see.  if we did, we create and raise an exception
@@ -830,6 +1229,18 @@ class RunningCommand(object):
         self.wait()
         return self.process.exit_code
 
+    @property
+    def out_sink(self):
+        """ the sink that our stdout was fed to, once we've finished, or None
+        if _out wasn't a sink """
+        self.wait()
+        return get_sink(self.call_args["out"])
+
+    @property
+    def err_sink(self):
+        self.wait()
+        return get_sink(self.call_args["err"])
+
 
     def __len__(self):
         return len(str(self))
@@ -850,6 +1261,8 @@ class RunningCommand(object):
         if self._stopped_iteration:
             raise StopIteration()
 
+        self._wait_for_spawn()
+
         # we do this because if get blocks, we can't catch a KeyboardInterrupt
         # so the slight timeout allows for that.
         while True:
@@ -888,6 +1301,9 @@ class RunningCommand(object):
     def __unicode__(self):
         """ a magic method defined for python2.  calling unicode() on a
         RunningCommand object will call this """
+        if self._spawned is not None:
+            self.wait()
+
         if self.process and self.stdout:
             return self.stdout.decode(self.call_args["encoding"],
                 self.call_args["decode_errors"])
@@ -906,6 +1322,7 @@ class RunningCommand(object):
     def __getattr__(self, p):
         # let these three attributes pass through to the OProc object
         if p in self._OProc_attr_whitelist:
+            self._wait_for_spawn()
             if self.process:
                 return getattr(self.process, p)
             else:
@@ -944,12 +1361,579 @@ class RunningCommand(object):
 
 
 
+class ReplayedProcess(object):
+    """ stands in for an OProc when a RunningCommand's results come from a
+    record of a previous run instead of a new process.  it has just enough of
+    OProc for RunningCommand to treat it like a process that has already
+    finished """
+
+    def __init__(self, command, stdout, stderr, exit_code):
+        self.command = command
+        self.call_args = command.call_args
+        self._stdout = stdout
+        self._stderr = stderr
+        self.exit_code = exit_code
+
+        self.pid = None
+        self.sid = None
+        self.pgid = None
+        self.ctty = None
+        self.timed_out = False
+        self._stdin_process = None
+
+        self._pipe_queue = Queue()
+        piped_output = stderr if self.call_args["iter"] == "err" else stdout
+        for line in piped_output.splitlines(True):
+            self._pipe_queue.put(line)
+        self._pipe_queue.put(None)
+
+    def __repr__(self):
+        return "<Replayed process %r>" % self.command.cmd[:500]
+
+    @property
+    def stdout(self):
+        return self._stdout
+
+    @property
+    def stderr(self):
+        return self._stderr
+
+    def finish(self):
+        done_callback = self.call_args["done"]
+        if done_callback:
+            success = self.exit_code in self.call_args["ok_code"]
+            done_callback(success, self.exit_code)
+
+    def wait(self):
+        return self.exit_code
+
+    def is_alive(self):
+        return False, self.exit_code
+
+
+class LRUCache(object):
+    """ a dict that holds at most `max_size` items, and drops the least
+    recently used when it's full.  it isn't thread safe, its owner should
+    hold a lock """
+
+    def __init__(self, max_size):
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1")
+
+        self.max_size = max_size
+        self.evictions = 0
+        # key -> [last used, value], where "last used" counts up with every
+        # use.  _order holds (last used, key) for every use, oldest first, so
+        # the least recently used item is the first in _order that hasn't
+        # been used again since.  (no OrderedDict on 2.6)
+        self._items = {}
+        self._order = deque()
+        self._uses = 0
+
+    def __repr__(self):
+        return "<LRUCache %d/%d>" % (len(self._items), self.max_size)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def _use(self, key, item):
+        self._uses += 1
+        item[0] = self._uses
+        self._order.append((self._uses, key))
+
+        # repeated hits on the same keys leave stale entries in _order, so
+        # every so often we rebuild it from what's actually in the cache
+        if len(self._order) > 2 * len(self._items) + 64:
+            self._order = deque(sorted((item[0], key)
+                for key, item in self._items.items()))
+
+    def get(self, key, default=None):
+        item = self._items.get(key, None)
+        if item is None:
+            return default
+        self._use(key, item)
+        return item[1]
+
+    def put(self, key, value):
+        item = [0, value]
+        self._items[key] = item
+        self._use(key, item)
+
+        while len(self._items) > self.max_size:
+            used, key = self._order.popleft()
+            item = self._items.get(key, None)
+            if item is not None and item[0] == used:
+                del self._items[key]
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        item = self._items.pop(key, None)
+        if item is None:
+            return default
+        return item[1]
+
+    def clear(self):
+        self._items.clear()
+        self._order.clear()
+
+
+class ResultCache(object):
+    """ remembers the output and exit code of successful commands for `ttl`
+    seconds, so that running the same command again within that time replays
+    them instead of launching another process.  this is meant for read-only
+    commands that get called over and over, like `git rev-parse HEAD`.  at
+    most `max_size` results are kept, and the least recently used are dropped
+    first """
+
+    def __init__(self, ttl, max_size=1024):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # key -> (expires at, stdout, stderr, exit code)
+        self._results = LRUCache(max_size)
+
+        self._hits = 0
+        self._misses = 0
+
+    def __repr__(self):
+        return "<ResultCache ttl=%r, %d/%d>" % (self.ttl, len(self._results),
+                self.max_size)
+
+    def __len__(self):
+        return len(self._results)
+
+    @property
+    def max_size(self):
+        return self._results.max_size
+
+    def get(self, command, key):
+        """ returns a ReplayedProcess for `command` if we have a fresh result
+        for `key` """
+        with self._lock:
+            result = self._results.get(key)
+            if result is not None and result[0] <= time.time():
+                self._results.pop(key)
+                result = None
+
+            if result is None:
+                self._misses += 1
+                return None
+            self._hits += 1
+
+        return ReplayedProcess(command, *result[1:])
+
+    def put(self, key, process):
+        result = (time.time() + self.ttl, process.stdout, process.stderr,
+                process.exit_code)
+        with self._lock:
+            self._results.put(key, result)
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._results),
+                "max_size": self._results.max_size,
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._results.evictions,
+            }
+
+
+# ResultCaches for commands that pass a number for _cache_ttl at call time,
+# instead of baking it in.  keyed on (ttl, max size)
+_result_caches = {}
+_result_caches_lock = threading.Lock()
+
+
+def get_result_cache(call_args):
+    cache = call_args["cache_ttl"]
+    if isinstance(cache, ResultCache):
+        return cache
+
+    cache_key = (cache, call_args["cache_size"])
+    with _result_caches_lock:
+        found = _result_caches.get(cache_key, None)
+        if found is None:
+            found = ResultCache(cache, call_args["cache_size"])
+            _result_caches[cache_key] = found
+    return found
+
+
+def get_result_cache_key(cmd, call_args, stdin):
+    """ the key a run of `cmd` is cached under in a ResultCache, or None if it
+    can't be cached.  runs whose stdin isn't a string or bytes, or whose
+    output is redirected elsewhere, can't be.  neither can a _piped run, since
+    whatever it's piped into reads straight from its live process """
+    if stdin is not None and not isinstance(stdin, (basestring, bytes)):
+        return None
+    if call_args["out"] is not None or call_args["err"] is not None:
+        return None
+    if call_args["piped"]:
+        return None
+
+    env = call_args["env"]
+    if env is None:
+        env = os.environ
+
+    if stdin is not None:
+        stdin = encode_to_py3bytes_or_py2str(stdin)
+
+    # these change what a command outputs, or how it's kept, so they're part
+    # of the key too
+    options = get_output_shape(call_args) + (call_args["out_compress"],
+            call_args["err_compress"])
+
+    return (tuple(cmd), tuple(sorted(env.items())),
+            call_args["cwd"] or os.getcwd(), stdin, options)
+
+
+class Flight(object):
+    """ an in-flight _single_flight command that identical commands started
+    while it runs can attach to, instead of launching their own process """
+
+    def __init__(self, key, leader):
+        self.key = key
+        self.leader = leader
+        self.started = threading.Event()
+        self.exc = None
+        # the _done callbacks of the commands attached to us, and the ok_codes
+        # they judge success by
+        self.followers = []
+
+    def failed(self, exc):
+        """ the leader couldn't be launched """
+        self.exc = exc
+        leave_flight(self)
+        self.started.set()
+
+    def done(self, leader_done, success, exit_code):
+        followers = leave_flight(self)
+        try:
+            if leader_done:
+                leader_done(success, exit_code)
+        finally:
+            for done_callback, ok_code in followers:
+                done_callback(exit_code in ok_code, exit_code)
+
+
+# the Flights of _single_flight commands, by their result cache key
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def join_flight(command, key):
+    """ returns (flight, leading).  if an identical command is running,
+    `command` attaches to its flight, otherwise `command` leads a new one """
+    call_args = command.call_args
+    with _flights_lock:
+        flight = _flights.get(key, None)
+        if flight is not None:
+            if call_args["done"]:
+                flight.followers.append((call_args["done"],
+                    call_args["ok_code"]))
+            return flight, False
+
+        flight = Flight(key, command)
+        call_args["done"] = partial(flight.done, call_args["done"])
+        _flights[key] = flight
+        return flight, True
+
+
+def leave_flight(flight):
+    """ stops new commands from attaching to `flight`, and returns the done
+    callbacks of those that did """
+    with _flights_lock:
+        if _flights.get(flight.key, None) is flight:
+            del _flights[flight.key]
+        followers = flight.followers
+        flight.followers = []
+    return followers
+
+
+class SharedProcess(object):
+    """ stands in for an OProc when a _single_flight command attaches to an
+    identical command that's already running.  the output and exit code are
+    the other command's, but the exit code is judged by our own ok_code """
+
+    def __init__(self, command, flight):
+        self.command = command
+        self.call_args = command.call_args
+        self._flight = flight
+        self._stdin_process = None
+        self._replay = None
+
+    def __repr__(self):
+        return "<Shared process %r>" % self.command.cmd[:500]
+
+    def _process(self):
+        self._flight.started.wait()
+        if self._flight.exc:
+            raise self._flight.exc
+        return self._flight.leader.process
+
+    @property
+    def _pipe_queue(self):
+        # the leader's pipe queue is the leader's to read, so once the process
+        # is done, we replay our own copy of its output
+        if self._replay is None:
+            process = self._process()
+            process.wait()
+            self._replay = ReplayedProcess(self.command, process.stdout,
+                    process.stderr, process.exit_code)
+        return self._replay._pipe_queue
+
+    @property
+    def pid(self):
+        return self._process().pid
+
+    @property
+    def stdout(self):
+        return self._process().stdout
+
+    @property
+    def stderr(self):
+        return self._process().stderr
+
+    @property
+    def exit_code(self):
+        return self._process().exit_code
+
+    @property
+    def timed_out(self):
+        return self._process().timed_out
+
+    def wait(self):
+        return self._process().wait()
+
+    def is_alive(self):
+        return self._process().is_alive()
+
+
+def _resolve_cmd_path(call_args, path):
+    return os.path.join(call_args["cwd"] or os.getcwd(), path)
+
+
+def get_output_shape(call_args):
+    """ the special kwargs that change what a command's output looks like once
+    we have it, as a tuple.  output recorded or cached with one shape can't
+    stand in for output with another """
+    shape = [call_args["tty_out"], tuple(call_args["tty_size"]),
+            call_args["err_to_out"], call_args["uid"], call_args["no_out"],
+            call_args["no_err"]]
+
+    for std in ("out", "err"):
+        keep = call_args[std + "_keep"]
+        if keep is not None:
+            keep = parse_keep_policy(keep)
+        filt = call_args[std + "_filter"]
+        if hasattr(filt, "pattern"):
+            filt = (filt.pattern, filt.flags)
+        shape.extend((keep, filt))
+
+    return tuple(shape)
+
+
+def get_incremental_key(cmd, call_args, stdin):
+    """ computes the key that a run of `cmd` is recorded under in a _cache_dir.
+    returns None if the run can't be recorded, which is the case if its stdin
+    is anything other than a string or bytes, if its output is redirected
+    elsewhere, if it's filtered by a function, or if it's _piped.  only an
+    explicit _env is part of the key, not the environment that the process
+    would otherwise inherit """
+
+    if stdin is not None and not isinstance(stdin, (basestring, bytes)):
+        return None
+    # a replay only has the output to give back, not whatever a callback or a
+    # file would have done with it, or a live process to pipe from
+    if call_args["out"] is not None or call_args["err"] is not None:
+        return None
+    if call_args["piped"]:
+        return None
+
+    shape = get_output_shape(call_args)
+    if any(callable(option) for option in shape):
+        return None
+
+    import hashlib
+
+    encode = encode_to_py3bytes_or_py2str
+    key = hashlib.sha256()
+
+    def add(*parts):
+        for part in parts:
+            part = encode(part)
+            key.update(encode(len(part)) + b":" + part)
+
+    add("argv", len(cmd), *cmd)
+
+    env = call_args["env"]
+    if env is not None:
+        add("env", len(env))
+        for k in sorted(env.keys()):
+            add(k, env[k])
+
+    add("cwd", call_args["cwd"] or os.getcwd())
+    add("shape", repr(shape))
+
+    if stdin is not None:
+        add("stdin", stdin)
+
+    for path in call_args["outputs"] or ():
+        add("output", path)
+
+    by_content = call_args["inputs_check"] == "content"
+    for path in call_args["inputs"] or ():
+        add("input", path)
+        full_path = _resolve_cmd_path(call_args, path)
+        try:
+            st = os.stat(full_path)
+        except OSError:
+            add("missing")
+            continue
+
+        if not by_content:
+            add(st.st_size, repr(st.st_mtime))
+
+        elif stat.S_ISDIR(st.st_mode):
+            # everything under the directory, by its path within it
+            for root, dirs, files in os.walk(full_path):
+                dirs.sort()
+                rel_root = os.path.relpath(root, full_path)
+                for name in dirs:
+                    add("dir", os.path.join(rel_root, name))
+                for name in sorted(files):
+                    add("file", os.path.join(rel_root, name))
+                    hash_file_content(key, os.path.join(root, name))
+
+        else:
+            hash_file_content(key, full_path)
+
+    return key.hexdigest()
+
+
+def hash_file_content(key, path):
+    try:
+        h = open(path, "rb")
+    except (IOError, OSError):
+        key.update(b"missing")
+        return
+
+    with h:
+        while True:
+            chunk = h.read(64 * 1024)
+            if not chunk:
+                break
+            key.update(chunk)
+
+
+def _copy_path(src, dst):
+    import shutil
+    if os.path.isdir(src):
+        if os.path.isdir(dst):
+            shutil.rmtree(dst)
+        shutil.copytree(src, dst)
+    else:
+        shutil.copy2(src, dst)
+
+
+def load_incremental_record(command, key):
+    """ if there's a record of a successful run under `key`, restores the
+    outputs of that run and returns a ReplayedProcess for it """
+    call_args = command.call_args
+    record_dir = os.path.join(call_args["cache_dir"], key)
+
+    try:
+        with open(os.path.join(record_dir, "exit_code"), "rb") as h:
+            exit_code = int(h.read())
+        with open(os.path.join(record_dir, "stdout"), "rb") as h:
+            stdout = h.read()
+        with open(os.path.join(record_dir, "stderr"), "rb") as h:
+            stderr = h.read()
+    except (IOError, OSError, ValueError):
+        return None
+
+    for i, path in enumerate(call_args["outputs"] or ()):
+        saved = os.path.join(record_dir, "outputs", str(i))
+        if not os.path.exists(saved):
+            return None
+        _copy_path(saved, _resolve_cmd_path(call_args, path))
+
+    return ReplayedProcess(command, stdout, stderr, exit_code)
+
+
+def save_incremental_record(command, key):
+    """ records the results of a finished, successful run under `key`, so that
+    it can be replayed later """
+    import shutil
+    import tempfile
+
+    call_args = command.call_args
+    cache_dir = call_args["cache_dir"]
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    # build the record off to the side and rename it into place, so a record
+    # that's visible is always complete
+    tmp_dir = tempfile.mkdtemp(prefix=".tmp-", dir=cache_dir)
+    try:
+        outputs_dir = os.path.join(tmp_dir, "outputs")
+        os.mkdir(outputs_dir)
+        for i, path in enumerate(call_args["outputs"] or ()):
+            full_path = _resolve_cmd_path(call_args, path)
+            if not os.path.exists(full_path):
+                command.log.info("not recording, output %r is missing", path)
+                return
+            _copy_path(full_path, os.path.join(outputs_dir, str(i)))
+
+        process = command.process
+        with open(os.path.join(tmp_dir, "stdout"), "wb") as h:
+            h.write(process.stdout)
+        with open(os.path.join(tmp_dir, "stderr"), "wb") as h:
+            h.write(process.stderr)
+        with open(os.path.join(tmp_dir, "exit_code"), "wb") as h:
+            h.write(str(process.exit_code).encode())
+
+        try:
+            os.rename(tmp_dir, os.path.join(cache_dir, key))
+        except OSError:
+            # somebody else recorded the same thing first
+            pass
+    finally:
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+
+
 def output_redirect_is_filename(out):
     return isinstance(out, basestring)
 
 
+def open_output_redirect(out):
+    """ opens the files that an _out or _err redirects to by name, including
+    those in a list of handlers """
+    if output_redirect_is_filename(out):
+        return open(str(out), "wb")
+    if isinstance(out, (list, tuple)):
+        return [open_output_redirect(handler) for handler in out]
+    return out
+
+
+def output_handlers(out):
+    """ everything that an _out or _err sends output to, as a list """
+    if isinstance(out, (list, tuple)):
+        return list(out)
+    if out is None:
+        return []
+    return [out]
+
+
 def get_prepend_stack():
-    tl = Command.thread_local
+    tl = Command._thread_local
     if not hasattr(tl, "_prepend_stack"):
         tl._prepend_stack = []
     return tl._prepend_stack
@@ -975,6 +1959,83 @@ def special_kwarg_validator(kwargs, invalid_list):
     return invalid_args
 
 
+# the results of running Command._kwarg_validators, keyed on the names of the
+# special kwargs and the values of the few that the validators look at (the
+# rest only matter by whether they were given).  some validators make syscalls
+# on the values (is this a tty?  a pipe?), and the same combinations show up
+# over and over, for example from an execution context like
+# `sh2 = sh(_out=f)`, which bakes its args into every command it looks up.
+# we only cache plain values, so that an entry never keeps a big _in string,
+# an open file or a callback alive.  a stdin, stdout or stderr is keyed on
+# whatever its fd points to, not on the fd or the object, since an fd number
+# can be reused for something else entirely
+_call_args_validation_cache = {}
+_CALL_ARGS_VALIDATION_CACHE_SIZE = 512
+
+_validated_call_args = ("in", "out", "err", "in_bufsize", "out_bufsize",
+        "err_bufsize", "out_keep", "err_keep", "out_filter", "err_filter",
+        "out_compress", "err_compress")
+
+
+def get_validation_cache_key(call_args):
+    """ the key that the validation of call_args is cached under, or None if
+    it shouldn't be cached """
+    values = []
+    for k in _validated_call_args:
+        if k not in call_args:
+            continue
+        v = call_args[k]
+        if k in ("in", "out", "err"):
+            v = get_validation_fd_key(v)
+            if v is False:
+                return None
+        elif not is_plain_value(v):
+            return None
+        values.append(v)
+
+    return (tuple(sorted(call_args.keys())), tuple(values))
+
+
+def get_validation_fd_key(ob):
+    """ all that the validators see of a stdin, stdout or stderr is whether
+    its fd is a tty or a pipe, so this is what its fd points to, or None if it
+    doesn't have one.  False if we can't tell """
+    fileno = get_fileno(ob)
+    # the same test that ob_is_tty and ob_is_pipe make
+    if not fileno:
+        return None
+    try:
+        fd_stat = os.fstat(fileno)
+    except OSError:
+        return False
+    return (fd_stat.st_dev, fd_stat.st_ino, fd_stat.st_mode)
+
+
+def is_plain_value(v):
+    if isinstance(v, tuple):
+        return all(is_plain_value(item) for item in v)
+    return v is None or isinstance(v, (bool, int, long, float, basestring,
+        bytes))
+
+
+def get_invalid_call_args(call_args):
+    cache_key = get_validation_cache_key(call_args)
+    if cache_key is None:
+        return special_kwarg_validator(call_args, Command._kwarg_validators)
+
+    try:
+        return _call_args_validation_cache[cache_key]
+    except KeyError:
+        pass
+
+    invalid = special_kwarg_validator(call_args, Command._kwarg_validators)
+
+    if len(_call_args_validation_cache) >= _CALL_ARGS_VALIDATION_CACHE_SIZE:
+        _call_args_validation_cache.clear()
+    _call_args_validation_cache[cache_key] = invalid
+    return invalid
+
+
 def get_fileno(ob):
     # in py2, this will return None.  in py3, it will return an method that
     # raises when called
@@ -1050,6 +2111,48 @@ def bufsize_validator(kwargs):
 
     return invalid
 
+def keep_validator(kwargs):
+    invalid = []
+    for name in ("out_keep", "err_keep"):
+        keep = kwargs.get(name, None)
+        if keep is None:
+            continue
+        try:
+            parse_keep_policy(keep)
+        except (TypeError, ValueError) as e:
+            invalid.append(((name,), "`_%s` %s" % (name, e)))
+    return invalid
+
+def compress_validator(kwargs):
+    invalid = []
+    for name in ("out_compress", "err_compress"):
+        level = kwargs.get(name, None)
+        if level is None or level is False or level is True:
+            continue
+        if not isinstance(level, (int, long)) or not 1 <= level <= 9:
+            invalid.append(((name,), "`_%s` must be True or a zlib level, \
+1 to 9" % name))
+    return invalid
+
+def filter_validator(kwargs):
+    invalid = []
+    for std in ("out", "err"):
+        name = std + "_filter"
+        filt = kwargs.get(name, None)
+        if filt is None:
+            continue
+
+        if not callable(filt) and not hasattr(filt, "search") \
+                and not isinstance(filt, (basestring, bytes)):
+            invalid.append(((name,), "`_%s` must be a regex or a function" %
+                name))
+
+        bufsize = std + "_bufsize"
+        if kwargs.get(bufsize, 1) != 1:
+            invalid.append(((name, bufsize), "Can only filter line buffered \
+output"))
+    return invalid
+
 
 class Command(object):
     """ represents an un-run system program, like "ls" or "cd".  because it
@@ -1060,7 +2163,7 @@ class Command(object):
     when a Command object is called, the result that is returned is a
     RunningCommand object, which represents the Command put into an execution
     state. """
-    thread_local = threading.local()
+    _thread_local = threading.local()
 
     _call_args = {
         "fg": False, # run command in foreground
@@ -1075,8 +2178,10 @@ class Command(object):
 
         "with": False, # prepend the command to every command after it
         "in": None,
-        "out": None, # redirect STDOUT
-        "err": None, # redirect STDERR
+        # redirect STDOUT/STDERR.  a list or tuple sends the output to
+        # everything in it
+        "out": None,
+        "err": None,
         "err_to_out": None, # redirect STDERR to STDOUT
 
         # stdin buffer size
@@ -1097,6 +2202,31 @@ class Command(object):
         # be "internal_bufsize" CHUNKS of 1024 bytes
         "internal_bufsize": 3 * 1024 ** 2,
 
+        # instead of everything, only keep the first and/or last so many bytes
+        # of stdout or stderr, for example ("head", 64000, "tail", 64000).  the
+        # kept output has a marker where the rest was dropped.  unless the
+        # command is iterated over, its pipe only gets what was kept, when the
+        # output ends
+        "out_keep": None,
+        "err_keep": None,
+
+        # only let through the lines of stdout or stderr that match a regex
+        # (compiled, or a pattern string), or that a function of the line's
+        # bytes returns true for.  the rest are dropped before they're kept,
+        # piped or sent to a callback.  the output must be line buffered
+        "out_filter": None,
+        "err_filter": None,
+
+        # keep stdout or stderr zlib-compressed, at this level (True is 1, the
+        # fastest), and only decompress it when it's asked for.  the
+        # compressing happens on a thread of its own
+        "out_compress": None,
+        "err_compress": None,
+
+        # once the command finishes, join its output into one bytes object,
+        # instead of keeping the chunks it was read in
+        "freeze_output": False,
+
         "env": None,
         "piped": None,
         "iter": None,
@@ -1143,6 +2273,34 @@ class Command(object):
         # will be called when a process terminates regardless of exception
         "done": None,
 
+        # opt-in incremental execution.  if cache_dir is set, a successful run
+        # is recorded there, keyed on the command's arguments, env, cwd, stdin,
+        # and the files in "inputs".  running the same thing again with
+        # unchanged inputs restores the files in "outputs" and replays the
+        # recorded stdout, stderr and exit code instead of launching a process.
+        # "inputs_check" is "content" to hash the inputs' contents, or "mtime"
+        # to only look at their sizes and modification times
+        "cache_dir": None,
+        "inputs": None,
+        "outputs": None,
+        "inputs_check": "content",
+
+        # cache successful results in memory for this many seconds, and replay
+        # them for identical runs instead of launching another process.  this
+        # may also be a ResultCache, to share one between commands.  at most
+        # "cache_size" results are kept
+        "cache_ttl": None,
+        "cache_size": 1024,
+
+        # a Session to run the command through, instead of launching it
+        # ourselves
+        "session": None,
+
+        # if an identical command (same arguments, env, cwd and stdin) is
+        # already running when this one starts, attach to it and share its
+        # output and exit code, instead of launching another process
+        "single_flight": False,
+
         # a tuple (rows, columns) of the desired size of both the stdout and
         # stdin ttys, if ttys are being used
         "tty_size": (20, 80),
@@ -1167,6 +2325,12 @@ class Command(object):
         # a callable that produces a log message from an argument tuple of the
         # command and the args
         "log_msg": None,
+
+        # the most processes that may be running at once, or a
+        # ConcurrencyLimiter shared by several commands.  commands over the
+        # limit wait for a free slot.  None means use the process-wide limit
+        # from set_max_concurrency(), if there is one
+        "max_concurrent": None,
     }
 
     # this is a collection of validators to make sure the special kwargs make
@@ -1174,6 +2338,9 @@ class Command(object):
     _kwarg_validators = (
         (("fg", "bg"), "Command can't be run in the foreground and background"),
         (("fg", "err_to_out"), "Can't redirect STDERR in foreground mode"),
+        (("fg", "cache_dir"), "Can't record results in foreground mode"),
+        (("fg", "cache_ttl"), "Can't cache results in foreground mode"),
+        (("fg", "single_flight"), "Can't share processes in foreground mode"),
         (("err", "err_to_out"), "Stderr is already being redirected"),
         (("piped", "iter"), "You cannot iterate when this command is being piped"),
         (("piped", "no_pipe"), "Using a pipe doesn't make sense if you've \
@@ -1182,6 +2349,13 @@ disabled the pipe"),
 output"),
         tty_in_validator,
         bufsize_validator,
+        (("out_keep", "out_compress"), "Can't compress output that's only \
+partly kept"),
+        (("err_keep", "err_compress"), "Can't compress output that's only \
+partly kept"),
+        keep_validator,
+        filter_validator,
+        compress_validator,
     )
 
 
@@ -1195,6 +2369,11 @@ output"),
         self._partial_baked_args = []
         self._partial_call_args = {}
 
+        # subcommands (like `git.log`) that have been baked from us.  since a
+        # Command never changes after it's created, we can hand back the same
+        # subcommand every time it's asked for
+        self._subcommands = {}
+
         # bugfix for functools.wraps.  issue #121
         self.__name__ = str(self)
 
@@ -1210,27 +2389,28 @@ output"),
         self.__name__ = str(self)
 
 
-    def __getattribute__(self, name):
-        # convenience
-        getattr = partial(object.__getattribute__, self)
-        val = None
-
+    def __getattr__(self, name):
+        """ only called for attributes that don't exist on the instance or the
+        class, so our own internal attributes never pay for this lookup.
+        anything left over that isn't private is treated as a subcommand """
         if name.startswith("_"):
-            val = getattr(name)
+            raise AttributeError(name)
 
-        elif name == "bake":
-            val = getattr("bake")
-
-        # here we have a way of getting past shadowed subcommands.  for example,
+        try:
+            return self._subcommands[name]
+        except KeyError:
+            pass
+
+        # here we have a way of getting past shadowed subcommands.  for example,
         # if "git bake" was a thing, we wouldn't be able to do `git.bake()`
         # because `.bake()` is already a method.  so we allow `git.bake_()`
-        elif name.endswith("_"):
-            name = name[:-1]
-
-        if val is None:
-            val = getattr("bake")(name)
+        subcommand = name
+        if subcommand.endswith("_"):
+            subcommand = subcommand[:-1]
 
-        return val
+        cmd = self.bake(subcommand)
+        self._subcommands[name] = cmd
+        return cmd
 
 
     @staticmethod
@@ -1241,15 +2421,15 @@ output"),
 
         kwargs = kwargs.copy()
         call_args = {}
-        for parg, default in Command._call_args.items():
-            key = "_" + parg
+        # there are usually far fewer kwargs than there are special kwargs, so
+        # it's the kwargs that we loop over
+        for key in list(kwargs.keys()):
+            if key.startswith("_"):
+                parg = key[1:]
+                if parg in Command._call_args:
+                    call_args[parg] = kwargs.pop(key)
 
-            if key in kwargs:
-                call_args[parg] = kwargs[key]
-                del kwargs[key]
-
-        invalid_kwargs = special_kwarg_validator(call_args,
-                Command._kwarg_validators)
+        invalid_kwargs = get_invalid_call_args(call_args)
 
         if invalid_kwargs:
             exc_msg = []
@@ -1263,18 +2443,35 @@ output"),
 
     # TODO needs documentation
     def bake(self, *args, **kwargs):
-        fn = type(self)(self._path)
+        # our path has already been resolved, so we skip __init__ and avoid
+        # searching for it all over again
+        fn = object.__new__(type(self))
+        fn._path = self._path
         fn._partial = True
+        fn._partial_baked_args = []
+        fn._partial_call_args = {}
+        fn._subcommands = {}
 
         call_args, kwargs = self._extract_call_args(kwargs)
 
         pruned_call_args = call_args
-        for k, v in Command._call_args.items():
-            try:
-                if pruned_call_args[k] == v:
-                    del pruned_call_args[k]
-            except KeyError:
-                continue
+        for k in list(pruned_call_args.keys()):
+            if pruned_call_args[k] == Command._call_args[k]:
+                del pruned_call_args[k]
+
+        # everything baked from us should share one limit
+        max_concurrent = pruned_call_args.get("max_concurrent", None)
+        if max_concurrent is not None:
+            pruned_call_args["max_concurrent"] = \
+                    get_concurrency_limiter(pruned_call_args)
+
+        # and one cache of results
+        cache_ttl = pruned_call_args.get("cache_ttl", None)
+        if cache_ttl is not None and not isinstance(cache_ttl, ResultCache):
+            cache_size = pruned_call_args.get("cache_size",
+                    self._partial_call_args.get("cache_size",
+                    Command._call_args["cache_size"]))
+            pruned_call_args["cache_ttl"] = ResultCache(cache_ttl, cache_size)
 
         fn._partial_call_args.update(self._partial_call_args)
         fn._partial_call_args.update(pruned_call_args)
@@ -1283,8 +2480,148 @@ output"),
         prefix = pruned_call_args.get("long_prefix",
                 self._call_args["long_prefix"])
         fn._partial_baked_args.extend(compile_args(args, kwargs, sep, prefix))
+        fn.__name__ = str(fn)
         return fn
 
+
+    def _compile(self, *args, **kwargs):
+        """ returns a CompiledCommand, which is this command called with these
+        arguments, frozen so that it can be launched over and over with the
+        least possible overhead.  use ARG for any positional argument that
+        should be supplied each time the CompiledCommand is called.  it's
+        underscored, like the special keyword arguments, so that `cmd.compile`
+        is still the "compile" subcommand """
+
+        args = list(args)
+        preprocessor = self._partial_call_args.get("arg_preprocess", None)
+        if preprocessor:
+            args, kwargs = preprocessor(args, kwargs)
+
+        extracted_call_args, kwargs = self._extract_call_args(kwargs)
+
+        own_call_args = self._partial_call_args.copy()
+        own_call_args.update(extracted_call_args)
+
+        call_args = Command._call_args.copy()
+        call_args.update(own_call_args)
+        normalize_ok_code(call_args)
+
+        sep = call_args["long_sep"]
+        prefix = call_args["long_prefix"]
+
+        argv = [self._path] + self._partial_baked_args
+        slots = []
+        for arg in args:
+            if arg is ARG:
+                slots.append(len(argv))
+                argv.append(None)
+            else:
+                argv.extend(compile_args([arg], {}, sep, prefix))
+        argv.extend(compile_args([], kwargs, sep, prefix))
+
+        return CompiledCommand(argv, slots, call_args, own_call_args,
+                call_args["in"])
+
+
+    def _map(self, iterable, *args, **kwargs):
+        """ runs this command once for every item in `iterable`, with the item
+        as its last argument(s), keeping at most `workers` processes alive at a
+        time, or one per cpu if it isn't given.  it returns a generator of
+        (item, result) pairs, produced as the processes finish, or in the order
+        of `iterable` if `ordered` is True.  result is the finished
+        RunningCommand, or, if that item failed, the exception (like
+        ErrorReturnCode) that it would have raised.  a failing item doesn't
+        stop the others:
+
+            for path, res in sh.gzip._map(paths, "-t", workers=8):
+                if isinstance(res, sh.ErrorReturnCode):
+                    print("corrupt: " + path)
+
+        `workers` and `ordered` can only be given by keyword.  any other args
+        and kwargs are used for every item, before it.  items are pulled
+        from `iterable` only as they're needed, and each process is collected
+        by its _done callback, so nothing waits on the items still pending.
+        the arguments are checked right away, not when the first result is
+        asked for """
+
+        workers = kwargs.pop("workers", None)
+        ordered = kwargs.pop("ordered", True)
+        if workers is None:
+            workers = get_num_cpus()
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+
+        finished = Queue()
+        user_done = kwargs.pop("_done", self._partial_call_args.get("done"))
+
+        def done(cmd, success, exit_code):
+            try:
+                if user_done:
+                    user_done(cmd, success, exit_code)
+            finally:
+                finished.put(cmd)
+
+        # we're collecting every exception ourselves
+        kwargs.setdefault("_bg_exc", False)
+        compiled = self._compile(*args, _bg=True, _done=done, **kwargs)
+
+        return map_results(compiled, iter(iterable), workers, ordered,
+                finished)
+
+
+    def _xargs(self, iterable, *args, **kwargs):
+        """ runs this command with every argument from `iterable`, like
+        xargs(1): the arguments are packed into as few invocations as will fit
+        under the system's limit on argument size (ARG_MAX, minus what the
+        environment uses), so that we neither fail with E2BIG nor launch one
+        process per argument:
+
+            sh.rm._xargs(huge_list_of_paths, f=True)
+
+        an item of `iterable` that is a list or tuple is kept together in one
+        invocation.  `max_args` caps the number of arguments per invocation,
+        and up to `max_procs` invocations, one by default, run at the same
+        time.  those two can only be given by keyword.  any other args and
+        kwargs are used for every invocation, before its arguments from
+        `iterable`.
+
+        every batch runs to completion, and then, if any of them failed, the
+        exception of the first failed batch is raised.  otherwise, the list of
+        finished RunningCommands is returned """
+
+        max_procs = kwargs.pop("max_procs", 1)
+        max_args = kwargs.pop("max_args", None)
+
+        compiled = self._compile(*args, **kwargs)
+        env = compiled._call_args["env"]
+        if env is None:
+            env = os.environ
+
+        limit = get_exec_arg_limit(env)
+        base_size = sum([get_exec_arg_size(arg) for arg in compiled._argv])
+        call_args = compiled._call_args
+
+        def args_to_pack():
+            for arg in iterable:
+                yield compile_args([arg], {}, call_args["long_sep"],
+                        call_args["long_prefix"])
+
+        batches = pack_exec_args(args_to_pack(), limit - base_size, max_args)
+
+        results = []
+        first_exc = None
+        for batch, result in self._map(batches, *args, workers=max_procs,
+                **kwargs):
+            if isinstance(result, Exception):
+                if first_exc is None:
+                    first_exc = result
+            else:
+                results.append(result)
+
+        if first_exc is not None:
+            raise first_exc
+        return results
+
     def __str__(self):
         """ in python3, should return unicode.  in python2, should return a
         string of bytes """
@@ -1359,22 +2696,14 @@ output"),
         call_args.update(extracted_call_args)
 
 
-        # handle a None.  this is added back only to not break the api in the
-        # 1.* version.  TODO remove this in 2.0, as "ok_code", if specified,
-        # should always be a definitive value or list of values, and None is
-        # ambiguous
-        if call_args["ok_code"] is None:
-            call_args["ok_code"] = 0
-
-        if not getattr(call_args["ok_code"], "__iter__", None):
-            call_args["ok_code"] = [call_args["ok_code"]]
-
+        normalize_ok_code(call_args)
 
         # check if we're piping via composition
         stdin = call_args["in"]
         if args:
             first_arg = args.pop(0)
             if isinstance(first_arg, RunningCommand):
+                first_arg._wait_for_spawn()
                 if first_arg.call_args["piped"]:
                     stdin = first_arg.process
                 else:
@@ -1393,38 +2722,902 @@ output"),
 
         cmd.extend(final_args)
 
-        # if we're running in foreground mode, we need to completely bypass
-        # launching a RunningCommand and OProc and just do a spawn
-        if call_args["fg"]:
-            if call_args["env"] is None:
-                launch = lambda: os.spawnv(os.P_WAIT, cmd[0], cmd)
+        return launch_command(cmd, call_args, stdin)
+
+
+class Placeholder(object):
+    """ marks a positional argument of Command._compile() that will be filled
+    in each time the CompiledCommand is called """
+    def __repr__(self):
+        return "ARG"
+
+ARG = Placeholder()
+
+
+class CompiledCommand(object):
+    """ a frozen invocation of a Command, produced by Command._compile().  all
+    of the work that Command.__call__ normally does on every call (merging and
+    validating the special keyword arguments, encoding the arguments) is done
+    once, up front.  calling a CompiledCommand only fills in the arguments
+    that were left as ARG placeholders, appends any extra arguments, and
+    launches the process:
+
+        convert = sh.convert._compile(sh.ARG, "-resize", "50%", sh.ARG)
+        for src, dst in pairs:
+            convert(src, dst)
+
+    special keyword arguments can't be changed once compiled.  compile another
+    CompiledCommand if you need different ones """
+
+    __slots__ = ("_argv", "_slots", "_call_args", "_own_call_args", "_stdin",
+            "__weakref__")
+
+    def __init__(self, argv, slots, call_args, own_call_args, stdin):
+        self._argv = tuple(argv)
+        self._slots = tuple(slots)
+        self._call_args = call_args
+        self._own_call_args = own_call_args
+        self._stdin = stdin
+
+    def __repr__(self):
+        args = list(self._argv)
+        for idx in self._slots:
+            args[idx] = repr(ARG).encode()
+        return "<CompiledCommand %r>" % \
+                b" ".join(args).decode(DEFAULT_ENCODING, "replace")
+
+    def __call__(self, *args, **kwargs):
+        num_slots = len(self._slots)
+        if len(args) < num_slots:
+            raise TypeError("CompiledCommand takes at least %d positional \
+arguments (%d given)" % (num_slots, len(args)))
+
+        cmd = list(self._argv)
+        encode = encode_to_py3bytes_or_py2str
+        for idx, arg in zip(self._slots, args):
+            cmd[idx] = encode(arg)
+
+        call_args = self._call_args
+        extra_args = args[num_slots:]
+        if extra_args or kwargs:
+            for k in kwargs:
+                if k.startswith("_") and k[1:] in Command._call_args:
+                    raise TypeError("Special keyword argument %r can't be \
+changed on a CompiledCommand" % k)
+            cmd.extend(compile_args(extra_args, kwargs,
+                call_args["long_sep"], call_args["long_prefix"]))
+
+        # with-contexts are resolved at call time, same as Command.__call__
+        prepend_stack = get_prepend_stack()
+        if prepend_stack:
+            call_args = Command._call_args.copy()
+            prepend_cmd = []
+            for prepend in prepend_stack:
+                pcall_args = prepend.call_args.copy()
+                pcall_args.pop("with", None)
+                call_args.update(pcall_args)
+                prepend_cmd.extend(prepend.cmd)
+            call_args.update(self._own_call_args)
+            normalize_ok_code(call_args)
+            cmd = prepend_cmd + cmd
+        else:
+            # RunningCommand and OProc modify their call_args, so every
+            # invocation needs its own copy
+            call_args = call_args.copy()
+
+        return launch_command(cmd, call_args, self._stdin)
+
+
+# the headroom that POSIX recommends xargs(1) leaves below ARG_MAX
+EXEC_ARG_HEADROOM = 2048
+POINTER_SIZE = struct.calcsize("P")
+
+
+def get_exec_arg_size(arg):
+    """ how much of ARG_MAX an encoded argument or environment entry uses up:
+    its bytes, its null terminator, and its pointer in argv or envp """
+    return len(arg) + 1 + POINTER_SIZE
+
+
+def get_exec_arg_limit(env):
+    """ the number of bytes available to the arguments of a process exec'd with
+    the environment `env` """
+    try:
+        arg_max = os.sysconf("SC_ARG_MAX")
+    except (AttributeError, ValueError, OSError):
+        arg_max = -1
+    # the posix minimum for ARG_MAX is 4096, but every system we support allows
+    # much more than that
+    if arg_max <= 0:
+        arg_max = 128 * 1024
+
+    encode = encode_to_py3bytes_or_py2str
+    env_size = 0
+    for k, v in env.items():
+        env_size += get_exec_arg_size(encode(k) + b"=" + encode(v))
+
+    return arg_max - env_size - EXEC_ARG_HEADROOM
+
+
+def pack_exec_args(arg_groups, limit, max_args=None):
+    """ takes an iterable of lists of encoded arguments and packs the lists into
+    batches whose size, as measured by get_exec_arg_size, stays under limit.
+    a list is never split across batches.  a single list that exceeds limit
+    by itself gets a batch of its own, and exec will tell us about it """
+    batch = []
+    size = 0
+    for group in arg_groups:
+        group_size = sum([get_exec_arg_size(arg) for arg in group])
+        too_big = size + group_size > limit
+        too_many = max_args and len(batch) + len(group) > max_args
+        if batch and (too_big or too_many):
+            yield batch
+            batch = []
+            size = 0
+
+        batch.extend(group)
+        size += group_size
+
+    if batch:
+        yield batch
+
+
+def get_num_cpus():
+    try:
+        return os.sysconf("SC_NPROCESSORS_ONLN")
+    except (AttributeError, ValueError, OSError):
+        return 1
+
+
+def map_results(compiled, items, workers, ordered, finished):
+    """ the generator behind Command._map.  `compiled` launches one item in
+    the background, and its _done callback puts the finished command on the
+    `finished` Queue """
+    exhausted = False
+    num_spawned = 0
+    next_to_yield = 0
+    running = {}
+    completed = {}
+
+    while True:
+        while not exhausted and len(running) < workers:
+            try:
+                item = next(items)
+            except StopIteration:
+                exhausted = True
+                break
+
+            index = num_spawned
+            num_spawned += 1
+            try:
+                cmd = compiled(item)
+            except (ForkException, OSError) as e:
+                completed[index] = (item, e)
             else:
-                launch = lambda: os.spawnve(os.P_WAIT, cmd[0], cmd, call_args["env"])
+                running[id(cmd)] = (index, item, cmd)
 
+        if ordered:
+            while next_to_yield in completed:
+                yield completed.pop(next_to_yield)
+                next_to_yield += 1
+        else:
+            for index in list(completed.keys()):
+                yield completed.pop(index)
+
+        if not running:
+            if exhausted and not completed:
+                break
+            continue
+
+        # every process we spawned was registered before we got here, so
+        # this is always one of ours
+        cmd = finished.get()
+        index, item, cmd = running.pop(id(cmd))
+        try:
+            result = cmd.wait()
+        except (ErrorReturnCode, TimeoutException) as e:
+            result = e
+        completed[index] = (item, result)
+
+
+def normalize_ok_code(call_args):
+    # handle a None.  this is added back only to not break the api in the
+    # 1.* version.  TODO remove this in 2.0, as "ok_code", if specified,
+    # should always be a definitive value or list of values, and None is
+    # ambiguous
+    if call_args["ok_code"] is None:
+        call_args["ok_code"] = 0
+
+    if not getattr(call_args["ok_code"], "__iter__", None):
+        call_args["ok_code"] = [call_args["ok_code"]]
+
+
+def launch_command(cmd, call_args, stdin):
+    """ takes a fully compiled command and its complete set of special keyword
+    arguments, and launches it """
+
+    # if we're running in foreground mode, we need to completely bypass
+    # launching a RunningCommand and OProc and just do a spawn
+    if call_args["fg"]:
+        if call_args["env"] is None:
+            launch = lambda: os.spawnv(os.P_WAIT, cmd[0], cmd)
+        else:
+            launch = lambda: os.spawnve(os.P_WAIT, cmd[0], cmd, call_args["env"])
+
+        limiter = get_concurrency_limiter(call_args)
+        if limiter:
+            limiter.acquire()
+        try:
             exit_code = launch()
-            exc_class = get_exc_exit_code_would_raise(exit_code,
-                    call_args["ok_code"], call_args["piped"])
-            if exc_class:
-                if IS_PY3:
-                    ran = " ".join([arg.decode(DEFAULT_ENCODING, "ignore") for arg in cmd])
+        finally:
+            if limiter:
+                limiter.release()
+
+        exc_class = get_exc_exit_code_would_raise(exit_code,
+                call_args["ok_code"], call_args["piped"])
+        if exc_class:
+            if IS_PY3:
+                ran = " ".join([arg.decode(DEFAULT_ENCODING, "ignore") for arg in cmd])
+            else:
+                ran = " ".join(cmd)
+            exc = exc_class(ran, b"", b"", call_args["truncate_exc"])
+            raise exc
+        return None
+
+
+    # stdout redirection
+    stdout = open_output_redirect(call_args["out"])
+
+    # stderr redirection
+    stderr = open_output_redirect(call_args["err"])
+
+    return RunningCommand(cmd, call_args, stdin, stdout, stderr)
+
+
+class DependencyFailed(Exception):
+    """ the result of a TaskGraph task that was never run because a task that
+    it depends on failed """
+    def __init__(self, name, dependency):
+        self.name = name
+        self.dependency = dependency
+        msg = "%r was not run because %r failed" % (name, dependency)
+        super(DependencyFailed, self).__init__(msg)
+
+
+class TaskGraph(object):
+    """ runs commands that depend on each other, each one as soon as the tasks
+    it depends on have finished successfully, with at most `max_parallel`
+    processes running at a time:
+
+        graph = sh.TaskGraph(max_parallel=4)
+        graph.add("fetch", sh.curl.bake("-o", "data.csv", url))
+        graph.add("schema", sh.psql.bake("-f", "schema.sql"))
+        graph.add("load", sh.psql.bake("-c", load_sql), after=["fetch", "schema"])
+        graph.add("report", sh.python.bake("report.py"), after="load")
+        graph.run()
+
+    a task can also be fed the stdout of another task through a pipe, with
+    `pipe_from`.  the two are started together, as soon as both of their
+    dependencies allow it, and the data goes straight from one process to the
+    other through the kernel, like a shell pipeline:
+
+        graph.add("dump", sh.pg_dump.bake("mydb"), after="load")
+        graph.add("compress", sh.gzip.bake("-c", _out="mydb.gz"), pipe_from="dump")
+
+    a failed task cancels everything downstream of it, but independent tasks
+    keep running.  run() returns when nothing else can run.  if anything
+    failed, it raises the exception of the first task that failed.  either way,
+    .results maps each task name to its finished RunningCommand, its
+    exception, or a DependencyFailed if it was cancelled """
+
+    def __init__(self, max_parallel=None):
+        if max_parallel is None:
+            max_parallel = get_num_cpus()
+        if max_parallel < 1:
+            raise ValueError("max_parallel must be at least 1")
+
+        self.max_parallel = max_parallel
+        self.results = {}
+        self._tasks = {}
+        self._task_order = []
+
+    def add(self, name, cmd, after=(), pipe_from=None):
+        """ adds a task named `name` that runs the Command `cmd` (usually a
+        baked command) once every task in `after` has succeeded.  if
+        `pipe_from` is the name of another task, that task's stdout becomes
+        this task's stdin """
+        if name in self._tasks:
+            raise ValueError("there is already a task named %r" % name)
+
+        if isinstance(after, basestring):
+            after = [after]
+
+        if pipe_from is not None:
+            for other_name, other in self._tasks.items():
+                if other["pipe_from"] == pipe_from:
+                    raise ValueError("%r is already piped into %r" %
+                            (pipe_from, other_name))
+
+        self._tasks[name] = {
+            "cmd": cmd,
+            "after": set(after),
+            "pipe_from": pipe_from,
+        }
+        self._task_order.append(name)
+
+
+    def _get_groups(self):
+        """ validates the graph and returns the groups of tasks that are
+        started together, which is every task alone, except for the tasks of a
+        pipeline """
+        pipe_to = {}
+        for name in self._task_order:
+            task = self._tasks[name]
+            for dep in list(task["after"]) + [task["pipe_from"]]:
+                if dep is not None and dep not in self._tasks:
+                    raise ValueError("%r depends on unknown task %r" %
+                            (name, dep))
+            if task["pipe_from"] is not None:
+                pipe_to[task["pipe_from"]] = name
+
+        # look for cycles with a depth-first search.  being piped from a task
+        # counts as depending on it
+        visiting = set()
+        visited = set()
+        def visit(name):
+            if name in visited:
+                return
+            if name in visiting:
+                raise ValueError("dependency cycle involving %r" % name)
+            visiting.add(name)
+            task = self._tasks[name]
+            for dep in task["after"]:
+                visit(dep)
+            if task["pipe_from"] is not None:
+                visit(task["pipe_from"])
+            visiting.discard(name)
+            visited.add(name)
+
+        for name in self._task_order:
+            visit(name)
+
+        groups = []
+        for name in self._task_order:
+            if self._tasks[name]["pipe_from"] is not None:
+                continue
+
+            members = [name]
+            while members[-1] in pipe_to:
+                members.append(pipe_to[members[-1]])
+
+            deps = set()
+            for member in members:
+                deps.update(self._tasks[member]["after"])
+            deps.difference_update(members)
+            groups.append((members, deps))
+
+        return groups
+
+
+    def run(self):
+        groups = self._get_groups()
+        self.results = {}
+
+        succeeded = set()
+        failed = set()
+        first_exc = []
+        running = {}
+        commands = {}
+        finished = Queue()
+
+        def make_done(user_done):
+            def done(cmd, success, exit_code):
+                try:
+                    if user_done:
+                        user_done(cmd, success, exit_code)
+                finally:
+                    finished.put(cmd)
+            return done
+
+        def record(name, result):
+            self.results[name] = result
+            if isinstance(result, Exception):
+                failed.add(name)
+                if not first_exc and not isinstance(result, DependencyFailed):
+                    first_exc.append(result)
+            else:
+                succeeded.add(name)
+
+        def collect(name):
+            if name in self.results:
+                return
+            # the process feeding us must be collected first, otherwise
+            # waiting on us would raise its exception as if it were ours
+            producer = self._tasks[name]["pipe_from"]
+            if producer is not None:
+                collect(producer)
+
+            cmd = commands[name]
+            running.pop(id(cmd), None)
+            try:
+                result = cmd.wait()
+            except (ErrorReturnCode, TimeoutException) as e:
+                result = e
+            record(name, result)
+
+        def start(members):
+            prev = None
+            for i, name in enumerate(members):
+                if prev is None and i:
+                    record(name, DependencyFailed(name, members[i - 1]))
+                    continue
+
+                cmd = self._tasks[name]["cmd"]
+                kwargs = {
+                    "_bg": True,
+                    "_bg_exc": False,
+                    "_done": make_done(cmd._partial_call_args.get("done")),
+                }
+                if i < len(members) - 1:
+                    kwargs["_piped"] = True
+
+                args = ()
+                if prev is not None:
+                    args = (prev,)
+
+                try:
+                    prev = cmd(*args, **kwargs)
+                except (ForkException, OSError) as e:
+                    record(name, e)
+                    prev = None
                 else:
-                    ran = " ".join(cmd)
-                exc = exc_class(ran, b"", b"", call_args["truncate_exc"])
-                raise exc
-            return None
+                    commands[name] = prev
+                    running[id(prev)] = name
 
+        while True:
+            # starting or cancelling a group can settle the dependencies of
+            # groups we've already looked at, so we go until nothing changes
+            changed = True
+            while changed:
+                changed = False
+                for group in list(groups):
+                    members, deps = group
+                    bad_deps = deps & failed
+                    if bad_deps:
+                        groups.remove(group)
+                        changed = True
+                        bad_dep = sorted(bad_deps)[0]
+                        for name in members:
+                            record(name, DependencyFailed(name, bad_dep))
+                        continue
+
+                    if not deps.issubset(succeeded):
+                        continue
+
+                    # a pipeline bigger than our limit can still run by itself
+                    if running and \
+                            len(running) + len(members) > self.max_parallel:
+                        continue
+
+                    groups.remove(group)
+                    changed = True
+                    start(members)
+
+            if not running:
+                break
 
-        # stdout redirection
-        stdout = call_args["out"]
-        if output_redirect_is_filename(stdout):
-            stdout = open(str(stdout), "wb")
+            cmd = finished.get()
+            name = running.get(id(cmd))
+            if name is not None:
+                collect(name)
 
-        # stderr redirection
-        stderr = call_args["err"]
-        if output_redirect_is_filename(stderr):
-            stderr = open(str(stderr), "wb")
-    
-        return RunningCommand(cmd, call_args, stdin, stdout, stderr)
+        if first_exc:
+            raise first_exc[0]
+        return self.results
+
+
+class _CoprocessOutput(object):
+    """ the file-like object a Coprocess's stdout is written to.  being
+    file-like, rather than a callback, means we get the raw bytes """
+
+    def __init__(self, coprocess):
+        self.coprocess = coprocess
+
+    def write(self, chunk):
+        self.coprocess._received(chunk)
+
+
+class Coprocess(object):
+    """ keeps a program running in the background and sends it requests over
+    its stdin, for programs that answer one request after another, like
+    `git cat-file --batch`, `bc` or `sqlite3`.  this saves launching a new
+    process for every request:
+
+        bc = sh.Coprocess(sh.bc.bake("-q"))
+        bc.request("2 + 2\\n", until="\\n")      # "4\\n"
+
+    `until` says where a response ends.  it may be a delimiter string, which
+    is included in the response, a compiled regex, where the response ends at
+    the end of the first match, a number of bytes, or a function that's given
+    everything received so far and returns where the response ends, or None
+    if it hasn't all arrived yet.
+
+    requests are sent one at a time, so a Coprocess can be shared between
+    threads.  if the program exits, it's started again on the next request.
+    if `until` raises an exception, the program is killed, since we can't
+    tell where its next response would begin, and the exception is raised.
+    responses are strings in the command's _encoding, or bytes if `binary` is
+    True.  any other keyword arguments are special kwargs for launching the
+    program """
+
+    def __init__(self, command, binary=False, **kwargs):
+        self._command = command
+        self._binary = binary
+
+        call_args = Command._call_args.copy()
+        call_args.update(command._partial_call_args)
+        call_args.update((k.lstrip("_"), v) for k, v in kwargs.items())
+        self._encoding = call_args["encoding"]
+        self._decode_errors = call_args["decode_errors"]
+        # we launch the program with a _done of our own, which would replace
+        # one baked into the command, so we call theirs from ours
+        self._done = call_args["done"]
+
+        # most programs buffer their output if it isn't a tty, but a tty would
+        # mangle newlines, and the programs meant to be used like this flush
+        # after each response anyways.  we read a line at a time, because
+        # unbuffered reads a byte at a time, so a program whose responses
+        # don't end in a newline, like a prompt, needs _out_bufsize=0
+        self._launch_kwargs = {"_tty_out": False, "_no_err": True,
+                "_out_bufsize": 1}
+        self._launch_kwargs.update(kwargs)
+
+        # serializes requests
+        self._lock = threading.Lock()
+        # guards everything below, and is notified when output arrives or the
+        # process exits
+        self._cond = threading.Condition(threading.Lock())
+        self._process = None
+        self._stdin = None
+        self._buffer = bytearray()
+        self._exited = False
+        self._closed = False
+        # which launch of the program this is.  an old one exiting shouldn't
+        # look like the current one exiting
+        self._generation = 0
+
+    def __repr__(self):
+        return "<Coprocess %r>" % self._command
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def process(self):
+        """ the RunningCommand of the program, if it's running """
+        return self._process
+
+    def _encode(self, data):
+        if isinstance(data, bytes):
+            return data
+        return data.encode(self._encoding)
+
+    def _start(self):
+        self._stdin = Queue()
+        with self._cond:
+            self._buffer = bytearray()
+            self._exited = False
+            self._generation += 1
+            generation = self._generation
+
+        kwargs = self._launch_kwargs.copy()
+        kwargs.update({
+            "_bg": True,
+            "_bg_exc": False,
+            "_in": self._stdin,
+            "_out": _CoprocessOutput(self),
+            "_done": self._exit_callback(generation, self._done),
+        })
+        self._process = self._command(**kwargs)
+
+    def _exit_callback(self, generation, done):
+        def fn(cmd, success, exit_code):
+            with self._cond:
+                if generation == self._generation:
+                    self._exited = True
+                    self._cond.notify_all()
+            if done:
+                done(cmd, success, exit_code)
+        return fn
+
+    def _received(self, chunk):
+        with self._cond:
+            self._buffer += chunk
+            self._cond.notify_all()
+
+    def _find_end(self, until, searched):
+        buf = self._buffer
+        if isinstance(until, (int, long)):
+            if len(buf) >= until:
+                return until
+        elif isinstance(until, bytes):
+            # don't search what we've already searched, but back up in case
+            # the delimiter was split across chunks
+            i = buf.find(until, max(0, searched - len(until) + 1))
+            if i != -1:
+                return i + len(until)
+        elif callable(until):
+            return until(buf)
+        else:
+            match = until.search(buf)
+            if match:
+                return match.end()
+        return None
+
+    def request(self, data=None, until="\n", timeout=None):
+        """ sends `data` to the program and returns its response.  if
+        `timeout` seconds pass without a full response, the program is killed,
+        because we would no longer know where its next response begins, and
+        TimeoutException is raised """
+        if isinstance(until, basestring):
+            until = self._encode(until)
+
+        with self._lock:
+            if self._closed:
+                raise ValueError("request on a closed Coprocess")
+            if self._process is None or self._exited:
+                self._start()
+
+            if data:
+                self._stdin.put(self._encode(data))
+            return self._read_response(until, timeout)
+
+    def _read_response(self, until, timeout):
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        searched = 0
+        broken = None
+        with self._cond:
+            while True:
+                try:
+                    end = self._find_end(until, searched)
+                except Exception as e:
+                    broken = e
+                    break
+                if end is not None:
+                    response = bytes(self._buffer[:end])
+                    del self._buffer[:end]
+                    break
+                searched = len(self._buffer)
+
+                if self._exited:
+                    break
+
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                self._cond.wait(remaining)
+
+        if broken:
+            # the program's exit callback needs the condition, so we can't
+            # kill it while we hold it
+            self._kill()
+            raise broken
+        if end is None:
+            return self._failed()
+
+        if not self._binary:
+            response = response.decode(self._encoding, self._decode_errors)
+        return response
+
+    def _kill(self):
+        """ kills the program, so the next request starts it again, with
+        nothing left over from this one.  returns its exit code """
+        process = self._process
+        try:
+            process.kill()
+        except OSError:
+            pass
+        exit_code = process.process.wait()
+        self._exited = True
+        return exit_code
+
+    def _failed(self):
+        process = self._process
+        if not self._exited:
+            raise TimeoutException(-self._kill())
+
+        # raises ErrorReturnCode if it exited with a bad exit code
+        process.wait()
+        raise EOFError("%r exited before responding" % process.ran)
+
+    def close(self):
+        """ closes the program's stdin, and waits for it to exit """
+        with self._lock:
+            self._closed = True
+            process = self._process
+            if process is None or self._exited:
+                return
+            self._stdin.put(None)
+        process.wait()
+
+
+class CoprocessPool(object):
+    """ a pool of `size` identical Coprocesses, for when one process isn't
+    enough to keep up with the requests of several threads.  a request goes to
+    whichever one is free.  the arguments are the same as Coprocess """
+
+    def __init__(self, command, size=None, **kwargs):
+        if size is None:
+            size = get_num_cpus()
+        if size < 1:
+            raise ValueError("size must be at least 1")
+
+        self._idle = Queue()
+        self.coprocesses = []
+        for i in range(size):
+            coprocess = Coprocess(command, **kwargs)
+            self.coprocesses.append(coprocess)
+            self._idle.put(coprocess)
+
+    def __repr__(self):
+        return "<CoprocessPool of %d>" % len(self.coprocesses)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def request(self, data=None, until="\n", timeout=None):
+        coprocess = self._idle.get()
+        try:
+            return coprocess.request(data, until, timeout)
+        finally:
+            self._idle.put(coprocess)
+
+    def close(self):
+        for coprocess in self.coprocesses:
+            coprocess.close()
+
+
+def shell_quote(arg):
+    """ quotes an encoded argument for a posix shell """
+    return b"'" + arg.replace(b"'", b"'\\''") + b"'"
+
+
+class Session(object):
+    """ runs short commands through one long-running shell, instead of
+    launching each of them with their own pipes, pty and threads.  for glue
+    code that runs lots of quick commands like `test`, `stat` or `mkdir`:
+
+        session = sh.Session(tty_out=False)
+        sh.test("-f", path, _session=session)
+
+        mkdir = sh.mkdir.bake("-p", _session=session)
+
+    a session can't give its commands a tty.  so by default, it only runs the
+    commands that were called with _tty_out=False, and everything else gets
+    its tty by being launched normally.  Session(tty_out=False) runs them all
+    without a tty, as if they had been called with _tty_out=False.  stdin may
+    only be a string or bytes.  anything a session can't do, like running in
+    the background, piping, redirecting output or _uid, is launched the
+    regular way instead.  like in a shell, a command killed by a signal exits
+    with 128 plus the signal number """
+
+    # call args that a session can't honor.  a command with any of these set
+    # is launched normally
+    _unsupported = ("bg", "piped", "out", "err", "tty_in", "uid",
+            "preexec_fn", "fg", "out_filter", "err_filter", "out_keep",
+            "err_keep")
+
+    def __init__(self, shell="/bin/sh", tty_out=True):
+        import binascii
+        import tempfile
+
+        self.shell = shell
+        self.tty_out = tty_out
+        self._lock = threading.Lock()
+        self._dir = tempfile.mkdtemp(prefix="sh-session-")
+        self._err_path = os.path.join(self._dir, "err")
+        self._in_path = os.path.join(self._dir, "in")
+
+        # ends each command's output, so that we know where it stops.  it's
+        # random, so no command will print it by accident
+        self._marker = binascii.hexlify(os.urandom(16))
+        self._coprocess = Coprocess(Command(shell), binary=True)
+
+    def __repr__(self):
+        return "<Session %r>" % self.shell
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def can_run(self, call_args, stdin):
+        if stdin is not None and not isinstance(stdin, (basestring, bytes)):
+            return False
+        # _tty_out is on unless it was turned off, and only we can say that it
+        # doesn't matter
+        if self.tty_out and call_args["tty_out"]:
+            return False
+        for arg in self._unsupported:
+            if call_args[arg]:
+                return False
+        return True
+
+    def _script(self, cmd, call_args, stdin):
+        encode = encode_to_py3bytes_or_py2str
+        argv = b" ".join(shell_quote(arg) for arg in cmd)
+
+        env = call_args["env"]
+        if env is not None:
+            assignments = [shell_quote(encode("%s=%s" % (k, v)))
+                    for k, v in env.items()]
+            argv = b" ".join([b"env -i"] + assignments + [argv])
+
+        # a subshell keeps the cd to itself
+        argv = b"exec " + argv
+        if call_args["cwd"]:
+            argv = b"cd " + shell_quote(encode(call_args["cwd"])) + b" && " \
+                    + argv
+        script = b"(" + argv + b")"
+
+        if stdin is None:
+            script += b" </dev/null"
+        else:
+            script += b" <" + shell_quote(encode(self._in_path))
+
+        if call_args["err_to_out"]:
+            script += b" 2>&1"
+        else:
+            script += b" 2>" + shell_quote(encode(self._err_path))
+
+        # the exit code goes at the start of a new line, in case the
+        # command's output doesn't end with a newline
+        script += b"; printf '\\n%d %s\\n' \"$?\" " + self._marker + b"\n"
+        return script
+
+    def run(self, command, cmd, stdin):
+        """ runs `cmd` for the RunningCommand `command`, and returns a
+        finished stand-in for its OProc """
+        call_args = command.call_args
+        script = self._script(cmd, call_args, stdin)
+        end = b" " + self._marker + b"\n"
+
+        with self._lock:
+            if stdin is not None:
+                with open(self._in_path, "wb") as h:
+                    h.write(encode_to_py3bytes_or_py2str(stdin))
+
+            response = self._coprocess.request(script, until=end,
+                    timeout=call_args["timeout"])
+
+            stderr = b""
+            if not call_args["err_to_out"]:
+                with open(self._err_path, "rb") as h:
+                    stderr = h.read()
+
+        stdout, _, exit_code = response[:-len(end)].rpartition(b"\n")
+        if call_args["no_out"]:
+            stdout = b""
+        if call_args["no_err"]:
+            stderr = b""
+        return ReplayedProcess(command, stdout, stderr, int(exit_code))
+
+    def close(self):
+        import shutil
+        self._coprocess.close()
+        shutil.rmtree(self._dir, ignore_errors=True)
 
 
 def compile_args(args, kwargs, sep, prefix):
@@ -1534,12 +3727,14 @@ def aggregate_keywords(keywords, sep, prefix, raw=False):
     return processed
 
 
-def _start_daemon_thread(fn, name, exc_queue, *args):
+def _start_daemon_thread(fn, name, excs, *args):
+    """ starts fn in a daemon thread.  if it raises, the exception is appended
+    to the list `excs` """
     def wrap(*args, **kwargs):
         try:
             fn(*args, **kwargs)
         except Exception as e:
-            exc_queue.put(e)
+            excs.append(e)
             raise
 
     thrd = threading.Thread(target=wrap, name=name, args=args)
@@ -1551,12 +3746,22 @@ def _start_daemon_thread(fn, name, exc_queue, *args):
 def setwinsize(fd, rows_cols):
     """ set the terminal size of a tty file descriptor.  borrowed logic
     from pexpect.py """
+    import termios
     rows, cols = rows_cols
     TIOCSWINSZ = getattr(termios, 'TIOCSWINSZ', -2146929561)
 
     s = struct.pack('HHHH', rows, cols, 0, 0)
     fcntl.ioctl(fd, TIOCSWINSZ, s)
 
+def construct_streamreader_handler(process, handler):
+    """ makes closures for the callbacks in an _out or _err handler, which may
+    be a list of handlers """
+    if isinstance(handler, (list, tuple)):
+        return [construct_streamreader_handler(process, h) for h in handler]
+    if callable(handler):
+        return construct_streamreader_callback(process, handler)
+    return handler
+
 def construct_streamreader_callback(process, handler):
     """ here we're constructing a closure for our streamreader callback.  this
     is used in the case that we pass a callback into _out or _err, meaning we
@@ -1582,12 +3787,12 @@ def construct_streamreader_callback(process, handler):
         partial_args = len(handler.args)
         handler_to_inspect = handler.func
 
-    if inspect.ismethod(handler_to_inspect):
+    if isinstance(handler_to_inspect, MethodType):
         implied_arg = 1
         num_args = get_num_args(handler_to_inspect)
 
     else:
-        if inspect.isfunction(handler_to_inspect):
+        if isinstance(handler_to_inspect, FunctionType):
             num_args = get_num_args(handler_to_inspect)
 
         # is an object instance with __call__ method
@@ -1675,6 +3880,385 @@ def no_interrupt(syscall, *args, **kwargs):
     return ret
 
 
+def exec_child(spec, fds, preexec_fn=None): # pragma: no cover
+    """ runs in a freshly forked child, either ours or a forkserver's.  sets
+    up the child described by `spec` and execs it.  `fds` are the child's
+    (stdin, stdout, stderr, session pipe, exception pipe).  this never
+    returns """
+    # these were imported by our parent before it forked us, so these are
+    # only lookups in sys.modules
+    import resource, tty
+
+    stdin_fd, stdout_fd, stderr_fd, session_pipe_write, exc_pipe_write = fds
+
+    try:
+        # ignoring SIGHUP lets us persist even after the parent process
+        # exits.  only ignore if we're backgrounded
+        if spec["bg"]:
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+        # python ignores SIGPIPE by default.  we must make sure to put
+        # this behavior back to the default for spawned processes,
+        # otherwise SIGPIPE won't kill piped processes, which is what we
+        # need, so that we can check the error code of the killed
+        # process to see that SIGPIPE killed it
+        signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+        # put our forked process in a new session?  this will relinquish
+        # any control of our inherited CTTY and also make our parent
+        # process init
+        if spec["new_session"]:
+            os.setsid()
+        # if we're not going in a new session, we should go in a new
+        # process group.  this way, our process, and any children it
+        # spawns, are alone, contained entirely in one group.  if we
+        # didn't do this, and didn't use a new session, then our exec'd
+        # process *could* exist in the same group as our python process,
+        # depending on how we launch the process (from a shell, or some
+        # other way)
+        else:
+            os.setpgrp()
+
+        sid = os.getsid(0)
+        pgid = os.getpgid(0)
+        payload = ("%d,%d" % (sid, pgid)).encode(DEFAULT_ENCODING)
+        os.write(session_pipe_write, payload)
+
+        if spec["raw_out"]:
+            # set raw mode, so there isn't any weird translation of
+            # newlines to \r\n and other oddities.  we're not outputting
+            # to a terminal anyways
+            #
+            # we HAVE to do this here, and not in the parent process,
+            # because we have to guarantee that this is set before the
+            # child process is run, and we can't do it twice.
+            tty.setraw(stdout_fd)
+
+        if spec["cwd"]:
+            os.chdir(spec["cwd"])
+
+        os.dup2(stdin_fd, 0)
+        os.dup2(stdout_fd, 1)
+        os.dup2(stderr_fd, 2)
+
+
+        # set our controlling terminal, but only if we're using a tty
+        # for stdin.  it doesn't make sense to have a ctty otherwise
+        if spec["needs_ctty"]:
+            tmp_fd = os.open(os.ttyname(0), os.O_RDWR)
+            os.close(tmp_fd)
+
+        if spec["tty_size"]:
+            setwinsize(1, spec["tty_size"])
+
+        if spec["uid"] is not None:
+            os.setgid(spec["gid"])
+            os.setuid(spec["uid"])
+
+        if callable(preexec_fn):
+            preexec_fn()
+
+
+        # don't inherit file descriptors
+        max_fd = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+        os.closerange(3, max_fd)
+
+        # actually execute the process
+        cmd = spec["cmd"]
+        if spec["env"] is None:
+            os.execv(cmd[0], cmd)
+        else:
+            os.execve(cmd[0], cmd, spec["env"])
+
+    # we must ensure that we carefully exit the child process on
+    # exception, otherwise the parent process code will be executed
+    # twice on exception https://github.com/amoffat/sh/issues/202
+    #
+    # if your parent process experiences an exit code 255, it is most
+    # likely that an exception occurred between the fork of the child
+    # and the exec.  this should be reported.
+    except:
+        # some helpful debugging
+        try:
+            import traceback
+            tb = traceback.format_exc().encode("utf8", "ignore")
+            os.write(exc_pipe_write, tb)
+
+        finally:
+            os._exit(255)
+
+
+# the most fds that are sent along with a forkserver message
+_FORKSERVER_MAX_FDS = 5
+
+
+def _send_message(sock, message, fds=()):
+    """ sends a pickled message, and fds, over a unix socket """
+    import array
+    import pickle
+    import socket
+
+    payload = pickle.dumps(message, 2)
+    header = struct.pack("!I", len(payload))
+    if fds:
+        sock.sendmsg([header], [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+            array.array("i", fds))])
+    else:
+        sock.sendall(header)
+    sock.sendall(payload)
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise EOFError
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def _recv_message(sock):
+    """ returns (message, fds) from _send_message, or (None, []) if the
+    other end has closed the socket """
+    import array
+    import pickle
+    import socket
+
+    int_size = array.array("i").itemsize
+    header, ancdata, flags, addr = sock.recvmsg(4,
+            socket.CMSG_SPACE(_FORKSERVER_MAX_FDS * int_size))
+    if not header:
+        return None, []
+
+    fds = array.array("i")
+    for level, kind, data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - (len(data) % int_size)])
+
+    try:
+        header += _recv_exactly(sock, 4 - len(header))
+        size = struct.unpack("!I", header)[0]
+        message = pickle.loads(_recv_exactly(sock, size))
+    except EOFError:
+        return None, []
+    return message, list(fds)
+
+
+def _forkserver_main(sock): # pragma: no cover
+    """ the loop the forkserver process runs.  it forks and sets up children
+    for spawn requests, and reports back their pids, and their exit statuses
+    when they exit """
+
+    # we share a process group with our client, so a ctrl-c at the terminal
+    # that's meant for it shouldn't kill us
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # wake up our select() when a child exits
+    wake_read, wake_write = os.pipe()
+    for fd in (wake_read, wake_write):
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+    signal.set_wakeup_fd(wake_write)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+    while True:
+        try:
+            readable = select.select([sock, wake_read], [], [])[0]
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+
+        if wake_read in readable:
+            try:
+                while os.read(wake_read, 1024):
+                    pass
+            except OSError:
+                pass
+
+            while True:
+                try:
+                    pid, status = os.waitpid(-1, os.WNOHANG)
+                except OSError:
+                    break
+                if not pid:
+                    break
+                _send_message(sock, ("exit", pid, status))
+
+        if sock in readable:
+            spec, fds = _recv_message(sock)
+            if spec is None:
+                break
+
+            pid = os.fork()
+            if pid == 0:
+                signal.set_wakeup_fd(-1)
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                sock.close()
+                os.close(wake_read)
+                os.close(wake_write)
+                exec_child(spec, fds)
+
+            for fd in fds:
+                os.close(fd)
+            _send_message(sock, ("spawned", pid))
+
+
+class ForkServer(object):
+    """ a small helper process that forks our child processes for us.  forking
+    a big process, especially one with a lot of threads, is slow, because its
+    page tables have to be copied, and risky, because locks held by other
+    threads stay held in the child.  the forkserver is forked once, ideally
+    early, while our process is still small and has no threads, and from then
+    on it does the forking from its own small address space.  the fds a child
+    needs are sent to it over a unix socket.
+
+    use start_forkserver() rather than this directly.  this needs python 3.3
+    or later, for socket.sendmsg """
+
+    def __init__(self):
+        self.pid = None
+        self._sock = None
+        self._send_lock = threading.Lock()
+        self._replies = Queue()
+
+        # exit statuses of children that haven't been waited on yet, by pid
+        self._cond = threading.Condition(threading.Lock())
+        self._statuses = {}
+        self._alive = False
+
+    def __repr__(self):
+        return "<ForkServer pid %r>" % self.pid
+
+    def start(self):
+        import socket
+        # the forkserver only imports what its children need from what we've
+        # already imported
+        import resource, tty
+
+        if not hasattr(socket.socket, "sendmsg"):
+            raise RuntimeError("a forkserver needs python 3.3 or later")
+
+        parent_sock, child_sock = socket.socketpair(socket.AF_UNIX,
+                socket.SOCK_STREAM)
+        pid = os.fork()
+        if pid == 0: # pragma: no cover
+            try:
+                # keep nothing of our parent's open but our socket
+                fd = child_sock.fileno()
+                max_fd = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+                os.closerange(3, fd)
+                os.closerange(fd + 1, max_fd)
+                _forkserver_main(child_sock)
+            finally:
+                os._exit(0)
+
+        child_sock.close()
+        self.pid = pid
+        self._sock = parent_sock
+        self._alive = True
+
+        thread = threading.Thread(target=self._read_messages,
+                name="forkserver %d" % pid)
+        thread.daemon = True
+        thread.start()
+
+    def _read_messages(self):
+        import socket
+        try:
+            while True:
+                message = _recv_message(self._sock)[0]
+                if message is None:
+                    break
+
+                if message[0] == "exit":
+                    pid, status = message[1:]
+                    with self._cond:
+                        self._statuses[pid] = status
+                        self._cond.notify_all()
+                else:
+                    self._replies.put(message)
+        except (OSError, socket.error):
+            pass
+        finally:
+            with self._cond:
+                self._alive = False
+                self._cond.notify_all()
+            self._replies.put(None)
+
+    def spawn(self, spec, fds):
+        """ forks a child that runs exec_child(spec, fds), and returns its
+        pid """
+        with self._send_lock:
+            if not self._alive:
+                raise RuntimeError("the forkserver isn't running")
+            _send_message(self._sock, spec, fds)
+            reply = self._replies.get()
+
+        if reply is None:
+            raise RuntimeError("the forkserver exited")
+        return reply[1]
+
+    def waitpid(self, pid, options):
+        """ like os.waitpid, for the children of the forkserver """
+        with self._cond:
+            while pid not in self._statuses:
+                if options & os.WNOHANG:
+                    return 0, 0
+                if not self._alive:
+                    raise OSError(errno.ECHILD, "the forkserver exited")
+                self._cond.wait()
+            return pid, self._statuses.pop(pid)
+
+    def stop(self):
+        """ stops the forkserver.  children it has already started keep
+        running, but they can no longer be waited on """
+        import socket
+        with self._send_lock:
+            if self._sock is None:
+                return
+            # shutdown, and not just close, so that our reader thread wakes up
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self._sock.close()
+            self._sock = None
+        no_interrupt(os.waitpid, self.pid, 0)
+
+
+# the ForkServer that OProc uses, if start_forkserver() has started one
+_forkserver = None
+
+
+def start_forkserver():
+    """ starts a forkserver, and launches every process after this through it.
+    call this as early as you can, before your program starts any threads or
+    grows big, because that's the state the forkserver starts with.  setting
+    the SH_FORKSERVER environment variable starts one when sh is imported.
+    returns the ForkServer """
+    global _forkserver
+
+    if _forkserver is None:
+        forkserver = ForkServer()
+        forkserver.start()
+        _forkserver = forkserver
+    return _forkserver
+
+
+def stop_forkserver():
+    """ goes back to forking processes ourselves """
+    global _forkserver
+
+    forkserver = _forkserver
+    _forkserver = None
+    if forkserver is not None:
+        forkserver.stop()
+
+
 class OProc(object):
     """ this class is instantiated by RunningCommand for a command to be exec'd.
     it handles all the nasty business involved with correctly setting up the
@@ -1687,6 +4271,18 @@ class OProc(object):
     STDOUT = -1
     STDERR = -2
 
+    __slots__ = ("command", "call_args", "cmd", "pid", "sid", "pgid", "ctty",
+            "started", "timed_out", "exit_code", "log", "_stdin",
+            "_stdin_process", "_stdin_read_fd", "_stdin_write_fd",
+            "_stdout_read_fd", "_stdout_write_fd", "_stderr_read_fd",
+            "_stderr_write_fd", "_pipe_fd", "_pipe_queue", "_waitpid",
+            "_wait_lock", "_stdout", "_stderr", "_stdin_stream",
+            "_stdout_stream", "_stderr_stream", "_timeout_event",
+            "_timeout_timer", "_quit_threads", "_stop_output_event",
+            "_background_thread", "_input_thread", "_output_thread",
+            "_bg_thread_excs", "_input_thread_excs", "_output_thread_excs",
+            "__weakref__")
+
     def __init__(self, command, parent_log, cmd, stdin, stdout, stderr,
             call_args, pipe, process_assign_lock):
         """
@@ -1699,6 +4295,10 @@ class OProc(object):
             call_args is a mapping of all the special keyword arguments to apply
             to the child process
         """
+        # the child needs tty and resource after the fork, so they're imported
+        # here, before it, and the child only looks them up in sys.modules
+        import pty, resource, termios, tty
+
         self.command = command
         self.call_args = call_args
 
@@ -1855,10 +4455,51 @@ class OProc(object):
         if IS_OSX:
             close_pipe_read, close_pipe_write = os.pipe()
 
+        # everything the child needs to set itself up and exec, in a form that
+        # can also be sent to a forkserver
+        child_spec = {
+            "cmd": cmd,
+            "env": ca["env"],
+            "cwd": cwd,
+            "bg": ca["bg"] is True,
+            "new_session": new_session,
+            "needs_ctty": needs_ctty,
+            "raw_out": ca["tty_out"] and not stdout_is_tty_or_pipe \
+                    and not single_tty,
+            "tty_size": None,
+            "uid": None,
+            "gid": None,
+        }
+        if ca["tty_out"] and not stdout_is_tty_or_pipe:
+            child_spec["tty_size"] = ca["tty_size"]
+        if ca["uid"] is not None:
+            child_spec["uid"] = target_uid
+            child_spec["gid"] = target_gid
+        child_fds = (self._stdin_write_fd, self._stdout_write_fd,
+                self._stderr_write_fd, session_pipe_write, exc_pipe_write)
+
+        # a preexec_fn can't be sent to another process, so that always needs
+        # a fork of our own
+        forkserver = _forkserver
+        if forkserver is not None and ca["preexec_fn"] is not None:
+            forkserver = None
+
         # session id, group id, process id
         self.sid = None
         self.pgid = None
-        self.pid = os.fork()
+        self._waitpid = os.waitpid
+
+        if forkserver is not None:
+            # the forkserver's cwd and environment are whatever ours were when
+            # it started, so send along what they are now
+            if child_spec["cwd"] is None:
+                child_spec["cwd"] = os.getcwd()
+            if child_spec["env"] is None:
+                child_spec["env"] = dict(os.environ)
+            self.pid = forkserver.spawn(child_spec, child_fds)
+            self._waitpid = forkserver.waitpid
+        else:
+            self.pid = os.fork()
 
         # child
         if self.pid == 0: # pragma: no cover
@@ -1867,115 +4508,21 @@ class OProc(object):
                 os.close(close_pipe_read)
                 os.close(close_pipe_write)
 
-            try:
-                # ignoring SIGHUP lets us persist even after the parent process
-                # exits.  only ignore if we're backgrounded
-                if ca["bg"] is True:
-                    signal.signal(signal.SIGHUP, signal.SIG_IGN)
-
-                # python ignores SIGPIPE by default.  we must make sure to put
-                # this behavior back to the default for spawned processes,
-                # otherwise SIGPIPE won't kill piped processes, which is what we
-                # need, so that we can check the error code of the killed
-                # process to see that SIGPIPE killed it
-                signal.signal(signal.SIGPIPE, signal.SIG_DFL)
-
-                # put our forked process in a new session?  this will relinquish
-                # any control of our inherited CTTY and also make our parent
-                # process init
-                if new_session:
-                    os.setsid()
-                # if we're not going in a new session, we should go in a new
-                # process group.  this way, our process, and any children it
-                # spawns, are alone, contained entirely in one group.  if we
-                # didn't do this, and didn't use a new session, then our exec'd
-                # process *could* exist in the same group as our python process,
-                # depending on how we launch the process (from a shell, or some
-                # other way)
-                else:
-                    os.setpgrp()
-
-                sid = os.getsid(0)
-                pgid = os.getpgid(0)
-                payload = ("%d,%d" % (sid, pgid)).encode(DEFAULT_ENCODING)
-                os.write(session_pipe_write, payload)
-
-                if ca["tty_out"] and not stdout_is_tty_or_pipe and not single_tty:
-                    # set raw mode, so there isn't any weird translation of
-                    # newlines to \r\n and other oddities.  we're not outputting
-                    # to a terminal anyways
-                    #
-                    # we HAVE to do this here, and not in the parent process,
-                    # because we have to guarantee that this is set before the
-                    # child process is run, and we can't do it twice.
-                    tty.setraw(self._stdout_write_fd)
-
-
-                # if the parent-side fd for stdin exists, close it.  the case
-                # where it may not exist is if we're using piping
-                if self._stdin_read_fd:
-                    os.close(self._stdin_read_fd)
-
-                if self._stdout_read_fd:
-                    os.close(self._stdout_read_fd)
-
-                if self._stderr_read_fd:
-                    os.close(self._stderr_read_fd)
+            # if the parent-side fd for stdin exists, close it.  the case
+            # where it may not exist is if we're using piping
+            if self._stdin_read_fd:
+                os.close(self._stdin_read_fd)
 
-                os.close(session_pipe_read)
-                os.close(exc_pipe_read)
-
-                if cwd:
-                    os.chdir(cwd)
-
-                os.dup2(self._stdin_write_fd, 0)
-                os.dup2(self._stdout_write_fd, 1)
-                os.dup2(self._stderr_write_fd, 2)
-
-
-                # set our controlling terminal, but only if we're using a tty
-                # for stdin.  it doesn't make sense to have a ctty otherwise
-                if needs_ctty:
-                    tmp_fd = os.open(os.ttyname(0), os.O_RDWR)
-                    os.close(tmp_fd)
-
-                if ca["tty_out"] and not stdout_is_tty_or_pipe:
-                    setwinsize(1, ca["tty_size"])
-
-                if ca["uid"] is not None:
-                    os.setgid(target_gid)
-                    os.setuid(target_uid)
-
-                preexec_fn = ca["preexec_fn"]
-                if callable(preexec_fn):
-                    preexec_fn()
-
-
-                # don't inherit file descriptors
-                max_fd = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
-                os.closerange(3, max_fd)
+            if self._stdout_read_fd:
+                os.close(self._stdout_read_fd)
 
-                # actually execute the process
-                if ca["env"] is None:
-                    os.execv(cmd[0], cmd)
-                else:
-                    os.execve(cmd[0], cmd, ca["env"])
+            if self._stderr_read_fd:
+                os.close(self._stderr_read_fd)
 
-            # we must ensure that we carefully exit the child process on
-            # exception, otherwise the parent process code will be executed
-            # twice on exception https://github.com/amoffat/sh/issues/202
-            #
-            # if your parent process experiences an exit code 255, it is most
-            # likely that an exception occurred between the fork of the child
-            # and the exec.  this should be reported.
-            except:
-                # some helpful debugging
-                try:
-                    tb = traceback.format_exc().encode("utf8", "ignore")
-                    os.write(exc_pipe_write, tb)
+            os.close(session_pipe_read)
+            os.close(exc_pipe_read)
 
-                finally:
-                    os._exit(255)
+            exec_child(child_spec, child_fds, ca["preexec_fn"])
 
         # parent
         else:
@@ -2020,7 +4567,9 @@ class OProc(object):
             # to prevent race conditions
             self.exit_code = None
 
-            self.stdin = stdin or Queue()
+            # a Queue for stdin is only made if something asks for it, see
+            # the stdin property
+            self._stdin = stdin
 
             # _pipe_queue is used internally to hand off stdout from one process
             # to another.  by default, all stdout from a process gets dumped
@@ -2036,7 +4585,24 @@ class OProc(object):
             # these are for aggregating the stdout and stderr.  we use a deque
             # because we don't want to overflow
             self._stdout = deque(maxlen=ca["internal_bufsize"])
+            if ca["out_keep"]:
+                self._stdout = HeadTailBuffer(ca["out_keep"], ca["encoding"])
+            elif ca["out_compress"] not in (None, False):
+                self._stdout = CompressedBuffer(int(ca["out_compress"]))
+
             self._stderr = deque(maxlen=ca["internal_bufsize"])
+            if ca["err_keep"]:
+                self._stderr = HeadTailBuffer(ca["err_keep"], ca["encoding"])
+            elif ca["err_compress"] not in (None, False):
+                self._stderr = CompressedBuffer(int(ca["err_compress"]))
+
+            # if we're only keeping some of our output, or keeping it
+            # compressed, and nobody is iterating over it as it comes, our pipe
+            # only gets what we kept, once our output ends.  otherwise it would
+            # hold on to all of it
+            iterating = ca["iter"] or ca["iter_noblock"]
+            out_kept = not isinstance(self._stdout, deque) and not iterating
+            err_kept = not isinstance(self._stderr, deque) and not iterating
 
             if ca["tty_in"] and not stdin_is_tty_or_pipe:
                 setwinsize(self._stdin_read_fd, ca["tty_size"])
@@ -2056,7 +4622,8 @@ class OProc(object):
             # we're only going to create a stdin thread iff we have potential
             # for stdin to come in.  this would be through a stdout callback or
             # through an object we've passed in for stdin
-            potentially_has_input = callable(stdout) or stdin
+            potentially_has_input = stdin or \
+                    any(callable(h) for h in output_handlers(stdout))
 
             # this represents the connection from a Queue object (or whatever
             # we're using to feed STDIN) to the process's STDIN fd
@@ -2089,15 +4656,17 @@ class OProc(object):
             # processes's stdin fd
             self._stdout_stream = None
             if not pipe_out and self._stdout_read_fd:
-                if callable(stdout):
-                    stdout = construct_streamreader_callback(self, stdout)
+                stdout = construct_streamreader_handler(self, stdout)
                 self._stdout_stream = \
                         StreamReader(
                                 self.log.get_child("streamreader", "stdout"),
                                 self._stdout_read_fd, stdout, self._stdout,
                                 ca["out_bufsize"], ca["encoding"],
                                 ca["decode_errors"], stdout_pipe,
-                                save_data=save_stdout)
+                                save_data=save_stdout,
+                                pipe_kept=out_kept,
+                                chunk_filter=get_chunk_filter(ca["out_filter"],
+                                    ca["encoding"], ca["decode_errors"]))
 
             elif self._stdout_read_fd:
                 os.close(self._stdout_read_fd)
@@ -2118,13 +4687,15 @@ class OProc(object):
                 save_stderr = not ca["no_err"] and \
                     (ca["tee"] in ("err",) or stderr is None)
 
-                if callable(stderr):
-                    stderr = construct_streamreader_callback(self, stderr)
+                stderr = construct_streamreader_handler(self, stderr)
 
                 self._stderr_stream = StreamReader(Logger("streamreader"),
                         self._stderr_read_fd, stderr, self._stderr,
                         ca["err_bufsize"], ca["encoding"], ca["decode_errors"],
-                        stderr_pipe, save_data=save_stderr)
+                        stderr_pipe, save_data=save_stderr,
+                        pipe_kept=err_kept,
+                        chunk_filter=get_chunk_filter(ca["err_filter"],
+                            ca["encoding"], ca["decode_errors"]))
 
             elif self._stderr_read_fd:
                 os.close(self._stderr_read_fd)
@@ -2159,23 +4730,27 @@ class OProc(object):
 
             self._quit_threads = threading.Event()
 
-            thread_name = "background thread for pid %d" % self.pid
-            self._bg_thread_exc_queue = Queue(1)
-            self._background_thread = _start_daemon_thread(background_thread,
-                    thread_name, self._bg_thread_exc_queue, timeout_fn,
-                    self._timeout_event, handle_exit_code, self.is_alive,
-                    self._quit_threads)
+            # the background thread only has something to do if we can time
+            # out, or if we have to report our exit code
+            self._background_thread = None
+            self._bg_thread_excs = []
+            if self._timeout_event or handle_exit_code:
+                thread_name = "background thread for pid %d" % self.pid
+                self._background_thread = _start_daemon_thread(
+                        background_thread, thread_name, self._bg_thread_excs,
+                        timeout_fn, self._timeout_event, handle_exit_code,
+                        self.is_alive, self._quit_threads)
 
 
             # start the main io threads. stdin thread is not needed if we are
             # connecting from another process's stdout pipe
             self._input_thread = None
-            self._input_thread_exc_queue = Queue(1)
+            self._input_thread_excs = []
             if self._stdin_stream:
                 close_before_term = not needs_ctty
                 thread_name = "STDIN thread for pid %d" % self.pid
                 self._input_thread = _start_daemon_thread(input_thread,
-                        thread_name, self._input_thread_exc_queue, self.log,
+                        thread_name, self._input_thread_excs, self.log,
                         self._stdin_stream, self.is_alive, self._quit_threads,
                         close_before_term)
 
@@ -2187,10 +4762,10 @@ class OProc(object):
             # prevents that hanging
             self._stop_output_event = threading.Event()
 
-            self._output_thread_exc_queue = Queue(1)
+            self._output_thread_excs = []
             thread_name = "STDOUT/ERR thread for pid %d" % self.pid
             self._output_thread = _start_daemon_thread(output_thread,
-                    thread_name, self._output_thread_exc_queue, self.log,
+                    thread_name, self._output_thread_excs, self.log,
                     self._stdout_stream, self._stderr_stream,
                     self._timeout_event, self.is_alive, self._quit_threads,
                     self._stop_output_event)
@@ -2200,13 +4775,20 @@ class OProc(object):
         return "<Process %d %r>" % (self.pid, self.cmd[:500])
 
 
+    @property
+    def stdin(self):
+        if not self._stdin:
+            self._stdin = Queue()
+        return self._stdin
+
+
     # these next 3 properties are primary for tests
     @property
     def output_thread_exc(self):
         exc = None
         try:
-            exc = self._output_thread_exc_queue.get(False)
-        except Empty:
+            exc = self._output_thread_excs.pop()
+        except IndexError:
             pass
         return exc
 
@@ -2214,8 +4796,8 @@ class OProc(object):
     def input_thread_exc(self):
         exc = None
         try:
-            exc = self._input_thread_exc_queue.get(False)
-        except Empty:
+            exc = self._input_thread_excs.pop()
+        except IndexError:
             pass
         return exc
 
@@ -2223,8 +4805,8 @@ class OProc(object):
     def bg_thread_exc(self):
         exc = None
         try:
-            exc = self._bg_thread_exc_queue.get(False)
-        except Empty:
+            exc = self._bg_thread_excs.pop()
+        except IndexError:
             pass
         return exc
 
@@ -2310,7 +4892,7 @@ class OProc(object):
             # essentially polling the process.  the return result is (0, 0) if
             # there's no process status, so we check that pid == self.pid below
             # in order to determine how to proceed
-            pid, exit_code = no_interrupt(os.waitpid, self.pid, os.WNOHANG)
+            pid, exit_code = no_interrupt(self._waitpid, self.pid, os.WNOHANG)
             if pid == self.pid:
                 self.exit_code = handle_process_exit_code(exit_code)
                 self._process_just_ended()
@@ -2330,10 +4912,15 @@ class OProc(object):
         if self._timeout_timer:
             self._timeout_timer.cancel()
 
-        done_callback = self.call_args["done"]
-        if done_callback:
-            success = self.exit_code in self.call_args["ok_code"]
-            done_callback(success, self.exit_code)
+        try:
+            done_callback = self.call_args["done"]
+            if done_callback:
+                success = self.exit_code in self.call_args["ok_code"]
+                done_callback(success, self.exit_code)
+        finally:
+            limiter = self.command._limiter
+            if limiter:
+                limiter.release()
 
         # this can only be closed at the end of the process, because it might be
         # the CTTY, and closing it prematurely will send a SIGHUP.  we also
@@ -2353,40 +4940,199 @@ class OProc(object):
             self.log.debug("got wait lock")
             witnessed_end = False
 
-            if self.exit_code is None:
-                self.log.debug("exit code not set, waiting on pid")
-                pid, exit_code = no_interrupt(os.waitpid, self.pid, 0) # blocks
-                self.exit_code = handle_process_exit_code(exit_code)
-                witnessed_end = True
+            if self.exit_code is None:
+                self.log.debug("exit code not set, waiting on pid")
+                pid, exit_code = no_interrupt(self._waitpid, self.pid, 0) # blocks
+                self.exit_code = handle_process_exit_code(exit_code)
+                witnessed_end = True
+
+            else:
+                self.log.debug("exit code already set (%d), no need to wait",
+                        self.exit_code)
+
+            self._quit_threads.set()
+
+            # we may not have a thread for stdin, if the pipe has been connected
+            # via _piped="direct"
+            if self._input_thread:
+                self._input_thread.join()
+
+            # wait, then signal to our output thread that the child process is
+            # done, and we should have finished reading all the stdout/stderr
+            # data that we can by now
+            timer = threading.Timer(2.0, self._stop_output_event.set)
+            timer.start()
+
+            # wait for our stdout and stderr streamreaders to finish reading and
+            # aggregating the process output
+            self._output_thread.join()
+            timer.cancel()
+
+            if self._background_thread:
+                self._background_thread.join()
+
+            if witnessed_end:
+                self._process_just_ended()
+
+            return self.exit_code
+
+
+
+class FinishedProcess(object):
+    """ what a RunningCommand keeps of its OProc once the process has finished
+    and been waited on: the exit code, the output and a little about the
+    process.  the pipes, threads, queues and locks that the OProc needed while
+    the process ran are let go.  if `freeze` is true, the output is joined into
+    one bytes object, instead of the chunks it was read in """
+
+    __slots__ = ("call_args", "cmd", "pid", "sid", "pgid", "ctty", "started",
+            "timed_out", "exit_code", "_stdout", "_stderr", "_pipe",
+            "_thread_excs")
+
+    def __init__(self, process, freeze=False):
+        self.call_args = process.call_args
+        self.cmd = process.cmd
+        self.pid = process.pid
+        self.sid = process.sid
+        self.pgid = process.pgid
+        self.ctty = process.ctty
+        self.started = process.started
+        self.timed_out = process.timed_out
+        self.exit_code = process.exit_code
+
+        self._stdout = process._stdout
+        self._stderr = process._stderr
+
+        # what's left in the pipe queue is usually every chunk of our stdout
+        # (or stderr, for _iter="err") followed by a None.  in that case we
+        # make the queue again from our output, if it's ever asked for.
+        # otherwise, someone may be partway through reading it, so we keep it
+        queue = process._pipe_queue
+        with queue.mutex:
+            pending = list(queue.queue)
+
+        self._pipe = None
+        if pending:
+            self._pipe = queue
+            ended = pending[-1] is None
+            if ended:
+                pending.pop()
+
+            replayable = (("out", self._stdout, process._stdout_stream),
+                    ("err", self._stderr, process._stderr_stream))
+            for which, output, stream in replayable:
+                if len(output) != len(pending):
+                    continue
+
+                # a pipe that only got our output once it had ended got all of
+                # it, so if nothing's been read, it's the same.  compressed
+                # output would have to be decompressed to check otherwise
+                kept = stream and stream.pipe_kept
+                if not kept and not all(a is b for a, b in zip(pending,
+                        output)):
+                    continue
+
+                # once frozen, we only know where lines end, so the chunks
+                # can only be made again if they were lines
+                compressed = isinstance(output, CompressedBuffer)
+                if freeze and not compressed and stream and \
+                        stream.stream_bufferer.type != 1:
+                    break
+                self._pipe = (which, ended)
+                break
+
+        # compressed output is already smaller than frozen output would be
+        if freeze:
+            if not isinstance(self._stdout, CompressedBuffer):
+                self._stdout = self.stdout
+            if not isinstance(self._stderr, CompressedBuffer):
+                self._stderr = self.stderr
+
+        excs = (process._input_thread_excs, process._output_thread_excs,
+                process._bg_thread_excs)
+        self._thread_excs = excs if any(excs) else None
+
+    def __repr__(self):
+        return "<Process %d %r>" % (self.pid, self.cmd[:500])
+
+    def _join(self, output):
+        if not isinstance(output, bytes):
+            output = "".encode(self.call_args["encoding"]).join(output)
+        return output
+
+    @property
+    def stdout(self):
+        return self._join(self._stdout)
+
+    @property
+    def stderr(self):
+        return self._join(self._stderr)
+
+    @property
+    def _pipe_queue(self):
+        pipe = self._pipe
+        if pipe is None or isinstance(pipe, tuple):
+            queue = Queue()
+            if pipe is not None:
+                which, ended = pipe
+                output = self._stdout if which == "out" else self._stderr
+                if isinstance(output, bytes):
+                    nl = "\n".encode(self.call_args["encoding"])
+                    output = [line + nl for line in output.split(nl)]
+                    output[-1] = output[-1][:-len(nl)]
+                    if not output[-1]:
+                        output.pop()
+
+                for chunk in output:
+                    queue.put(chunk)
+                if ended:
+                    queue.put(None)
+            self._pipe = pipe = queue
+        return pipe
+
+    def _thread_exc(self, i):
+        exc = None
+        if self._thread_excs:
+            try:
+                exc = self._thread_excs[i].pop()
+            except IndexError:
+                pass
+        return exc
+
+    @property
+    def input_thread_exc(self):
+        return self._thread_exc(0)
 
-            else:
-                self.log.debug("exit code already set (%d), no need to wait",
-                        self.exit_code)
+    @property
+    def output_thread_exc(self):
+        return self._thread_exc(1)
 
-            self._quit_threads.set()
+    @property
+    def bg_thread_exc(self):
+        return self._thread_exc(2)
 
-            # we may not have a thread for stdin, if the pipe has been connected
-            # via _piped="direct"
-            if self._input_thread:
-                self._input_thread.join()
+    def signal(self, sig):
+        # our process has been waited on, so its pid may already belong to
+        # some other process
+        raise OSError(errno.ESRCH, os.strerror(errno.ESRCH))
 
-            # wait, then signal to our output thread that the child process is
-            # done, and we should have finished reading all the stdout/stderr
-            # data that we can by now
-            timer = threading.Timer(2.0, self._stop_output_event.set)
-            timer.start()
+    def signal_group(self, sig):
+        self.signal(sig)
 
-            # wait for our stdout and stderr streamreaders to finish reading and
-            # aggregating the process output
-            self._output_thread.join()
-            timer.cancel()
+    def kill(self):
+        self.signal(signal.SIGKILL)
+
+    def kill_group(self):
+        self.signal(signal.SIGKILL)
 
-            self._background_thread.join()
+    def terminate(self):
+        self.signal(signal.SIGTERM)
 
-            if witnessed_end:
-                self._process_just_ended()
+    def wait(self):
+        return self.exit_code
 
-            return self.exit_code
+    def is_alive(self):
+        return False, self.exit_code
 
 
 
@@ -2416,14 +5162,24 @@ def input_thread(log, stdin, is_alive, quit, close_before_term):
 
         alive, _ = is_alive()
 
-    while alive:
-        quit.wait(1)
-        alive, _ = is_alive()
+    wait_for_exit(alive, is_alive, quit)
 
     if not closed:
         stdin.close()
 
 
+def wait_for_exit(alive, is_alive, quit):
+    """ blocks until is_alive() reports that our process has exited, or until
+    someone else has waited on it.  by the time we get here, our process has
+    usually closed its streams and is about to exit, so we poll quickly at
+    first and back off to once a second for processes that linger """
+    interval = 0.001
+    while alive:
+        quit.wait(interval)
+        interval = min(interval * 2, 1)
+        alive, _ = is_alive()
+
+
 def event_wait(ev, timeout=None):
     triggered = ev.wait(timeout)
     if IS_PY26:
@@ -2499,9 +5255,7 @@ def output_thread(log, stdout, stderr, timeout_event, is_alive, quit,
     # we need to wait until the process is guaranteed dead before closing our
     # outputs, otherwise SIGPIPE
     alive, _ = is_alive()
-    while alive:
-        quit.wait(1)
-        alive, _ = is_alive()
+    wait_for_exit(alive, is_alive, quit)
 
     if stdout:
         stdout.close()
@@ -2670,12 +5424,265 @@ def bufsize_type_to_bufsize(bf_type):
     return bufsize
 
 
+def parse_keep_policy(keep):
+    """ turns a policy like ("head", 1000, "tail", 1000) into the number of
+    bytes to keep from the head and from the tail """
+    if not isinstance(keep, (tuple, list)) or not keep or len(keep) % 2:
+        raise TypeError("must be a tuple like (\"head\", 1000, \"tail\", 1000)")
+
+    sizes = {"head": 0, "tail": 0}
+    for i in range(0, len(keep), 2):
+        where, size = keep[i:i + 2]
+        if where not in sizes:
+            raise ValueError("can only keep the \"head\" or the \"tail\", \
+not %r" % (where,))
+        if not isinstance(size, (int, long)) or size < 0:
+            raise ValueError("needs a number of bytes to keep, not %r" % (size,))
+        sizes[where] = size
+    return sizes["head"], sizes["tail"]
+
+
+class HeadTailBuffer(object):
+    """ stands in for the deque that an OProc keeps its stdout or stderr in,
+    when it should only keep the first `head` and the last `tail` bytes.  the
+    tail is a ring of chunks, so we never hold much more than head + tail
+    bytes.  iterating over us gives the kept chunks, with a marker chunk where
+    output was dropped """
+
+    __slots__ = ("head_size", "tail_size", "dropped", "encoding", "_head",
+            "_head_count", "_tail", "_tail_count", "_marker")
+
+    def __init__(self, keep, encoding=DEFAULT_ENCODING):
+        self.head_size, self.tail_size = parse_keep_policy(keep)
+        self.encoding = encoding
+
+        # how many bytes were in neither the head nor the tail
+        self.dropped = 0
+
+        self._head = []
+        self._head_count = 0
+        self._tail = deque()
+        self._tail_count = 0
+
+        # (dropped, chunk).  the same marker chunk is given out until more
+        # is dropped
+        self._marker = None
+
+    def __repr__(self):
+        return "<HeadTailBuffer head=%d tail=%d dropped=%d>" % (self.head_size,
+                self.tail_size, self.dropped)
+
+    def append(self, chunk):
+        room = self.head_size - self._head_count
+        if room > 0:
+            if len(chunk) > room:
+                head, chunk = chunk[:room], chunk[room:]
+            else:
+                head, chunk = chunk, chunk[:0]
+            self._head.append(head)
+            self._head_count += len(head)
+            if not chunk:
+                return
+
+        if not self.tail_size:
+            self.dropped += len(chunk)
+            return
+
+        self._tail.append(chunk)
+        self._tail_count += len(chunk)
+
+        # drop whole chunks off the front of the tail, then trim what's left
+        while self._tail_count - len(self._tail[0]) >= self.tail_size:
+            first = self._tail.popleft()
+            self._tail_count -= len(first)
+            self.dropped += len(first)
+
+        over = self._tail_count - self.tail_size
+        if over > 0:
+            self._tail[0] = self._tail[0][over:]
+            self._tail_count -= over
+            self.dropped += over
+
+    def marker(self):
+        """ the chunk that stands in for the dropped output, or None if
+        nothing has been dropped """
+        if not self.dropped:
+            return None
+        if self._marker is None or self._marker[0] != self.dropped:
+            chunk = ("\n... (%d bytes dropped) ...\n" % self.dropped)
+            self._marker = (self.dropped, chunk.encode(self.encoding))
+        return self._marker[1]
+
+    def __iter__(self):
+        # copies, because the reader thread may still be appending to us
+        chunks = list(self._head)
+        marker = self.marker()
+        if marker is not None:
+            chunks.append(marker)
+        chunks.extend(list(self._tail))
+        return iter(chunks)
+
+    def __len__(self):
+        return len(self._head) + len(self._tail) + bool(self.dropped)
+
+
+class CompressionThread(object):
+    """ compresses the chunks it's given on a thread of its own, so that
+    whoever gives them to us, usually a StreamReader's thread, never waits on
+    the compressor.  what comes out of the compressor is handed to `write`,
+    from our thread.  chunks that arrive while we're busy are compressed
+    together, in one go """
+
+    __slots__ = ("compressor", "write", "exc", "_pending", "_closed",
+            "_finished", "_ready", "_busy", "_thread")
+
+    def __init__(self, compressor, write):
+        self.compressor = compressor
+        self.write = write
+        self.exc = None
+
+        self._pending = []
+        self._closed = False
+        # once the compressor has been flushed, it can't be used again
+        self._finished = False
+        self._ready = threading.Condition(threading.Lock())
+
+        # held while a batch is on its way from _pending through the
+        # compressor, so that snapshot() never catches it in neither place
+        self._busy = threading.Lock()
+
+        self._thread = threading.Thread(target=self._run, name="compression")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, chunk):
+        with self._ready:
+            self._pending.append(chunk)
+            self._ready.notify()
+
+    def _run(self):
+        while True:
+            with self._ready:
+                while not self._pending and not self._closed:
+                    self._ready.wait()
+
+            with self._busy:
+                with self._ready:
+                    batch, self._pending = self._pending, []
+                    closed = self._closed
+
+                # after a failure we keep taking chunks, so that put() and
+                # close() still work, but there's no point compressing them
+                if self.exc is None:
+                    try:
+                        if batch:
+                            out = self.compressor.compress(b"".join(batch))
+                            if out:
+                                self.write(out)
+                        if closed:
+                            self._finished = True
+                            self.write(self.compressor.flush())
+                    except Exception as e:
+                        self.exc = e
+
+            if closed:
+                return
+
+    def close(self):
+        """ compresses what's left, finishes the compressed stream, and waits
+        for all of it to be written """
+        with self._ready:
+            self._closed = True
+            self._ready.notify()
+        self._thread.join()
+        if self.exc is not None:
+            raise self.exc
+
+    def snapshot(self, finish):
+        """ calls finish(compressor, pending) while nothing is being
+        compressed, where pending is the chunks that haven't been yet.  the
+        compressor is None if it has already been flushed """
+        with self._busy:
+            if self.exc is not None:
+                raise self.exc
+            with self._ready:
+                pending = list(self._pending)
+            compressor = None if self._finished else self.compressor
+            return finish(compressor, pending)
+
+
+class CompressedBuffer(object):
+    """ stands in for the deque that an OProc keeps its stdout or stderr in,
+    keeping it zlib-compressed.  chunks are compressed on a CompressionThread,
+    so reading the output isn't slowed down, and the output is only
+    decompressed when it's asked for, as one chunk.  the thread is only
+    started once there's output, so a buffer that never gets any, like
+    stderr's with _err_to_out, costs nothing """
+
+    __slots__ = ("level", "bytes", "_compressed", "_compression")
+
+    def __init__(self, level=1):
+        self.level = level
+        self.bytes = 0
+        self._compressed = []
+        self._compression = None
+
+    def __repr__(self):
+        return "<CompressedBuffer bytes=%d compressed=%d>" % (self.bytes,
+                self.compressed_size)
+
+    @property
+    def compressed_size(self):
+        return sum(len(piece) for piece in self._compressed)
+
+    def append(self, chunk):
+        if self._compression is None:
+            import zlib
+            self._compression = CompressionThread(zlib.compressobj(self.level),
+                    self._compressed.append)
+        self.bytes += len(chunk)
+        self._compression.put(chunk)
+
+    def close(self):
+        if self._compression is None:
+            return
+        self._compression.close()
+        # a compressor holds on to a lot of memory, even after it's finished,
+        # so once we're done with it, we let it and its thread go
+        self._compressed[:] = [b"".join(self._compressed)]
+        self._compression = None
+
+    def _decompress(self, compressor, pending):
+        import zlib
+        compressed = list(self._compressed)
+        # a copy of a compressor that's still going can be finished off
+        # without disturbing the original
+        if compressor is not None:
+            compressed.append(compressor.copy().flush())
+        return [zlib.decompress(b"".join(compressed))] + pending
+
+    def __iter__(self):
+        if not self.bytes:
+            return iter([])
+        compression = self._compression
+        if compression is None:
+            chunks = self._decompress(None, [])
+        else:
+            chunks = compression.snapshot(self._decompress)
+        return iter([b"".join(chunks)])
+
+    def __len__(self):
+        return 1 if self.bytes else 0
+
 
 class StreamWriter(object):
     """ StreamWriter reads from some input (the stdin param) and writes to a fd
     (the stream param).  the stdin may be a Queue, a callable, something with
     the "read" method, a string, or an iterable """
 
+    __slots__ = ("stream", "stdin", "log", "encoding", "tty_in",
+            "stream_bufferer", "get_chunk")
+
     def __init__(self, log, stream, stdin, bufsize_type, encoding, tty_in):
 
         self.stream = stream
@@ -2716,6 +5723,7 @@ class StreamWriter(object):
             if self.tty_in:
                 # EOF time
                 try:
+                    import termios
                     char = termios.tcgetattr(self.stream)[6][termios.VEOF]
                 except:
                     char = chr(4).encode()
@@ -2774,8 +5782,249 @@ class StreamWriter(object):
         os.close(self.stream)
 
 
+class Sink(object):
+    """ the base for sinks: things that _out or _err can be pointed at, which
+    see every chunk of output, as bytes, but don't keep it.  they're fed
+    straight from the StreamReader, with no decoding, and once the command
+    has finished, they have the answer in `result`.  a sink adds up output
+    across every stream and command that it's given to, so give each stream
+    its own sink unless that's what you want.
+
+    a sink's class defines `update(chunk)`, which is called with each chunk,
+    and `result`, usually a property.  it can also define `finish()`, which is
+    called when the stream it's fed from has closed.  a subclass must call
+    Sink.__init__, which makes sure that it has both """
+
+    __slots__ = ()
+
+    def __init__(self):
+        for name in ("update", "result"):
+            if not hasattr(self.__class__, name):
+                raise TypeError("%s is a Sink, so it must define %s"
+                        % (self.__class__.__name__, name))
+
+    def finish(self):
+        pass
+
+    def __repr__(self):
+        return "<%s %r>" % (self.__class__.__name__, self.result)
+
+
+class HashSink(Sink):
+    """ a hash of the output, with any algorithm hashlib knows about:
+
+        h = sh._sinks.Hash("sha256")
+        sh.tar("c", "src", _out=h, _tty_out=False)
+        h.hexdigest() """
+
+    __slots__ = ("name", "_hash")
+
+    def __init__(self, name="sha256"):
+        import hashlib
+        super(HashSink, self).__init__()
+        self.name = name
+        self._hash = hashlib.new(name)
+
+    def update(self, chunk):
+        self._hash.update(chunk)
+
+    def digest(self):
+        return self._hash.digest()
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+    @property
+    def result(self):
+        return self.hexdigest()
+
+
+class CountSink(Sink):
+    """ counts bytes and lines of output.  like `wc -l`, lines are counted by
+    their newlines, so a last line without one isn't counted """
+
+    __slots__ = ("bytes", "lines")
+
+    def __init__(self):
+        super(CountSink, self).__init__()
+        self.bytes = 0
+        self.lines = 0
+
+    def update(self, chunk):
+        self.bytes += len(chunk)
+        self.lines += chunk.count(b"\n")
+
+    @property
+    def result(self):
+        return {"bytes": self.bytes, "lines": self.lines}
+
+
+class LineLengthHistogramSink(Sink):
+    """ counts lines by their length, not including the newline.  lengths are
+    put into buckets `bucket` bytes wide, keyed on the smallest length in the
+    bucket.  lines may be split across chunks, so we carry the length of an
+    unfinished line over to the next chunk """
+
+    __slots__ = ("bucket", "counts", "_partial")
+
+    def __init__(self, bucket=1):
+        if bucket < 1:
+            raise ValueError("bucket must be at least 1")
+        super(LineLengthHistogramSink, self).__init__()
+        self.bucket = bucket
+        self.counts = {}
+        self._partial = 0
+
+    def _add(self, length):
+        key = length - length % self.bucket
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+    def update(self, chunk):
+        lines = chunk.split(b"\n")
+        if len(lines) == 1:
+            self._partial += len(chunk)
+            return
+
+        self._add(self._partial + len(lines[0]))
+        for line in lines[1:-1]:
+            self._add(len(line))
+        self._partial = len(lines[-1])
+
+    def finish(self):
+        if self._partial:
+            self._add(self._partial)
+            self._partial = 0
+
+    @property
+    def result(self):
+        return dict(self.counts)
+
+
+def new_gzip_compressor(level):
+    import zlib
+    # 16 more window bits asks zlib for a gzip header and trailer
+    return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+def new_bz2_compressor(level):
+    import bz2
+    return bz2.BZ2Compressor(level)
+
+def new_lzma_compressor(level):
+    import lzma
+    return lzma.LZMACompressor(preset=level)
+
+
+class CompressedSink(Sink):
+    """ compresses the output into a file, given by its name or as something
+    with a write method.  `new_compressor(level)` makes the compressor, which
+    is anything with the compress and flush methods of zlib's compressobj.
+    the compressing happens on a thread of its own, so it doesn't hold up
+    reading the output.  the file is finished, and closed if we opened it,
+    when the stream we're fed from closes, so a compressed sink can only be
+    used for one stream """
+
+    __slots__ = ("bytes", "compressed_bytes", "_file", "_opened",
+            "_new_compressor", "_level", "_compression")
+
+    def __init__(self, out, new_compressor, level):
+        super(CompressedSink, self).__init__()
+        self._opened = output_redirect_is_filename(out)
+        if self._opened:
+            out = open(str(out), "wb")
+        self._file = out
+        self._new_compressor = new_compressor
+        self._level = level
+
+        # we don't start a thread until there's output to compress
+        self._compression = None
+
+        self.bytes = 0
+        self.compressed_bytes = 0
+
+    def _write(self, data):
+        self.compressed_bytes += len(data)
+        self._file.write(data)
+
+    def _start(self):
+        if self._compression is None:
+            self._compression = CompressionThread(
+                    self._new_compressor(self._level), self._write)
+        return self._compression
+
+    def update(self, chunk):
+        self.bytes += len(chunk)
+        self._start().put(chunk)
+
+    def finish(self):
+        try:
+            self._start().close()
+        finally:
+            if self._opened:
+                self._file.close()
+            elif hasattr(self._file, "flush"):
+                self._file.flush()
+
+    @property
+    def result(self):
+        return {"bytes": self.bytes, "compressed_bytes": self.compressed_bytes}
+
+
+class GzipSink(CompressedSink):
+    """ sh._sinks.Gzip("out.csv.gz", level=3) """
+
+    __slots__ = ()
+
+    def __init__(self, out, level=9):
+        super(GzipSink, self).__init__(out, new_gzip_compressor, level)
+
+
+class Bz2Sink(CompressedSink):
+    __slots__ = ()
+
+    def __init__(self, out, level=9):
+        super(Bz2Sink, self).__init__(out, new_bz2_compressor, level)
+
+
+class LzmaSink(CompressedSink):
+    """ needs python 3.3 or later, for the lzma module.  `level` is an xz
+    preset, 0 to 9 """
+
+    __slots__ = ()
+
+    def __init__(self, out, level=6):
+        super(LzmaSink, self).__init__(out, new_lzma_compressor, level)
+
+
+def get_chunk_filter(filt, encoding, decode_errors):
+    """ returns a function that says whether a chunk of output should be let
+    through, for an _out_filter or _err_filter """
+    if filt is None:
+        return None
+
+    if isinstance(filt, (basestring, bytes)):
+        filt = re.compile(filt)
+
+    if not hasattr(filt, "search"):
+        return filt
+
+    # a regex of text, and not bytes, has to search the decoded chunk
+    if isinstance(filt.pattern, bytes):
+        return filt.search
+
+    def fn(chunk):
+        return filt.search(chunk.decode(encoding, decode_errors))
+    return fn
+
+
 def determine_how_to_feed_output(handler, encoding, decode_errors):
-    if callable(handler):
+    if isinstance(handler, Sink):
+        process, finish = get_sink_chunk_consumer(handler)
+
+    elif isinstance(handler, (list, tuple)):
+        process, finish = get_multi_chunk_consumer(handler, encoding,
+                decode_errors)
+
+    elif callable(handler):
         process, finish = get_callback_chunk_consumer(handler, encoding,
                 decode_errors)
 
@@ -2791,6 +6040,11 @@ def determine_how_to_feed_output(handler, encoding, decode_errors):
     elif hasattr(handler, "write"):
         process, finish = get_file_chunk_consumer(handler)
 
+    # a Queue gets what a callback would
+    elif hasattr(handler, "put"):
+        process, finish = get_callback_chunk_consumer(handler.put, encoding,
+                decode_errors)
+
     else:
         try:
             handler = int(handler)
@@ -2803,11 +6057,69 @@ def determine_how_to_feed_output(handler, encoding, decode_errors):
     return process, finish
 
 
+def get_sink(handler):
+    """ the sink an _out or _err handler feeds, or the first sink in a list of
+    handlers """
+    for h in output_handlers(handler):
+        if isinstance(h, Sink):
+            return h
+    return None
+
+
+def get_multi_chunk_consumer(handlers, encoding, decode_errors):
+    """ feeds each chunk to every one of handlers, in order.  a handler that
+    asks to quit doesn't get any more chunks, and we quit when they all have
+    """
+    consumers = [determine_how_to_feed_output(h, encoding, decode_errors)
+            for h in handlers]
+    processors = [process for process, finish in consumers]
+
+    def process(chunk):
+        quitting = [fn for fn in processors if fn(chunk)]
+        for fn in quitting:
+            processors.remove(fn)
+        return not processors
+
+    def finish():
+        for process, finish in consumers:
+            finish()
+
+    return process, finish
+
+def get_sink_chunk_consumer(handler):
+    update = handler.update
+    def process(chunk):
+        update(chunk)
+        return False
+    return process, handler.finish
+
 def get_fd_chunk_consumer(handler):
-    handler = fdopen(handler, "w", closefd=False)
-    return get_file_chunk_consumer(handler)
+    """ writes chunks straight to the fd, bytes as they are, with nothing in
+    between to buffer or flush """
+    def process(chunk):
+        # on a pipe or a socket, os.write may not write everything we gave it
+        while chunk:
+            written = no_interrupt(os.write, handler, chunk)
+            chunk = chunk[written:]
+        return False
+
+    finish = lambda: None
+    return process, finish
 
 def get_file_chunk_consumer(handler):
+    """ a binary file is written through its fd, like an fd is, after
+    flushing whatever it had buffered, so that comes first.  anything else
+    with a write method is written to, and flushed, chunk by chunk.  that
+    includes text files, since they may have another encoding than our
+    output, or translate newlines.  it also includes file-likes that aren't
+    real files, even if they have a fileno(), because fileno() can have side
+    effects, like a SpooledTemporaryFile rolling over to disk """
+    if isinstance(handler, raw_file_types):
+        fileno = get_fileno(handler)
+        if fileno is not None:
+            handler.flush()
+            return get_fd_chunk_consumer(fileno)
+
     encode = lambda chunk: chunk
     if getattr(handler, "encoding", None):
         encode = lambda chunk: chunk.decode(handler.encoding)
@@ -2868,11 +6180,25 @@ def get_stringio_chunk_consumer(handler, encoding, decode_errors):
 class StreamReader(object):
     """ reads from some output (the stream) and sends what it just read to the
     handler.  """
+
+    __slots__ = ("stream", "buffer", "save_data", "encoding", "decode_errors",
+            "pipe_queue", "pipe_kept", "chunk_filter", "log", "stream_bufferer",
+            "bufsize", "process_chunk", "finish_chunk_processor", "should_quit")
+
     def __init__(self, log, stream, handler, buffer, bufsize_type, encoding,
-            decode_errors, pipe_queue=None, save_data=True):
+            decode_errors, pipe_queue=None, save_data=True, pipe_kept=False,
+            chunk_filter=None):
         self.stream = stream
         self.buffer = buffer
         self.save_data = save_data
+
+        # if true, the pipe queue only gets what's in our buffer, when we
+        # close, instead of every chunk as it comes
+        self.pipe_kept = pipe_kept
+
+        # if set, chunks that this returns false for are dropped before
+        # anything else sees them
+        self.chunk_filter = chunk_filter
         self.encoding = encoding
         self.decode_errors = decode_errors
 
@@ -2905,8 +6231,18 @@ class StreamReader(object):
 
         self.finish_chunk_processor()
 
+        # a buffer that does work of its own, like compressing, is told that
+        # there's nothing more coming
+        close_buffer = getattr(self.buffer, "close", None)
+        if close_buffer is not None:
+            close_buffer()
+
         if self.pipe_queue and self.save_data:
-            self.pipe_queue().put(None)
+            pipe_queue = self.pipe_queue()
+            if self.pipe_kept:
+                for chunk in self.buffer:
+                    pipe_queue.put(chunk)
+            pipe_queue.put(None)
 
         os.close(self.stream)
 
@@ -2914,6 +6250,9 @@ class StreamReader(object):
     def write_chunk(self, chunk):
         # in PY3, the chunk coming in will be bytes, so keep that in mind
 
+        if self.chunk_filter and not self.chunk_filter(chunk):
+            return
+
         if not self.should_quit:
             self.should_quit = self.process_chunk(chunk)
 
@@ -2921,7 +6260,7 @@ class StreamReader(object):
         if self.save_data:
             self.buffer.append(chunk)
 
-            if self.pipe_queue:
+            if self.pipe_queue and not self.pipe_kept:
                 self.log.debug("putting chunk onto pipe: %r", chunk[:30])
                 self.pipe_queue().put(chunk)
 
@@ -2953,6 +6292,16 @@ class StreamBufferer(object):
     however they come in), OProc will use an instance of this class to chop up
     the data and feed it as lines to be sent down the pipe """
 
+    __slots__ = ("type", "buffer", "n_buffer_count", "encoding",
+            "decode_errors", "_use_up_buffer_first", "_buffering_lock")
+
+    # every bufferer logs with the same name and no context, so they can all
+    # share one
+    log = Logger("stream_bufferer")
+
+    # only for creating the buffering locks
+    _lock_creation_lock = threading.Lock()
+
     def __init__(self, buffer_type, encoding=DEFAULT_ENCODING,
             decode_errors="strict"):
         # 0 for unbuffered, 1 for line, everything else for that amount
@@ -2971,12 +6320,25 @@ class StreamBufferer(object):
         # the buffering lock is used because we might change the buffering
         # types from a different thread.  for example, if we have a stdout
         # callback, we might use it to change the way stdin buffers.  so we
-        # lock
-        self._buffering_lock = threading.RLock()
-        self.log = Logger("stream_bufferer")
+        # lock.  that's rare, so the lock is only made the first time that the
+        # buffering changes.  until then, there's nothing to lock against
+        self._buffering_lock = None
 
 
+    def _acquire(self):
+        """ returns the buffering lock, acquired, or None if the buffering has
+        never changed """
+        lock = self._buffering_lock
+        if lock is not None:
+            lock.acquire()
+        return lock
+
     def change_buffering(self, new_type):
+        if self._buffering_lock is None:
+            with self._lock_creation_lock:
+                if self._buffering_lock is None:
+                    self._buffering_lock = threading.RLock()
+
         # TODO, when we stop supporting 2.6, make this a with context
         self.log.debug("acquiring buffering lock for changing buffering")
         self._buffering_lock.acquire()
@@ -2997,11 +6359,15 @@ class StreamBufferer(object):
 
         # TODO, when we stop supporting 2.6, make this a with context
         self.log.debug("acquiring buffering lock to process chunk (buffering: %d)", self.type)
-        self._buffering_lock.acquire()
+        lock = self._acquire()
         self.log.debug("got buffering lock to process chunk (buffering: %d)", self.type)
+
+        # the buffering can change while we're running if we didn't have a
+        # lock to take, so we only look at it once
+        buffer_type = self.type
         try:
             # unbuffered
-            if self.type == 0:
+            if buffer_type == 0:
                 if self._use_up_buffer_first:
                     self._use_up_buffer_first = False
                     to_write = self.buffer
@@ -3012,7 +6378,7 @@ class StreamBufferer(object):
                 return [chunk]
 
             # line buffered
-            elif self.type == 1:
+            elif buffer_type == 1:
                 total_to_write = []
                 nl = "\n".encode(self.encoding)
                 while True:
@@ -3039,11 +6405,11 @@ class StreamBufferer(object):
             else:
                 total_to_write = []
                 while True:
-                    overage = self.n_buffer_count + len(chunk) - self.type
+                    overage = self.n_buffer_count + len(chunk) - buffer_type
                     if overage >= 0:
                         ret = "".encode(self.encoding).join(self.buffer) + chunk
-                        chunk_to_write = ret[:self.type]
-                        chunk = ret[self.type:]
+                        chunk_to_write = ret[:buffer_type]
+                        chunk = ret[buffer_type:]
                         total_to_write.append(chunk_to_write)
                         self.buffer = []
                         self.n_buffer_count = 0
@@ -3053,20 +6419,22 @@ class StreamBufferer(object):
                         break
                 return total_to_write
         finally:
-            self._buffering_lock.release()
+            if lock is not None:
+                lock.release()
             self.log.debug("released buffering lock for processing chunk (buffering: %d)", self.type)
 
 
     def flush(self):
         self.log.debug("acquiring buffering lock for flushing buffer")
-        self._buffering_lock.acquire()
+        lock = self._acquire()
         self.log.debug("got buffering lock for flushing buffer")
         try:
             ret = "".encode(self.encoding).join(self.buffer)
             self.buffer = []
             return ret
         finally:
-            self._buffering_lock.release()
+            if lock is not None:
+                lock.release()
             self.log.debug("released buffering lock for flushing buffer")
 
 
@@ -3145,6 +6513,9 @@ class Environment(dict):
         "NotYetReadyToRead",
         "SignalException",
         "ForkException",
+        "ForkServer",
+        "start_forkserver",
+        "stop_forkserver",
         "TimeoutException",
         "__project_url__",
         "__version__",
@@ -3153,6 +6524,18 @@ class Environment(dict):
         "pushd",
         "glob",
         "contrib",
+        "_sinks",
+        "_rehash",
+        "ARG",
+        "CompiledCommand",
+        "ConcurrencyLimiter",
+        "Coprocess",
+        "CoprocessPool",
+        "ResultCache",
+        "Session",
+        "set_max_concurrency",
+        "TaskGraph",
+        "DependencyFailed",
     ])
 
 
@@ -3266,17 +6649,223 @@ mod_name = __name__ + ".contrib"
 contrib = Contrib(mod_name)
 sys.modules[mod_name] = contrib
 
+# the built-in sinks, importable as "from sh.sinks import Hash", or as
+# sh._sinks, which is underscored so that it doesn't hide a "sinks" program
+_sinks = ModuleType(__name__ + ".sinks")
+_sinks.Sink = Sink
+_sinks.Hash = HashSink
+_sinks.Count = CountSink
+_sinks.LineLengthHistogram = LineLengthHistogramSink
+_sinks.Gzip = GzipSink
+_sinks.Bz2 = Bz2Sink
+_sinks.Lzma = LzmaSink
+sys.modules[_sinks.__name__] = _sinks
+
+
+class GitObjectReader(object):
+    """ reads objects out of a git repository through one long-running
+    `git cat-file --batch`, instead of a `git show` for every object.  git
+    objects never change, so everything read is also kept in an LRU cache,
+    keyed on the object id """
+
+    def __init__(self, git, repo, cache_size=4096):
+        self.repo = repo
+        self._coprocess = Coprocess(git.bake("-C", repo, "cat-file",
+            "--batch"), binary=True)
+        self._lock = threading.Lock()
+        self._cache = LRUCache(cache_size)
+
+    def __repr__(self):
+        return "<GitObjectReader %r>" % self.repo
+
+    @staticmethod
+    def _parse_header(line):
+        # a response starts with "<sha> <type> <size>", or "<name> missing" or
+        # "<name> ambiguous", where the name can have spaces of its own.
+        # returns None for the latter two
+        if line.endswith(b" missing") or line.endswith(b" ambiguous"):
+            return None
+        sha, obj_type, size = line.split(b" ")
+        return sha, obj_type, int(size)
+
+    @classmethod
+    def _response_end(cls, buf):
+        newline = buf.find(b"\n")
+        if newline == -1:
+            return None
+        header = cls._parse_header(bytes(buf[:newline]))
+        if header is None:
+            return newline + 1
+        # the contents are followed by a newline of their own
+        end = newline + 1 + header[2] + 1
+        if len(buf) < end:
+            return None
+        return end
+
+    def read(self, ref):
+        """ returns (sha, type, contents) for `ref`, which is anything
+        `git cat-file` understands, like a sha, "HEAD:README" or
+        "v1.0^{tree}" """
+        if not isinstance(ref, bytes):
+            ref = ref.encode(DEFAULT_ENCODING)
+        if b"\n" in ref:
+            raise ValueError("git object names can't contain newlines")
+
+        found = self.cached(ref)
+        if found:
+            return found
+
+        response = self._coprocess.request(ref + b"\n",
+                until=self._response_end)
+        newline = response.index(b"\n")
+        header = self._parse_header(response[:newline])
+        if header is None:
+            raise KeyError(ref.decode(DEFAULT_ENCODING))
+
+        sha, obj_type, size = header
+        obj = (sha.decode("ascii"), obj_type.decode("ascii"),
+                response[newline + 1:-1])
+        with self._lock:
+            self._cache.put(sha, obj)
+        return obj
+
+    def cached(self, ref):
+        """ returns (sha, type, contents) for `ref` if it's a full sha we've
+        already read, otherwise None.  only a full sha is sure to always mean
+        the same object """
+        if not isinstance(ref, bytes):
+            ref = ref.encode(DEFAULT_ENCODING)
+        if len(ref) != 40 or ref.strip(b"0123456789abcdef"):
+            return None
+        with self._lock:
+            return self._cache.get(ref)
+
+    def read_peeled(self, ref, obj_type):
+        """ like read, but peels `ref` down to an `obj_type`, the way
+        "<ref>^{<obj_type>}" does.  a tag or commit we already have is peeled
+        from the cache, by the sha in its first line, so only a miss asks git
+        to peel it.  anything else can't be peeled, so it's returned as it is,
+        for the caller to refuse """
+        found = self.cached(ref)
+        # a tag's first line is "object <sha>" and a commit's is "tree <sha>"
+        while found and found[1] != obj_type and (found[1] == "tag" or
+                (found[1] == "commit" and obj_type == "tree")):
+            found = self.cached(found[2].split(b"\n", 1)[0][-40:])
+        if found:
+            return found
+
+        if isinstance(ref, bytes):
+            ref = ref.decode(DEFAULT_ENCODING)
+        return self.read("%s^{%s}" % (ref, obj_type))
+
+    def close(self):
+        self._coprocess.close()
+
+
+# one GitObjectReader for each repository, by the repository's real path
+_git_readers = {}
+_git_readers_lock = threading.Lock()
+
+
+def get_git_reader(git, repo=None):
+    repo = os.path.realpath(repo or os.getcwd())
+    with _git_readers_lock:
+        reader = _git_readers.get(repo, None)
+        if reader is None:
+            reader = GitObjectReader(git, repo)
+            _git_readers[repo] = reader
+    return reader
+
+
+def _git_name(name):
+    # git paths are bytes.  in py3, surrogateescape lets a name that isn't in
+    # our encoding still make it back to the filesystem unchanged
+    if IS_PY3:
+        return name.decode(DEFAULT_ENCODING, "surrogateescape")
+    return name
+
 
 @contrib("git")
 def git(orig): # pragma: no cover
-    """ most git commands play nicer without a TTY """
+    """ most git commands play nicer without a TTY.  this also adds some
+    helpers for reading objects out of a repository (the current directory, by
+    default), which are much faster than running a git command for each
+    object:
+
+        git.read_blob("HEAD:README.rst")    # the file's contents, as bytes
+        git.read_tree("HEAD")               # [(mode, type, sha, name), ...]
+        git.read_commit("HEAD")             # {"tree": ..., "parents": [...]}
+    """
     cmd = orig.bake(_tty_out=False)
+
+    def read_object(ref, obj_type, repo, peel=False):
+        reader = get_git_reader(orig, repo)
+        if peel:
+            found = reader.read_peeled(ref, obj_type)
+        else:
+            found = reader.read(ref)
+        if found[1] != obj_type:
+            raise ValueError("%s is a %s, not a %s" % (ref, found[1], obj_type))
+        return found
+
+    def read_blob(ref, repo=None):
+        return read_object(ref, "blob", repo)[2]
+
+    def read_tree(ref, repo=None):
+        """ each entry of the tree is (mode, type, sha, name) """
+        import binascii
+        data = read_object(ref, "tree", repo, peel=True)[2]
+        entries = []
+        i = 0
+        while i < len(data):
+            space = data.index(b" ", i)
+            null = data.index(b"\0", space)
+            mode = data[i:space].decode("ascii")
+            sha = binascii.hexlify(data[null + 1:null + 21]).decode("ascii")
+
+            if mode == "40000":
+                entry_type = "tree"
+            elif mode == "160000":
+                entry_type = "commit"
+            else:
+                entry_type = "blob"
+
+            entries.append((mode, entry_type, sha,
+                _git_name(data[space + 1:null])))
+            i = null + 21
+        return entries
+
+    def read_commit(ref, repo=None):
+        """ returns a dict with the commit's "sha", "tree", "parents",
+        "author", "committer" and "message" """
+        sha, obj_type, data = read_object(ref, "commit", repo,
+                peel=True)
+        data = data.decode("utf8", "replace")
+        headers, _, message = data.partition("\n\n")
+
+        commit = {"sha": sha, "parents": [], "message": message}
+        for line in headers.split("\n"):
+            # a line starting with a space continues the previous header, like
+            # a signature.  we don't need those
+            if line.startswith(" "):
+                continue
+            key, _, value = line.partition(" ")
+            if key == "parent":
+                commit["parents"].append(value)
+            else:
+                commit[key] = value
+        return commit
+
+    cmd.read_blob = read_blob
+    cmd.read_tree = read_tree
+    cmd.read_commit = read_commit
     return cmd
 
 @contrib("sudo")
 def sudo(orig): # pragma: no cover
     """ a nicer version of sudo that uses getpass to ask for a password, or
     allows the first argument to be a string password """
+    import getpass
 
     prompt = "[sudo] password for %s: " % getpass.getuser()
 
@@ -3317,6 +6906,7 @@ def run_repl(env): # pragma: no cover
         except SystemExit:
             break
         except:
+            import traceback
             print(traceback.format_exc())
 
     # cleans up our last line
@@ -3351,9 +6941,6 @@ class SelfWrapper(ModuleType):
     def __call__(self, **kwargs):
         """ returns a new SelfWrapper object, where all commands spawned from it
         have the baked_args kwargs set on them by default """
-        baked_args = self.__env.baked_args.copy()
-        baked_args.update(kwargs)
-        new_mod = self.__class__(self.__self_module, baked_args)
 
         # inspect the line in the parent frame that calls and assigns the new sh
         # variable, and get the name of the new variable we're assigning to.
@@ -3363,15 +6950,50 @@ class SelfWrapper(ModuleType):
         # the reason we need to do this is because we need to remove the old
         # cached module from sys.modules.  if we don't, it gets re-used, and any
         # old baked params get used, which is not what we want
+        import ast
+        import inspect
+
         parent = inspect.stack()[1]
         code = parent[4][0].strip()
         parsed = ast.parse(code)
         module_name = parsed.body[0].targets[0].id
 
-        if module_name == __name__:
-            raise RuntimeError("Cannot use the name 'sh' as an execution context")
+        return self._context(module_name, **kwargs)
+
+    def _context(self, name=None, **kwargs):
+        """ like calling sh(**kwargs), but without inspecting the caller's
+        source to find out what variable the new context is being assigned
+        to, which is slow, and impossible if the source isn't around.  pass
+        that variable's name as `name` to be able to import from the context:
+
+            sh2 = sh._context("sh2", _timeout=3)
+            from sh2 import ls
+
+        it's underscored, like the special keyword arguments, so that
+        `sh.context` is still the "context" program.
+
+        without a name, commands can still be used as attributes of the
+        context, like `sh2.ls()`, and the context is cheap enough to create for
+        every request in a web handler """
+        baked_args = self.__env.baked_args.copy()
+        baked_args.update(kwargs)
+
+        # all of the commands in this execution context share one limit
+        max_concurrent = baked_args.get("_max_concurrent", None)
+        if max_concurrent is not None and \
+                not isinstance(max_concurrent, ConcurrencyLimiter):
+            baked_args["_max_concurrent"] = ConcurrencyLimiter(max_concurrent)
+
+        new_mod = self.__class__(self.__self_module, baked_args)
+
+        if name is not None:
+            if name == __name__:
+                raise RuntimeError("Cannot use the name 'sh' as an execution context")
+
+            sys.modules.pop(name, None)
 
-        sys.modules.pop(module_name, None)
+            add_live_context(name, new_mod)
+            register_importer()
 
         return new_mod
 
@@ -3381,6 +7003,35 @@ def in_importlib(frame):
     return frame.f_code.co_filename == "<frozen importlib._bootstrap>"
 
 
+# weakrefs to the named execution contexts that are alive, by name, so that
+# our importer can turn away an import of any other name with one lookup,
+# without inspecting any frames.  it's a plain dict, because a
+# WeakValueDictionary lookup is several times slower
+_live_contexts = {}
+
+
+def add_live_context(name, context):
+    def forget(ref):
+        # a newer context may have taken the name since
+        if _live_contexts.get(name) is ref:
+            _live_contexts.pop(name, None)
+    _live_contexts[name] = weakref.ref(context, forget)
+
+
+def could_be_context(mod_fullname, path, any_name=False):
+    """ a quick check of whether an import could be from an execution context,
+    before looking for one in the importer's frame.  a context is a variable,
+    so it's never a submodule of a package.  normally, the import has to be of
+    a name that a live context was created with.  with `any_name`, it can be
+    of any variable that a context has been assigned to since, like `omg` in
+    `omg = sh2`, as long as some named context is alive """
+    if path is not None or "." in mod_fullname:
+        return False
+    if any_name:
+        return len(_live_contexts) > 0
+    return mod_fullname in _live_contexts
+
+
 def register_importer():
     """ registers our fancy importer that can let us import from a module name,
     like:
@@ -3388,6 +7039,13 @@ def register_importer():
         import sh
         tmp = sh()
         from tmp import ls
+
+    this happens when the first execution context is created, so that nothing
+    else being imported has to pass through our importer before then.  the
+    importer at the front only looks for contexts by the names they were
+    created with.  a second one, at the back, finds contexts that have been
+    assigned to other variables, once every other finder has failed, so that
+    imports of real modules never have to inspect frames for them
     """
 
     def test(importer):
@@ -3399,9 +7057,14 @@ def register_importer():
             restrict_to=["SelfWrapper"],
         )
         sys.meta_path.insert(0, importer)
+        importer = ModuleImporterFromVariables(
+            restrict_to=["SelfWrapper"], any_name=True,
+        )
+        sys.meta_path.append(importer)
 
     return not already_registered
 
+
 def fetch_module_from_frame(name, frame):
     mod = frame.f_locals.get(name, frame.f_globals.get(name, None))
     return mod
@@ -3415,11 +7078,12 @@ class ModuleImporterFromVariables(object):
     
     """
 
-    def __init__(self, restrict_to=None):
+    def __init__(self, restrict_to=None, any_name=False):
         self.restrict_to = set(restrict_to or set())
+        self.any_name = any_name
 
 
-    def find_module(self, mod_fullname, path=None):
+    def _find(self, mod_fullname, frame):
         """ mod_fullname doubles as the name of the VARIABLE holding our new sh
         context.  for example:
 
@@ -3429,15 +7093,14 @@ class ModuleImporterFromVariables(object):
         here, mod_fullname will be "derp".  keep that in mind as we go throug
         the rest of this function """
 
-        parent_frame = inspect.currentframe().f_back
-        while in_importlib(parent_frame):
-            parent_frame = parent_frame.f_back
+        while in_importlib(frame):
+            frame = frame.f_back
 
         # this line is saying "hey, does mod_fullname exist as a name we've
         # defind previously?"  the purpose of this is to ensure that
         # mod_fullname is really a thing we've defined.  if we haven't defined
         # it before, then we "can't" import from it
-        module = fetch_module_from_frame(mod_fullname, parent_frame)
+        module = fetch_module_from_frame(mod_fullname, frame)
         if not module:
             return None
 
@@ -3445,11 +7108,41 @@ class ModuleImporterFromVariables(object):
         if module.__class__.__name__ not in self.restrict_to:
             return None
 
+        return module
+
+
+    def find_spec(self, mod_fullname, path=None, target=None):
+        """ the python >= 3.4 import protocol """
+        if not could_be_context(mod_fullname, path, self.any_name):
+            return None
+
+        module = self._find(mod_fullname, sys._getframe(1))
+        if module is None:
+            return None
+
+        from importlib.machinery import ModuleSpec
+        return ModuleSpec(mod_fullname, self, loader_state=module)
+
+
+    def create_module(self, spec):
+        return spec.loader_state
+
+
+    def exec_module(self, module):
+        pass
+
+
+    def find_module(self, mod_fullname, path=None):
+        if not could_be_context(mod_fullname, path, self.any_name):
+            return None
+
+        if self._find(mod_fullname, sys._getframe(1)) is None:
+            return None
         return self
 
 
     def load_module(self, mod_fullname):
-        parent_frame = inspect.currentframe().f_back
+        parent_frame = sys._getframe(1)
 
         while in_importlib(parent_frame):
             parent_frame = parent_frame.f_back
@@ -3580,5 +7273,7 @@ if __name__ == "__main__": # pragma: no cover
 else:
     self = sys.modules[__name__]
     sys.modules[__name__] = SelfWrapper(self)
-    register_importer()
+
+    if os.environ.get("SH_FORKSERVER"):
+        start_forkserver()
 
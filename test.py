@@ -49,6 +49,7 @@ from contextlib import contextmanager
 import sh
 import signal
 import errno
+import socket
 import stat
 import platform
 from functools import wraps
@@ -564,6 +565,73 @@ print("hi")
         self.assertEqual(found_path, py.name)
 
 
+    def test_which_cache(self):
+        from sh import which, _rehash as rehash
+        bin_dir = tempfile.mkdtemp()
+        prog = join(bin_dir, "some-program")
+        try:
+            self.assertEqual(which("some-program", [bin_dir]), None)
+
+            # adding a program modifies the directory, which invalidates the
+            # negative result we just cached
+            with open(prog, "w") as h:
+                h.write("#!/bin/sh\n")
+            os.chmod(prog, int(0o755))
+            self.assertEqual(which("some-program", [bin_dir]), prog)
+
+            # positive results are remembered until we rehash, like the shell
+            os.unlink(prog)
+            self.assertEqual(which("some-program", [bin_dir]), prog)
+            rehash()
+            self.assertEqual(which("some-program", [bin_dir]), None)
+        finally:
+            if exists(prog):
+                os.unlink(prog)
+            os.rmdir(bin_dir)
+
+
+    @skip_unless(HAS_MOCK, "requires unittest.mock")
+    def test_which_cache_resolved(self):
+        from sh import _rehash as rehash
+        resolve_command_path = sh.Command.__init__.__globals__[
+                "resolve_command_path"]
+        bin_dir = tempfile.mkdtemp()
+        prog = join(bin_dir, "some-program")
+        with open(prog, "w") as h:
+            h.write("#!/bin/sh\n")
+        os.chmod(prog, int(0o755))
+        self.addCleanup(os.rmdir, bin_dir)
+        self.addCleanup(os.unlink, prog)
+        self.addCleanup(rehash)
+
+        with unittest.mock.patch.dict(os.environ, {"PATH": bin_dir}):
+            self.assertEqual(resolve_command_path("some_program"), prog)
+
+            # the name was found by its dashed version, and looking it up
+            # again doesn't touch the filesystem at all
+            syscalls = []
+            def counted(fn):
+                def wrapper(*args, **kwargs):
+                    syscalls.append(fn.__name__)
+                    return fn(*args, **kwargs)
+                return wrapper
+            with unittest.mock.patch.multiple(os, stat=counted(os.stat),
+                    lstat=counted(os.lstat), access=counted(os.access)):
+                self.assertEqual(resolve_command_path("some_program"), prog)
+            self.assertEqual(syscalls, [])
+
+            rehash()
+            os.rename(prog, prog + ".moved")
+            try:
+                self.assertEqual(resolve_command_path("some_program"), None)
+            finally:
+                os.rename(prog + ".moved", prog)
+
+        # a different PATH is a different lookup
+        with unittest.mock.patch.dict(os.environ, {"PATH": ""}):
+            self.assertEqual(resolve_command_path("some_program"), None)
+
+
     def test_no_arg(self):
         import pwd
         from sh import whoami
@@ -574,6 +642,59 @@ print("hi")
     def test_incompatible_special_args(self):
         from sh import ls
         self.assertRaises(TypeError, ls, _iter=True, _piped=True)
+        # a cached validation result must still raise
+        self.assertRaises(TypeError, ls, _iter=True, _piped=True)
+
+    @skip_unless(HAS_MOCK, "requires unittest.mock")
+    def test_special_args_validated_once(self):
+        sh_globals = sh.Command.__init__.__globals__
+        calls = []
+        orig_ob_is_pipe = sh_globals["ob_is_pipe"]
+        def ob_is_pipe(ob):
+            calls.append(ob)
+            return orig_ob_is_pipe(ob)
+
+        out = tempfile.TemporaryFile()
+        fd = out.fileno()
+        with unittest.mock.patch.dict(sh_globals, {"ob_is_pipe": ob_is_pipe}):
+            cmd = python.bake(_out=fd, _out_bufsize=0)
+            self.assertTrue(calls)
+            del calls[:]
+            cmd.bake(_out=fd, _out_bufsize=0)
+            self.assertEqual(calls, [])
+
+            # a file object is cached by what its fd points to too, so it's
+            # the same as the fd
+            cmd.bake(_out=out, _out_bufsize=0)
+            self.assertEqual(calls, [])
+        out.close()
+
+    def test_special_args_validation_follows_fd(self):
+        # an fd number that's reused for something else is validated again
+        read_fd, write_fd = os.pipe()
+        self.assertRaises(TypeError, python.bake, _out=write_fd,
+                _out_bufsize=0)
+        out = tempfile.TemporaryFile()
+        os.dup2(out.fileno(), write_fd)
+        python.bake(_out=write_fd, _out_bufsize=0)
+        os.close(read_fd)
+        os.close(write_fd)
+        out.close()
+
+    def test_special_args_validation_keeps_nothing(self):
+        import weakref
+        import gc
+        class Lines(list):
+            pass
+        data = Lines(["x" * 1024])
+        ref = weakref.ref(data)
+        callback = lambda line: None
+        callback_ref = weakref.ref(callback)
+        python.bake(_in=data, _out=callback, _out_filter=b"x")
+        del data, callback
+        gc.collect()
+        self.assertTrue(ref() is None)
+        self.assertTrue(callback_ref() is None)
 
 
     def test_exception(self):
@@ -1796,6 +1917,264 @@ else:
         self.assertEqual(len(output), 100)
 
 
+    def test_finished_command_is_compact(self):
+        FinishedProcess = sh.Command.__init__.__globals__["FinishedProcess"]
+        p = sh.sleep("0.1", _bg=True)
+        self.assertFalse(hasattr(p, "__dict__"))
+        self.assertFalse(hasattr(p.process, "__dict__"))
+
+        # nothing could have written to our stdin, so it never needed a Queue
+        self.assertEqual(p.process._stdin, None)
+
+        # once finished, only the results are kept
+        p.wait()
+        self.assertTrue(isinstance(p.process, FinishedProcess))
+        self.assertFalse(hasattr(p.process, "__dict__"))
+        self.assertEqual(p.exit_code, 0)
+        self.assertRaises(OSError, p.kill)
+
+    def test_finished_command_output(self):
+        from sh import tr
+        FinishedProcess = sh.Command.__init__.__globals__["FinishedProcess"]
+        py = create_tmp_test("""
+import sys
+sys.stdout.write("one\\ntwo\\nthree")
+sys.stderr.write("err")
+""")
+        for freeze in (False, True):
+            p = python(py.name, _freeze_output=freeze)
+            self.assertTrue(isinstance(p.process, FinishedProcess))
+            self.assertEqual(p.stdout, b"one\ntwo\nthree")
+            self.assertEqual(p.stderr, b"err")
+            self.assertEqual(list(p), ["one\n", "two\n", "three"])
+
+            p = python(py.name, _freeze_output=freeze)
+            self.assertEqual(tr(p, "a-z", "A-Z"), "ONE\nTWO\nTHREE")
+
+        p = python(py.name, _freeze_output=True)
+        self.assertTrue(isinstance(p.process._stdout, bytes))
+
+        # a command that was iterated over partway keeps its place
+        p = python(py.name, _iter=True)
+        self.assertEqual(next(p), "one\n")
+        p.wait()
+        self.assertEqual(list(p), ["two\n", "three"])
+
+    def test_out_keep(self):
+        from sh import tr, ErrorReturnCode_1
+        py = create_tmp_test("""
+import sys
+for i in range(1000):
+    sys.stdout.write("%04d\\n" % i)
+sys.stderr.write("e" * 1000)
+exit(int(sys.argv[1]))
+""")
+        p = python(py.name, 0, _out_keep=("head", 10, "tail", 10),
+                _err_keep=("tail", 5))
+        self.assertEqual(p.stdout,
+                b"0000\n0001\n\n... (4980 bytes dropped) ...\n0998\n0999\n")
+        self.assertEqual(p.stderr, b"\n... (995 bytes dropped) ...\neeeee")
+
+        # what goes down the pipe is what was kept
+        self.assertEqual(list(p)[2], "\n... (4980 bytes dropped) ...\n")
+        out = tr(python(py.name, 0, _out_keep=("head", 5)), "0", "x")
+        self.assertEqual(out, "xxxx\n\n... (4995 bytes dropped) ...\n")
+
+        # unless we're iterating, which sees everything as it comes
+        p = python(py.name, 0, _out_keep=("head", 5), _iter=True)
+        self.assertEqual(len(list(p)), 1000)
+
+        try:
+            python(py.name, 1, _out_keep=("head", 5, "tail", 5))
+        except ErrorReturnCode_1 as e:
+            self.assertEqual(e.stdout,
+                    b"0000\n\n... (4990 bytes dropped) ...\n0999\n")
+        else:
+            self.fail("should have raised")
+
+        self.assertRaises(TypeError, python, py.name, 0,
+                _out_keep=("middle", 5))
+        self.assertRaises(TypeError, python, py.name, 0, _out_keep=("head",))
+
+    def test_out_filter(self):
+        import re
+        py = create_tmp_test("""
+import sys
+for i in range(10):
+    print(("ERROR %d" if i % 3 == 0 else "INFO %d") % i)
+sys.stdout.write("WARN last")
+sys.stderr.write("ERROR err\\nINFO err\\n")
+""")
+        p = python(py.name, _out_filter=re.compile(b"ERROR|WARN"),
+                _err_filter="INFO")
+        self.assertEqual(p.stdout, b"ERROR 0\nERROR 3\nERROR 6\nERROR 9\nWARN last")
+        self.assertEqual(p.stderr, b"INFO err\n")
+
+        # text patterns and functions work too, and iterating sees only what
+        # was let through
+        p = python(py.name, _out_filter=re.compile("WARN|9"), _iter=True)
+        self.assertEqual(list(p), ["ERROR 9\n", "WARN last"])
+
+        lines = []
+        python(py.name, _out=lines.append,
+                _out_filter=lambda line: line.startswith(b"INFO 1"))
+        self.assertEqual(lines, ["INFO 1\n"])
+
+        self.assertRaises(TypeError, python, py.name, _out_filter="x",
+                _out_bufsize=0)
+        self.assertRaises(TypeError, python, py.name, _out_filter=3)
+
+    def test_out_sinks(self):
+        import hashlib
+        from sh.sinks import Hash, Count, LineLengthHistogram
+        py = create_tmp_test("""
+import sys
+sys.stdout.write("one\\nthree\\n\\nfive5")
+sys.stderr.write("ab\\ncd\\n")
+""")
+        h = Hash("sha256")
+        p = python(py.name, _out=h, _err=Count(), _tee=True)
+        self.assertEqual(p.stdout, b"one\nthree\n\nfive5")
+        self.assertTrue(p.out_sink is h)
+        self.assertEqual(h.hexdigest(),
+                hashlib.sha256(b"one\nthree\n\nfive5").hexdigest())
+        self.assertEqual(p.err_sink.result, {"bytes": 6, "lines": 2})
+        self.assertEqual(p.stderr, b"")
+
+        # lines split across chunks are still counted whole
+        p = python(py.name, _out=LineLengthHistogram(), _out_bufsize=2)
+        self.assertEqual(p.out_sink.result, {0: 1, 3: 1, 5: 2})
+        self.assertEqual(p.stdout, b"")
+
+        p = python(py.name, _out=LineLengthHistogram(bucket=4))
+        self.assertEqual(p.out_sink.result, {0: 2, 4: 2})
+        self.assertEqual(python(py.name).out_sink, None)
+
+        # a sink of our own has to have update and result
+        class Longest(sh._sinks.Sink):
+            def __init__(self):
+                sh._sinks.Sink.__init__(self)
+                self.longest = 0
+            def update(self, chunk):
+                for line in chunk.split(b"\n"):
+                    self.longest = max(self.longest, len(line))
+            @property
+            def result(self):
+                return self.longest
+        self.assertEqual(python(py.name, _out=Longest()).out_sink.result, 5)
+
+        class Incomplete(sh._sinks.Sink):
+            def update(self, chunk):
+                pass
+        self.assertRaises(TypeError, Incomplete)
+
+    def test_out_list(self):
+        try: from Queue import Queue
+        except ImportError: from queue import Queue
+        from sh.sinks import Count
+        py = create_tmp_test("""
+import sys
+sys.stdout.write("one\\ntwo\\nthree\\n")
+""")
+        read_fd, write_fd = os.pipe()
+        lines = []
+        out = ioStringIO()
+        q = Queue()
+        with tempfile.NamedTemporaryFile() as f:
+            p = python(py.name, _out=[write_fd, lines.append, out, q,
+                Count(), f.name])
+            os.close(write_fd)
+            self.assertEqual(os.read(read_fd, 1024), b"one\ntwo\nthree\n")
+            os.close(read_fd)
+            self.assertEqual(lines, ["one\n", "two\n", "three\n"])
+            self.assertEqual(out.getvalue(), "one\ntwo\nthree\n")
+            self.assertEqual([q.get() for i in range(3)], lines)
+            self.assertEqual(p.out_sink.result, {"bytes": 14, "lines": 3})
+            self.assertEqual(f.read(), b"one\ntwo\nthree\n")
+        self.assertEqual(p.stdout, b"")
+
+        # a binary file is written through its fd, after what it had buffered
+        import io
+        writes = []
+        class Recording(io.BufferedWriter):
+            def write(self, data):
+                writes.append(data)
+                return super(Recording, self).write(data)
+        with tempfile.NamedTemporaryFile() as f:
+            out = Recording(io.FileIO(f.name, "w"))
+            out.write(b"first\n")
+            del writes[:]
+            python(py.name, _out=[out, lines.append])
+            self.assertEqual(writes, [])
+            out.close()
+            self.assertEqual(f.read(), b"first\none\ntwo\nthree\n")
+
+        # a callback that quits stops getting output, but the others don't
+        def first(line, stdin, process):
+            lines.append(line.upper())
+            return True
+        lines = []
+        p = python(py.name, _out=(first, lines.append), _tee=True)
+        self.assertEqual(lines, ["ONE\n", "one\n", "two\n", "three\n"])
+        self.assertEqual(p.stdout, b"one\ntwo\nthree\n")
+
+    def test_compressed_sinks(self):
+        import gzip
+        import bz2
+        py = create_tmp_test("""
+for i in range(1000):
+    print("line %d, which compresses well" % i)
+""")
+        expected = python(py.name).stdout
+
+        with tempfile.NamedTemporaryFile(suffix=".gz") as f:
+            gz = sh._sinks.Gzip(f.name, level=3)
+            p = python(py.name, _out=gz, _tee=True)
+            self.assertEqual(p.stdout, expected)
+            self.assertEqual(gzip.open(f.name).read(), expected)
+            self.assertEqual(gz.result["bytes"], len(expected))
+            self.assertTrue(gz.result["compressed_bytes"] < len(expected) / 5)
+
+        out = iocStringIO()
+        python(py.name, _out=sh._sinks.Bz2(out))
+        self.assertEqual(bz2.decompress(out.getvalue()), expected)
+
+    def test_out_compress(self):
+        py = create_tmp_test("""
+import sys
+for i in range(1000):
+    print("line %d" % i)
+sys.stderr.write("done\\n")
+""")
+        expected = python(py.name).stdout
+        p = python(py.name, _out_compress=True, _err_compress=9)
+        self.assertEqual(p.stdout, expected)
+        self.assertEqual(p.stderr, b"done\n")
+        self.assertTrue(p.process._stdout.compressed_size < len(expected) / 2)
+
+        p = python(py.name, _out_compress=1, _freeze_output=True)
+        self.assertEqual(p.stdout, expected)
+        self.assertEqual(sh.cat(_in=p).stdout, expected)
+        self.assertEqual(python(py.name, _out_compress=True, _iter=True,
+            _out_bufsize=0).next(), "l")
+
+        self.assertRaises(TypeError, python, py.name, _out_compress=10)
+        self.assertRaises(TypeError, python, py.name, _out_compress=1,
+                _out_keep=100)
+
+        import threading
+
+        # with _err_to_out, stderr's buffer never gets a reader, or any
+        # output, so it mustn't start a compression thread to leak
+        def compression_threads():
+            return len([t for t in threading.enumerate()
+                if t.name == "compression"])
+        before = compression_threads()
+        for i in range(10):
+            python(py.name, _err_to_out=True, _out_compress=True,
+                    _err_compress=True)
+        self.assertEqual(compression_threads(), before)
+
     def test_change_stdout_buffering(self):
         py = create_tmp_test("""
 import sys
@@ -2464,6 +2843,722 @@ sys.stdout.write(sys.argv[1])
         out = python.bake(py.name).bake_()
         self.assertEqual("bake", out)
 
+    def test_compiled_command(self):
+        from sh import ARG
+        py = create_tmp_test("""
+import sys
+sys.stdout.write(" ".join(sys.argv[1:]))
+""")
+        compiled = python._compile(py.name, "first", ARG, "--flag", ARG)
+        self.assertEqual("first a --flag b", compiled("a", "b"))
+        self.assertEqual("first 1 --flag 2", compiled(1, 2))
+        self.assertEqual("first a --flag b extra --opt=val",
+                compiled("a", "b", "extra", opt="val"))
+
+        self.assertRaises(TypeError, compiled, "a")
+        self.assertRaises(TypeError, compiled, "a", "b", _tty_out=False)
+
+        # "compile" is still a subcommand
+        self.assertEqual("compile x", python.bake(py.name).compile("x"))
+
+    def test_compiled_command_call_args(self):
+        py = create_tmp_test("""
+import sys
+sys.stdout.write(sys.argv[1])
+exit(int(sys.argv[1]))
+""")
+        out = []
+        compiled = python.bake(py.name)._compile(_ok_code=[0, 3],
+                _out=out.append)
+        compiled(3)
+        compiled(0)
+        self.assertEqual(["3", "0"], out)
+        self.assertRaises(sh.ErrorReturnCode_1, compiled, 1)
+
+    def test_map(self):
+        py = create_tmp_test("""
+import sys
+import time
+time.sleep(float(sys.argv[1]))
+sys.stdout.write(sys.argv[1])
+if sys.argv[2:]:
+    exit(int(sys.argv[2]))
+""")
+        cmd = python.bake(py.name)
+        items = ["0.3", "0.1", ("0.2", 3), "0"]
+
+        results = list(cmd._map(items, workers=2))
+        self.assertEqual(items, [item for item, _ in results])
+        self.assertEqual("0.3", results[0][1])
+        self.assertEqual("0.1", results[1][1])
+        self.assertTrue(isinstance(results[2][1], sh.ErrorReturnCode_3))
+        self.assertEqual(b"0.2", results[2][1].stdout)
+        self.assertEqual("0", results[3][1])
+
+        results = list(cmd._map(items, workers=4, ordered=False))
+        self.assertEqual(["0", "0.1", ("0.2", 3), "0.3"],
+                [item for item, _ in results])
+
+        # bad arguments are caught at the call, not on the first next()
+        self.assertRaises(ValueError, cmd._map, items, workers=0)
+        self.assertRaises(TypeError, cmd._map, items, _piped=True,
+                _iter=True)
+
+        # any other args come before each item
+        results = list(cmd._map(["0", "0"], "0", workers=2))
+        self.assertEqual(["0", "0"], [str(result) for _, result in results])
+        results = list(python._map(["a", "b"], "-c",
+            "import sys; sys.stdout.write(sys.argv[1])", workers=2))
+        self.assertEqual(["a", "b"], [str(result) for _, result in results])
+
+        # "map" is still a subcommand
+        self.assertEqual("map x\n", sh.echo.map("x"))
+
+    def test_map_workers(self):
+        py = create_tmp_test("""
+import time
+time.sleep(0.3)
+""")
+        start = time.time()
+        list(python._map([py.name] * 4, workers=1))
+        self.assertTrue(time.time() - start >= 1.2)
+
+        start = time.time()
+        list(python._map([py.name] * 4, workers=4))
+        self.assertTrue(time.time() - start < 1.0)
+
+    def test_xargs(self):
+        py = create_tmp_test("""
+import sys
+sys.stdout.write(" ".join(sys.argv[1:]))
+""")
+        cmd = python.bake(py.name, "-x")
+        results = cmd._xargs(["a", "b", ("c", "d"), "e"], max_args=2)
+        self.assertEqual(["-x a b", "-x c d", "-x e"], results)
+
+        results = cmd._xargs(["a", "b", ("c", "d"), "e"], max_args=3,
+                max_procs=2)
+        self.assertEqual(["-x a b", "-x c d e"], results)
+
+        self.assertEqual([], cmd._xargs([]))
+
+        results = cmd._xargs(["a", "b", "c"], "-y", max_args=2)
+        self.assertEqual(["-x -y a b", "-x -y c"], results)
+
+        # "xargs" is still a subcommand
+        self.assertEqual("-x xargs a", cmd.xargs("a"))
+
+    def test_xargs_arg_max(self):
+        py = create_tmp_test("""
+import sys
+sys.stdout.write(str(len(sys.argv) - 1))
+""")
+        num_args = 300000
+        results = python.bake(py.name)._xargs(["x" * 10] * num_args)
+        self.assertTrue(len(results) > 1)
+        self.assertEqual(num_args, sum([int(r) for r in results]))
+
+    def test_xargs_exception(self):
+        py = create_tmp_test("""
+import sys
+exit(int(sys.argv[1]))
+""")
+        self.assertRaises(sh.ErrorReturnCode_3, python.bake(py.name)._xargs,
+                ["0", "3", "0", "4"], max_args=1, max_procs=2)
+
+    def test_max_concurrency(self):
+        py = create_tmp_test("""
+import time
+time.sleep(0.3)
+""")
+        limiter = sh.set_max_concurrency(2)
+        try:
+            start = time.time()
+            procs = [python(py.name, _bg=True) for i in range(4)]
+            self.assertEqual(2, limiter.stats()["waiting"])
+            self.assertTrue(procs[2].process is None)
+
+            python(py.name)
+            for p in procs:
+                p.wait()
+            self.assertTrue(time.time() - start >= 0.9)
+
+            stats = limiter.stats()
+            self.assertEqual(5, stats["started"])
+            self.assertEqual(3, stats["waited"])
+            self.assertEqual(0, stats["running"])
+            self.assertTrue(stats["max_wait_time"] > 0.2)
+        finally:
+            sh.set_max_concurrency(None)
+
+    def test_max_concurrent_fifo(self):
+        py = create_tmp_test("""
+import sys
+import time
+time.sleep(0.1)
+sys.stdout.write(sys.argv[1])
+""")
+        order = []
+        def done(cmd, success, exit_code):
+            order.append(cmd.ran.split()[-1])
+
+        cmd = python.bake(py.name, _max_concurrent=1, _done=done)
+        procs = [cmd(str(i), _bg=True) for i in range(4)]
+        for p in procs:
+            p.wait()
+        self.assertEqual(["0", "1", "2", "3"], order)
+
+    def test_max_concurrent_pending(self):
+        py = create_tmp_test("""
+import sys
+import time
+time.sleep(float(sys.argv[1]))
+sys.stdout.write("done %s\\n" % sys.argv[1])
+""")
+        cmd = python.bake(py.name, _max_concurrent=1)
+
+        # piping from a command that's still waiting for a slot waits for it
+        # to start
+        first = cmd("0.3", _bg=True)
+        pending = cmd("0.1", _bg=True)
+        self.assertTrue(pending.process is None)
+        self.assertEqual("done 0.1\n", sh.cat(pending))
+        first.wait()
+
+        # and so does iterating over it
+        first = cmd("0.3", _bg=True)
+        pending = cmd("0.1", _bg=True, _iter=True)
+        self.assertEqual(["done 0.1\n"], list(pending))
+        first.wait()
+
+        # and killing it, which kills the process once it's started
+        first = cmd("0.3", _bg=True)
+        pending = cmd("5", _bg=True, _bg_exc=False)
+        self.assertTrue(pending.process is None)
+        pending.kill()
+        self.assertTrue(pending.pid > 0)
+        self.assertRaises(sh.SignalException_SIGKILL, pending.wait)
+        first.wait()
+
+        # a pending command that's slow to start doesn't hold up the command
+        # whose slot it gets
+        first = cmd("0.1", _bg=True)
+        pending = cmd("0", _bg=True, _preexec_fn=lambda: time.sleep(1))
+        start = time.time()
+        first.wait()
+        self.assertTrue(time.time() - start < 0.8)
+        self.assertEqual("done 0\n", pending.wait())
+
+    def test_task_graph(self):
+        py = create_tmp_test("""
+import sys
+import time
+log, name, delay = sys.argv[1:]
+with open(log, "a") as h:
+    h.write("start " + name + "\\n")
+time.sleep(float(delay))
+with open(log, "a") as h:
+    h.write("end " + name + "\\n")
+sys.stdout.write(name)
+""")
+        log = tempfile.NamedTemporaryFile()
+        cmd = python.bake(py.name, log.name)
+
+        graph = sh.TaskGraph(max_parallel=2)
+        graph.add("d", cmd.bake("d", 0), after=["b", "c"])
+        graph.add("b", cmd.bake("b", 0.2), after="a")
+        graph.add("c", cmd.bake("c", 0.2), after="a")
+        graph.add("a", cmd.bake("a", 0))
+        results = graph.run()
+
+        self.assertEqual(set("abcd"), set(results.keys()))
+        self.assertEqual("d", results["d"])
+
+        events = log.read().decode().split("\n")
+        self.assertEqual(["start a", "end a"], events[:2])
+        # b and c run at the same time
+        self.assertEqual(set(["start b", "start c"]), set(events[2:4]))
+        self.assertEqual(["start d", "end d", ""], events[-3:])
+
+    def test_task_graph_pipe(self):
+        producer = create_tmp_test("""
+for i in range(1000):
+    print(i)
+""")
+        consumer = create_tmp_test("""
+import sys
+sys.stdout.write(str(len(sys.stdin.readlines())))
+""")
+        graph = sh.TaskGraph()
+        graph.add("produce", python.bake(producer.name))
+        graph.add("consume", python.bake(consumer.name), pipe_from="produce")
+        results = graph.run()
+        self.assertEqual("1000", results["consume"])
+
+    def test_task_graph_failure(self):
+        py = create_tmp_test("""
+import sys
+exit(int(sys.argv[1]))
+""")
+        cmd = python.bake(py.name)
+        graph = sh.TaskGraph()
+        graph.add("fail", cmd.bake(3))
+        graph.add("downstream", cmd.bake(0), after="fail")
+        graph.add("further", cmd.bake(0), after="downstream")
+        graph.add("independent", cmd.bake(0))
+
+        self.assertRaises(sh.ErrorReturnCode_3, graph.run)
+        results = graph.results
+        self.assertTrue(isinstance(results["fail"], sh.ErrorReturnCode_3))
+        self.assertTrue(isinstance(results["downstream"], sh.DependencyFailed))
+        self.assertTrue(isinstance(results["further"], sh.DependencyFailed))
+        self.assertEqual(0, results["independent"].exit_code)
+
+        graph = sh.TaskGraph()
+        graph.add("a", cmd.bake(0), after="b")
+        graph.add("b", cmd.bake(0), after="a")
+        self.assertRaises(ValueError, graph.run)
+
+    def test_incremental(self):
+        import shutil
+        py = create_tmp_test("""
+import sys
+src, dst, counter = sys.argv[1:]
+with open(counter, "a") as h:
+    h.write("x")
+with open(src) as h:
+    data = h.read()
+with open(dst, "w") as h:
+    h.write(data.upper())
+sys.stdout.write("built " + data)
+""")
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        src = join(tmp_dir, "src")
+        dst = join(tmp_dir, "dst")
+        counter = join(tmp_dir, "counter")
+        cache_dir = join(tmp_dir, "cache")
+        with open(src, "w") as h:
+            h.write("one")
+
+        build = python.bake(py.name, src, dst, counter, _inputs=[src],
+                _outputs=[dst], _cache_dir=cache_dir)
+        def runs():
+            with open(counter) as h:
+                return len(h.read())
+
+        self.assertEqual(build(), "built one")
+        self.assertEqual(runs(), 1)
+
+        os.unlink(dst)
+        p = build()
+        self.assertEqual(p, "built one")
+        self.assertEqual(p.exit_code, 0)
+        self.assertEqual(runs(), 1)
+        with open(dst) as h:
+            self.assertEqual(h.read(), "ONE")
+
+        with open(src, "w") as h:
+            h.write("two")
+        self.assertEqual(build(), "built two")
+        self.assertEqual(runs(), 2)
+
+        # failures aren't recorded
+        fail = python.bake("-c", "exit(3)", _cache_dir=cache_dir)
+        self.assertRaises(sh.ErrorReturnCode_3, fail)
+        self.assertRaises(sh.ErrorReturnCode_3, fail)
+
+    def test_incremental_key(self):
+        import shutil
+        py = create_tmp_test("""
+import sys, os
+counter, src = sys.argv[1:]
+with open(counter, "a") as h:
+    h.write("x")
+for name in sorted(os.listdir(src)):
+    with open(os.path.join(src, name)) as h:
+        sys.stdout.write(h.read() + "\\n")
+""")
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        src = join(tmp_dir, "src")
+        os.mkdir(src)
+        counter = join(tmp_dir, "counter")
+        cache_dir = join(tmp_dir, "cache")
+        def write_src(data):
+            with open(join(src, "a"), "w") as h:
+                h.write(data)
+        def runs():
+            with open(counter) as h:
+                return len(h.read())
+        write_src("one")
+
+        build = python.bake(py.name, counter, src, _inputs=[src],
+                _inputs_check="content", _cache_dir=cache_dir)
+        self.assertEqual(build(), "one\n")
+        self.assertEqual(build(), "one\n")
+        self.assertEqual(runs(), 1)
+
+        # a change to a file in an input directory is a change to the input,
+        # even if the directory looks the same
+        st = os.stat(src)
+        write_src("two")
+        os.utime(src, (st.st_atime, st.st_mtime))
+        self.assertEqual(build(), "two\n")
+        self.assertEqual(runs(), 2)
+
+        # output that's shaped differently is recorded separately
+        self.assertEqual(build(_out_filter="x"), "")
+        self.assertEqual(build(_out_keep=("head", 1)),
+                "t\n... (3 bytes dropped) ...\n")
+        self.assertEqual(runs(), 4)
+
+        # redirected output isn't recorded, so callbacks always see it
+        lines = []
+        build(_out=lines.append)
+        build(_out=lines.append)
+        self.assertEqual(lines, ["two\n", "two\n"])
+        self.assertEqual(runs(), 6)
+
+        # neither is a piped run, since it has to be a real process to pipe
+        # from
+        self.assertEqual(sh.cat(build(_piped=True)), "two\n")
+        self.assertEqual(sh.cat(build(_piped=True)), "two\n")
+        self.assertEqual(runs(), 8)
+
+    def test_result_cache(self):
+        py = create_tmp_test("""
+import sys, os
+counter = sys.argv[1]
+with open(counter, "a") as h:
+    h.write("x")
+sys.stdout.write(sys.argv[2])
+""")
+        counter = tempfile.NamedTemporaryFile(delete=False)
+        self.addCleanup(os.unlink, counter.name)
+        def runs():
+            with open(counter.name) as h:
+                return len(h.read())
+
+        cmd = python.bake(py.name, counter.name, _cache_ttl=60, _cache_size=2)
+        cache = cmd._partial_call_args["cache_ttl"]
+
+        self.assertEqual(cmd("a"), "a")
+        self.assertEqual(cmd("a"), "a")
+        self.assertEqual(runs(), 1)
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+        # a different stdin is a different run
+        self.assertEqual(cmd("a", _in="x"), "a")
+        self.assertEqual(runs(), 2)
+
+        # "a" was used more recently than the run with stdin, so that's the
+        # one that gets evicted
+        cmd("a")
+        cmd("b")
+        self.assertEqual(runs(), 3)
+        self.assertEqual(cache.stats()["evictions"], 1)
+        cmd("a")
+        self.assertEqual(runs(), 3)
+
+        cache.ttl = 0
+        cache.clear()
+        cmd("a")
+        cmd("a")
+        self.assertEqual(runs(), 5)
+
+        # the same cache is used for calls that don't bake it in
+        uncached = python.bake(py.name, counter.name)
+        uncached("c", _cache_ttl=60)
+        uncached("c", _cache_ttl=60)
+        self.assertEqual(runs(), 6)
+
+        # filtered output is cached apart from the unfiltered output
+        self.assertEqual(uncached("c", _cache_ttl=60, _out_filter="x"), "")
+        self.assertEqual(runs(), 7)
+
+        # and so is partly kept output
+        self.assertEqual(uncached("long", _cache_ttl=60,
+            _out_keep=("head", 2)),
+                "lo\n... (2 bytes dropped) ...\n")
+        self.assertEqual(uncached("long", _cache_ttl=60), "long")
+        self.assertEqual(runs(), 9)
+
+        # a piped run is never a cache hit, since it has to be a real process
+        # to pipe from
+        for i in range(2):
+            piped = uncached("d", _cache_ttl=60, _piped=True)
+            self.assertEqual(sh.cat(piped), "d")
+        self.assertEqual(runs(), 11)
+
+    def test_single_flight(self):
+        py = create_tmp_test("""
+import sys, time
+counter = sys.argv[1]
+with open(counter, "a") as h:
+    h.write("x")
+time.sleep(0.5)
+sys.stdout.write("hi\\n")
+exit(2)
+""")
+        counter = tempfile.NamedTemporaryFile(delete=False)
+        self.addCleanup(os.unlink, counter.name)
+        def runs():
+            with open(counter.name) as h:
+                return len(h.read())
+
+        cmd = python.bake(py.name, counter.name, _single_flight=True,
+                _ok_code=2)
+        done = []
+        leader = cmd(_bg=True,
+                _done=lambda p, success, code: done.append(code))
+        followers = [cmd(_bg=True, _done=lambda p, success, code:
+            done.append(code)) for i in range(5)]
+        # the exit code is judged by each command's own ok_code
+        strict = cmd(_bg=True, _ok_code=0)
+
+        self.assertEqual(leader.wait(), "hi\n")
+        for p in followers:
+            self.assertEqual(p.wait(), "hi\n")
+            self.assertEqual(p.exit_code, 2)
+            self.assertEqual(list(p), ["hi\n"])
+        self.assertRaises(sh.ErrorReturnCode_2, strict.wait)
+        self.assertEqual(done, [2] * 6)
+        self.assertEqual(runs(), 1)
+
+        # once it's finished, the next one runs again
+        cmd()
+        self.assertEqual(runs(), 2)
+
+        # commands whose output is shaped differently don't share a process
+        leader = cmd(_bg=True, _piped=True)
+        filtered = cmd(_bg=True, _out_filter="nothing")
+        kept = cmd(_bg=True, _out_keep=("head", 1))
+        compressed = cmd(_bg=True, _out_compress=True)
+        plain = cmd(_bg=True)
+        self.assertEqual(filtered.wait(), "")
+        self.assertEqual(kept.wait(), "h\n... (2 bytes dropped) ...\n")
+        self.assertEqual(compressed.wait(), "hi\n")
+        self.assertEqual(plain.wait(), "hi\n")
+        leader.wait()
+        self.assertEqual(runs(), 7)
+
+        # piped commands don't share a process either, so each one can be
+        # piped from
+        piped = [cmd(_bg=True, _piped=True) for i in range(2)]
+        for p in piped:
+            self.assertEqual(sh.cat(p), "hi\n")
+        self.assertEqual(runs(), 9)
+
+    def test_coprocess(self):
+        import re
+        import threading
+        py = create_tmp_test("""
+import sys
+for line in iter(sys.stdin.readline, ""):
+    line = line.strip()
+    if line == "exit":
+        exit(3)
+    if line == "hang":
+        import time
+        time.sleep(10)
+    sys.stdout.write(line.upper() + "\\n")
+    sys.stdout.flush()
+""")
+        cmd = python.bake("-u", py.name)
+        coprocess = sh.Coprocess(cmd)
+        self.addCleanup(coprocess.close)
+
+        self.assertEqual(coprocess.request("abc\n"), "ABC\n")
+        pid = coprocess.process.pid
+        self.assertEqual(coprocess.request("a\nb\n", until=re.compile(b"B\n")),
+                "A\nB\n")
+        self.assertEqual(coprocess.request("xy\n", until=2), "XY")
+        self.assertEqual(coprocess.request(until="\n"), "\n")
+        self.assertEqual(coprocess.process.pid, pid)
+
+        self.assertRaises(sh.ErrorReturnCode_3, coprocess.request, "exit\n")
+        self.assertEqual(coprocess.request("back\n"), "BACK\n")
+        self.assertNotEqual(coprocess.process.pid, pid)
+
+        self.assertRaises(sh.TimeoutException, coprocess.request, "hang\n",
+                timeout=0.2)
+        self.assertEqual(coprocess.request("again\n"), "AGAIN\n")
+
+        # an `until` that fails leaves nothing behind for the next request
+        def broken(buf):
+            raise ValueError(bytes(buf))
+        self.assertRaises(ValueError, coprocess.request, "a\n", until=broken)
+        self.assertEqual(coprocess.request("b\n"), "B\n")
+
+        binary = sh.Coprocess(cmd, binary=True)
+        self.addCleanup(binary.close)
+        self.assertEqual(binary.request(b"abc\n", until=b"\n"), b"ABC\n")
+
+        # a _done baked into the command still gets called
+        exit_codes = []
+        exited = threading.Event()
+        def done(cmd, success, exit_code):
+            exit_codes.append(exit_code)
+            exited.set()
+        baked = sh.Coprocess(cmd.bake(_done=done))
+        self.addCleanup(baked.close)
+        self.assertRaises(sh.ErrorReturnCode_3, baked.request, "exit\n")
+        exited.wait(5)
+        self.assertEqual(exit_codes, [3])
+
+    def test_coprocess_pool(self):
+        import threading
+        py = create_tmp_test("""
+import sys, os
+for line in iter(sys.stdin.readline, ""):
+    sys.stdout.write("%d\\n" % os.getpid())
+    sys.stdout.flush()
+""")
+        pool = sh.CoprocessPool(python.bake("-u", py.name), size=2)
+        self.addCleanup(pool.close)
+
+        pids = []
+        def worker():
+            for i in range(10):
+                pids.append(pool.request("\n"))
+
+        threads = [threading.Thread(target=worker) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(pids), 40)
+        self.assertTrue(len(set(pids)) <= 2)
+
+    @requires_progs("git")
+    def test_git_read_objects(self):
+        import shutil
+        repo = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, repo)
+        setup = sh.git.bake("-C", repo, "-c", "user.name=sh",
+                "-c", "user.email=sh@example.com", _tty_out=False)
+        setup.init("-q")
+        with open(join(repo, "a"), "w") as h:
+            h.write("hello\n")
+        setup.add("a")
+        setup.commit("-q", "-m", "first")
+
+        git = sh.contrib.git
+        commit = git.read_commit("HEAD", repo=repo)
+        self.assertEqual(commit["message"], "first\n")
+        tree = git.read_tree("HEAD", repo=repo)
+        self.assertEqual([entry[3] for entry in tree], ["a"])
+        blob_sha = tree[0][2]
+        self.assertEqual(git.read_blob(blob_sha, repo=repo), b"hello\n")
+
+        # a missing name can have spaces in it, and it mustn't throw off the
+        # responses after it
+        self.assertRaises(KeyError, git.read_blob, "HEAD:no such", repo=repo)
+        self.assertEqual(git.read_blob("HEAD:a", repo=repo), b"hello\n")
+
+        # with the objects gone, anything by a full sha we've read has to come
+        # from the cache, including a commit's tree, peeled from the commit
+        shutil.move(join(repo, ".git", "objects"), join(repo, "moved"))
+        self.assertEqual(git.read_commit(commit["sha"], repo=repo), commit)
+        self.assertEqual(git.read_tree(commit["sha"], repo=repo), tree)
+        self.assertEqual(git.read_tree(commit["tree"], repo=repo), tree)
+        self.assertEqual(git.read_blob(blob_sha, repo=repo), b"hello\n")
+
+        # a cached object that can't be peeled to the type we want is refused
+        # without asking git
+        self.assertRaises(ValueError, git.read_blob, commit["tree"],
+                repo=repo)
+        self.assertRaises(ValueError, git.read_commit, commit["tree"],
+                repo=repo)
+        self.assertRaises(ValueError, git.read_tree, blob_sha, repo=repo)
+
+    def test_session(self):
+        py = create_tmp_test("""
+import sys, os
+sys.stdout.write("%d %s %s\\n" % (os.getppid(), sys.argv[1], os.getcwd()))
+sys.stderr.write(sys.stdin.read())
+exit(int(sys.argv[2]))
+""")
+        session = sh.Session(tty_out=False)
+        self.addCleanup(session.close)
+        cmd = python.bake(py.name, _session=session)
+
+        tmp_dir = realpath(tempfile.gettempdir())
+        out = cmd("it's", 0, _in="err", _cwd=tmp_dir)
+        shell_pid, arg, cwd = out.split()
+        self.assertEqual((arg, cwd), ("it's", tmp_dir))
+        self.assertEqual(out.stderr, b"err")
+        self.assertEqual(out.exit_code, 0)
+
+        # the same shell runs every command
+        self.assertEqual(cmd("a", 0).split()[0], shell_pid)
+        self.assertNotEqual(shell_pid, str(os.getpid()))
+
+        self.assertRaises(sh.ErrorReturnCode_3, cmd, "a", 3)
+        self.assertEqual(cmd("a", 3, _ok_code=3).exit_code, 3)
+
+        # things a session can't do are launched normally
+        p = cmd("a", 0, _bg=True, _in="x")
+        self.assertEqual(p.split()[0], str(os.getpid()))
+        p = cmd("a", 0, _in="x", _out_filter=" a ")
+        self.assertEqual(p.split()[0], str(os.getpid()))
+        self.assertEqual(cmd("a", 0, _in="x", _out_filter="nothing"), "")
+        p = cmd("a", 0, _in="x", _out_keep=("tail", 1))
+        self.assertTrue(p.endswith(" bytes dropped) ...\n\n"))
+
+        # by default, a session keeps out of the way of commands that expect
+        # a tty
+        tty_session = sh.Session()
+        self.addCleanup(tty_session.close)
+        cmd = python.bake(py.name, _session=tty_session)
+        self.assertEqual(cmd("a", 0, _in="x").split()[0], str(os.getpid()))
+        out = cmd("a", 0, _tty_out=False)
+        self.assertNotEqual(out.split()[0], str(os.getpid()))
+        self.assertEqual(cmd("a", 0, _tty_out=False).split()[0],
+                out.split()[0])
+
+    @skip_unless(hasattr(socket.socket, "sendmsg"), "Needs socket.sendmsg")
+    def test_forkserver(self):
+        py = create_tmp_test("""
+import sys, os
+sys.stdout.write("%d %s %s" % (os.getppid(), os.getcwd(), sys.stdin.read()))
+exit(int(sys.argv[1]))
+""")
+        forkserver = sh.start_forkserver()
+        self.addCleanup(sh.stop_forkserver)
+        self.assertTrue(sh.start_forkserver() is forkserver)
+
+        tmp_dir = realpath(tempfile.gettempdir())
+        out = python(py.name, 0, _in="in", _cwd=tmp_dir)
+        self.assertEqual(out, "%d %s in" % (forkserver.pid, tmp_dir))
+
+        self.assertRaises(sh.ErrorReturnCode_3, python, py.name, 3, _in="x")
+        p = python(py.name, 0, _bg=True, _in="bg")
+        self.assertTrue(p.wait().endswith("bg"))
+
+        # a preexec_fn means forking ourselves
+        out = python(py.name, 0, _in="x", _preexec_fn=lambda: None)
+        self.assertEqual(int(out.split()[0]), os.getpid())
+
+        sh.stop_forkserver()
+        out = python(py.name, 0, _in="x")
+        self.assertEqual(int(out.split()[0]), os.getpid())
+
+    def test_subcommand_cached(self):
+        py = create_tmp_test("""
+import sys
+sys.stdout.write(" ".join(sys.argv[1:]))
+""")
+        cmd = python.bake(py.name)
+        self.assertTrue(cmd.log is cmd.log)
+        self.assertTrue(cmd.log is not cmd.status)
+        self.assertEqual("log", cmd.log())
+        self.assertEqual("log oneline", cmd.log.oneline())
+        self.assertRaises(AttributeError, getattr, cmd, "_nonexistent")
+
 
     def test_no_proc_no_attr(self):
         py = create_tmp_test("")
@@ -2838,6 +3933,19 @@ print("cool")
         self.assertTrue(loglines, "Log handler captured no messages?")
         self.assertTrue(loglines[0].startswith("Hi! I ran something"))
 
+    @skip_unless(HAS_MOCK, "requires unittest.mock")
+    def test_logger_looked_up_once(self):
+        py = create_tmp_test("")
+        logger = logging.getLogger("sh")
+        logger.setLevel(logging.INFO)
+        self.addCleanup(logger.setLevel, logging.NOTSET)
+        python(py.name)
+
+        # every logger a command uses has been looked up by now
+        with unittest.mock.patch.object(logging, "getLogger") as get_logger:
+            python(py.name)
+        self.assertEqual(get_logger.call_count, 0)
+
 
     # https://github.com/amoffat/sh/issues/273
     def test_stop_iteration_doesnt_block(self):
@@ -2940,6 +4048,16 @@ class StreamBuffererTests(unittest.TestCase):
         self.assertEqual(b.process(b"\nthree\n"), [b"e\ntwo\nthre"])
         self.assertEqual(b.flush(), b"e\n")
 
+    def test_change_buffering(self):
+        from sh import _disable_whitelist, StreamBufferer
+        b = StreamBufferer(1)
+
+        self.assertEqual(b.process(b"one\ntw"), [b"one\n"])
+        b.change_buffering(0)
+        self.assertEqual(b.process(b"o"), [b"tw", b"o"])
+        self.assertEqual(b.process(b"three"), [b"three"])
+        self.assertEqual(b.flush(), b"")
+
 
 @requires_posix
 class ExecutionContextTests(unittest.TestCase):
@@ -3009,6 +4127,107 @@ class ExecutionContextTests(unittest.TestCase):
         omg = _sh
         from omg import python
 
+    def test_context(self):
+        import sh
+        out = StringIO()
+        ctx = sh._context(_out=out)
+        ctx.echo("-n", "TEST")
+        self.assertEqual("TEST", out.getvalue())
+
+        # contexts made from contexts keep what's baked into them
+        err = StringIO()
+        ctx2 = ctx._context(_err=err)
+        ctx2.echo("-n", "TEST2")
+        self.assertEqual("TESTTEST2", out.getvalue())
+
+        out2 = StringIO()
+        sh_named = sh._context("sh_named", _out=out2)
+        from sh_named import echo
+        echo("-n", "NAMED")
+        self.assertEqual("NAMED", out2.getvalue())
+
+        self.assertRaises(RuntimeError, sh._context, "sh")
+
+        # none of our helpers hide a program of the same name
+        bin_dir = tempfile.mkdtemp()
+        old_path = os.environ["PATH"]
+        os.environ["PATH"] = bin_dir + os.pathsep + old_path
+        try:
+            for name in ("context", "rehash", "sinks"):
+                with open(join(bin_dir, name), "w") as h:
+                    h.write("#!/bin/sh\necho %s\n" % name)
+                os.chmod(join(bin_dir, name), int(0o755))
+            # a fresh wrapper, since other tests turn off sh's whitelist
+            fresh = sh._context()
+            self.assertEqual("context\n", fresh.context())
+            self.assertEqual("rehash\n", fresh.rehash())
+            self.assertEqual("sinks\n", fresh.sinks())
+        finally:
+            os.environ["PATH"] = old_path
+            for name in os.listdir(bin_dir):
+                os.unlink(join(bin_dir, name))
+            os.rmdir(bin_dir)
+
+    def test_importer_registered_lazily(self):
+        py = create_tmp_test("""
+import os, sys
+sys.path.insert(0, os.getcwd())
+def registered():
+    return any(type(i).__name__ == "ModuleImporterFromVariables"
+        for i in sys.meta_path)
+
+import sh
+before = registered()
+_sh = sh()
+from _sh import echo
+print("%s %s" % (before, registered()))
+""")
+        out = python(py.name, _cwd=THIS_DIR).strip()
+        self.assertEqual(out, "False True")
+
+    @skip_unless(HAS_MOCK, "requires unittest.mock")
+    def test_importer_rejects_by_name(self):
+        import sh
+        sh_globals = sh.Command.__init__.__globals__
+        importer = sh_globals["ModuleImporterFromVariables"](
+                restrict_to=["SelfWrapper"])
+        ctx_by_name = sh._context("ctx_by_name")
+        looked = []
+        def fetch(name, frame):
+            looked.append(name)
+            return frame.f_locals.get(name, frame.f_globals.get(name, None))
+
+        with unittest.mock.patch.dict(sh_globals,
+                {"fetch_module_from_frame": fetch}):
+            # another name is turned away without looking at any frames
+            self.assertEqual(importer.find_spec("not_a_context", None), None)
+            self.assertEqual(looked, [])
+            self.assertTrue(importer.find_spec("ctx_by_name", None))
+            self.assertEqual(looked, ["ctx_by_name"])
+
+        # a context assigned to another variable can still be imported from
+        also_ctx = ctx_by_name
+        from also_ctx import echo
+        self.assertEqual("x\n", echo("x"))
+
+    def test_import_is_lean(self):
+        # modules that only some of sh's features need shouldn't be imported
+        # by `import sh` itself
+        py = create_tmp_test("""
+import os, sys
+sys.path.insert(0, os.getcwd())
+import sh
+heavy = ("ast", "inspect", "logging", "platform", "tempfile", "traceback",
+    "getpass", "hashlib", "binascii", "shutil", "pickle", "socket", "array",
+    "pty", "tty", "termios", "resource", "zlib", "bz2", "lzma")
+print(" ".join(sorted(m for m in heavy if m in sys.modules)))
+""")
+        # a forkserver started at import needs some of them
+        env = os.environ.copy()
+        env.pop("SH_FORKSERVER", None)
+        out = python(py.name, _cwd=THIS_DIR, _env=env).strip()
+        self.assertEqual(out, "")
+
     def test_importer_only_works_with_sh(self):
         def unallowed_import():
             _os = os